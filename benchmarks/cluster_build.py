@@ -0,0 +1,203 @@
+'''
+Measures how long build_cluster takes for N workers against a fake compute engine, so no VMs are created.
+The fake takes --insert seconds to accept an insert (or bulk insert), --create seconds until the VMs are running,
+only accepts --rate inserts per second (rate limited calls fail with 429 like the real API),
+and fails every VM in --full zones. --bulk also builds the cluster from an instance template with bulk inserts.
+
+Example: python benchmarks/cluster_build.py --workers 50 --inflight 1 16 --bulk --full us-central1-b
+'''
+
+import argparse
+import tempfile
+import threading
+import json
+import time
+import os
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL import main
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status):
+        super().__init__('HTTP %d' % status)
+        self.resp = type('Response', (), {'status': status})()
+        self.content = b''
+
+
+class FakeRequest:
+    def __init__(self, call):
+        self.call = call
+
+    def execute(self):
+        return self.call()
+
+
+class FakeState:
+    '''
+    State shared by the fake clients of every thread
+    '''
+
+    def __init__(self, insert_seconds, create_seconds, rate, full_zones):
+        self.insert_seconds = insert_seconds
+        self.create_seconds = create_seconds
+        self.rate = rate
+        self.full_zones = set(full_zones)
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.instances = {}
+        self.insert_times = []
+        self.calls = 0
+
+    def allow_insert(self):
+        with self.lock:
+            self.calls += 1
+            now = time.time()
+            self.insert_times = [t for t in self.insert_times if now - t < 1]
+            if len(self.insert_times) >= self.rate:
+                return False
+            self.insert_times.append(now)
+            return True
+
+    def add_operation(self, zone, error=False):
+        with self.lock:
+            name = 'operation-%d' % len(self.operations)
+            self.operations[name] = (time.time() + self.create_seconds, error)
+        return {"name": name, "zone": zone}
+
+    def operation(self, name):
+        done_time, error = self.operations[name]
+        result = {"name": name, "status": "DONE" if time.time() >= done_time else "RUNNING"}
+        if error and result["status"] == "DONE":
+            result["error"] = {"errors": [{"code": "ZONE_RESOURCE_POOL_EXHAUSTED"}]}
+        return result
+
+
+class FakeInstances:
+    def __init__(self, state):
+        self.state = state
+
+    def insert(self, project, zone, body):
+        return self.bulkInsert(project, zone, {"perInstanceProperties": {body["name"]: {}}})
+
+    def bulkInsert(self, project, zone, body):
+        def call():
+            if not self.state.allow_insert():
+                raise FakeHttpError(429)
+            time.sleep(self.state.insert_seconds)
+            full = zone in self.state.full_zones
+            if not full:
+                with self.state.lock:
+                    for name in body["perInstanceProperties"]:
+                        self.state.instances[name] = zone
+            return self.state.add_operation(zone, error=full)
+        return FakeRequest(call)
+
+    def list(self, project, zone):
+        return FakeRequest(lambda: {"items": [{"name": name, "status": "RUNNING"}
+                                              for name, instance_zone in self.state.instances.items()
+                                              if instance_zone == zone]})
+
+    def delete(self, project, zone, instance):
+        def call():
+            with self.state.lock:
+                self.state.instances.pop(instance, None)
+            return self.state.add_operation(zone)
+        return FakeRequest(call)
+
+
+class FakeInstanceTemplates:
+    def __init__(self, state):
+        self.state = state
+
+    def insert(self, project, body):
+        def call():
+            with self.state.lock:
+                self.state.calls += 1
+            return self.state.add_operation(None)
+        return FakeRequest(call)
+
+    def delete(self, project, instanceTemplate):
+        return FakeRequest(lambda: self.state.add_operation(None))
+
+
+class FakeOperations:
+    '''
+    Zone or global operations
+    '''
+
+    def __init__(self, state):
+        self.state = state
+
+    def get(self, project, operation, zone=None):
+        return FakeRequest(lambda: self.state.operation(operation))
+
+    def wait(self, project, operation, zone=None):
+        def call():
+            done_time = self.state.operations[operation][0]
+            # The real wait returns after about 2 minutes even when the operation is not done
+            time.sleep(max(0, min(done_time - time.time(), 120)))
+            return self.state.operation(operation)
+        return FakeRequest(call)
+
+
+class FakeCompute:
+    def __init__(self, state):
+        self.state = state
+
+    def instances(self):
+        return FakeInstances(self.state)
+
+    def instanceTemplates(self):
+        return FakeInstanceTemplates(self.state)
+
+    def zoneOperations(self):
+        return FakeOperations(self.state)
+
+    def globalOperations(self):
+        return FakeOperations(self.state)
+
+
+def build(args, in_flight, configs_pth, startup_pth, bulk=False):
+    state = FakeState(args.insert, args.create, args.rate, args.full)
+    gcp.set_compute(lambda: FakeCompute(state))
+    start = time.time()
+    built = main.build_cluster('project', 'bucket', args.workers, configs_pth, startup_pth, gcp.QuickSend('bucket'),
+                               in_flight, bulk)
+    return built, time.time() - start, state.calls
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmarking build_cluster against a fake compute engine")
+    parser.add_argument("--workers", type=int, default=50, help="Number of VMs to build")
+    parser.add_argument("--inflight", type=int, nargs='+', default=[1, 16], help="Max VMs built at once to compare")
+    parser.add_argument("--insert", type=float, default=0.2, help="Seconds the fake takes to accept an insert")
+    parser.add_argument("--create", type=float, default=2, help="Seconds until a fake VM is running")
+    parser.add_argument("--rate", type=int, default=20, help="Inserts per second the fake accepts")
+    parser.add_argument("--full", nargs='*', default=[], help="Zones where every VM fails to build")
+    parser.add_argument("--bulk", action="store_true", help="Also build with an instance template and bulk inserts")
+    args = parser.parse_args()
+
+    configs = json.loads(main.resource_string('clouDL_utils', os.path.join('user_files', 'configs.json')))
+    with tempfile.TemporaryDirectory() as folder:
+        # Errors are written to the bucket when some workers are not built
+        gcp.set_storage('local', folder)
+        gcp.make_bucket('bucket', None)
+        configs_pth = os.path.join(folder, 'configs.json')
+        startup_pth = os.path.join(folder, 'user_startup.sh')
+        with open(configs_pth, 'w') as f:
+            json.dump(configs, f)
+        with open(startup_pth, 'w') as f:
+            f.write('echo benchmark')
+
+        results = [('in flight %d' % in_flight, build(args, in_flight, configs_pth, startup_pth))
+                   for in_flight in args.inflight]
+        if args.bulk:
+            results.append(('bulk insert', build(args, None, configs_pth, startup_pth, bulk=True)))
+
+    for name, (built, seconds, calls) in results:
+        print('%-14s %d/%d built in %.2fs with %d insert calls' % (name + ':', built, args.workers, seconds, calls))
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,78 @@
+'''
+Reports the compression ratio against encode and decode time of every checkpoint codec and precision.
+Random weights barely compress, so pass a real state dict with --params for meaningful numbers.
+
+Example: python benchmarks/compression.py --params ./tmp/params.pt
+'''
+
+import argparse
+import time
+import io
+
+import torch
+
+from clouDL_utils.checkpoint import CheckpointIO, PRECISIONS
+from clouDL_utils import compression
+
+
+def synthetic_state(layers, width):
+    state = {}
+    for i in range(layers):
+        state['layer%d.weight' % i] = torch.randn(width, width) * 0.02
+        state['layer%d.bias' % i] = torch.zeros(width)
+    return state
+
+
+def measure(checkpoint_io, state, codec, precision, repeats):
+    if precision is not None:
+        state = checkpoint_io.cast(state, precision)
+
+    start = time.time()
+    for _ in range(repeats):
+        buffer = io.BytesIO()
+        checkpoint_io.write(state, buffer, codec)
+    encode_secs = (time.time() - start) / repeats
+
+    start = time.time()
+    for _ in range(repeats):
+        buffer.seek(0)
+        checkpoint_io.read(buffer, codec)
+    decode_secs = (time.time() - start) / repeats
+    return len(buffer.getvalue()), encode_secs, decode_secs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarking checkpoint compression")
+    parser.add_argument("-p", "--params", help="State dict saved with torch.save, a random one is used when missing")
+    parser.add_argument("-l", "--layers", type=int, default=8, help="Layers of the random state dict")
+    parser.add_argument("-w", "--width", type=int, default=1024, help="Width of the random state dict layers")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Number of timed runs per codec")
+    args = parser.parse_args()
+
+    if args.params:
+        state = torch.load(args.params, map_location='cpu')
+    else:
+        state = synthetic_state(args.layers, args.width)
+
+    # Only the in memory encoding is measured, nothing is uploaded
+    checkpoint_io = CheckpointIO(None, None, torch)
+
+    codecs = []
+    for codec in compression.CODECS:
+        try:
+            compression.check_codec(codec)
+            codecs.append(codec)
+        except ValueError as err:
+            print('Skipping %s: %s' % (codec, err))
+
+    raw_bytes, _, _ = measure(checkpoint_io, state, 'none', None, 1)
+    print('%-6s %-9s %12s %8s %10s %10s' % ('codec', 'precision', 'MB', 'ratio', 'encode s', 'decode s'))
+    for precision in [None] + PRECISIONS:
+        for codec in codecs:
+            num_bytes, encode_secs, decode_secs = measure(checkpoint_io, state, codec, precision, args.repeats)
+            print('%-6s %-9s %12.2f %8.2f %10.3f %10.3f' % (codec, precision or 'full', num_bytes / 1e6,
+                                                            raw_bytes / num_bytes, encode_secs, decode_secs))
+
+
+if __name__ == '__main__':
+    main()
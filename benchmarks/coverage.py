@@ -0,0 +1,94 @@
+'''
+Measures how well a trial budget covers the hyperparameter space with each sampling method.
+Points come from Hyperparameters.generate for every (rank, iteration) of a cluster, just like on the VMs.
+
+Lower discrepancy and dispersion mean better coverage, a larger min distance means fewer near duplicate trials.
+
+Example: python benchmarks/coverage.py --dims 4 --workers 8 --iterations 16
+'''
+
+import argparse
+import random
+import math
+
+from clouDL_utils.hyperparameters import Hyperparameters
+
+
+def cluster_points(method, dims, workers, iterations):
+    points = []
+    for rank in range(workers):
+        for cur_iter in range(iterations):
+            raw_hyparams = {
+                "hyperparameters": {"x%d" % dim: {"method": method, "data": [0, 1]} for dim in range(dims)},
+                "current_iter": cur_iter,
+                "max_iter": iterations,
+                "rank": rank,
+                "workers": workers
+            }
+            hyparams = Hyperparameters(hyparams=raw_hyparams)
+            hyparams.generate()
+            values = hyparams.get_hyparams()
+            points.append([values["x%d" % dim] for dim in range(dims)])
+    return points
+
+
+def centered_discrepancy(points):
+    '''
+    Centered L2 discrepancy (Hickernell) of points in the unit cube
+    '''
+
+    n = len(points)
+    dims = len(points[0])
+    first = (13 / 12) ** dims
+    second = 0
+    for point in points:
+        product = 1
+        for x in point:
+            product *= 1 + 0.5 * abs(x - 0.5) - 0.5 * abs(x - 0.5) ** 2
+        second += product
+    third = 0
+    for a in points:
+        for b in points:
+            product = 1
+            for x, y in zip(a, b):
+                product *= 1 + 0.5 * abs(x - 0.5) + 0.5 * abs(y - 0.5) - 0.5 * abs(x - y)
+            third += product
+    return math.sqrt(max(first - 2 * second / n + third / n ** 2, 0))
+
+
+def dispersion(points, probes):
+    '''
+    Largest distance from a random probe to its closest point, the biggest gap left in the space
+    '''
+
+    rand = random.Random(0)
+    dims = len(points[0])
+    largest = 0
+    for _ in range(probes):
+        probe = [rand.random() for _ in range(dims)]
+        largest = max(largest, min(math.dist(probe, point) for point in points))
+    return largest
+
+
+def min_distance(points):
+    return min(math.dist(a, b) for i, a in enumerate(points) for b in points[i + 1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarking hyperparameter space coverage")
+    parser.add_argument("-d", "--dims", type=int, default=4, help="Number of hyperparameters")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Number of VMs")
+    parser.add_argument("-i", "--iterations", type=int, default=16, help="Iterations per VM")
+    parser.add_argument("-p", "--probes", type=int, default=2000, help="Random probes for the dispersion")
+    args = parser.parse_args()
+
+    print('%d trials in %d dimensions' % (args.workers * args.iterations, args.dims))
+    print('%-16s %12s %12s %12s' % ('method', 'discrepancy', 'dispersion', 'min dist'))
+    for method in ["uniform random", "sobol", "latin hypercube"]:
+        points = cluster_points(method, args.dims, args.workers, args.iterations)
+        print('%-16s %12.4f %12.4f %12.4f' % (method, centered_discrepancy(points), dispersion(points, args.probes),
+                                              min_distance(points)))
+
+
+if __name__ == '__main__':
+    main()
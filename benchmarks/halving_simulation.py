@@ -0,0 +1,105 @@
+'''
+Replays the progress curves of recorded results through successive halving to measure how much compute it saves.
+Trials are replayed one after another in the order they finished, as if every curve had been stopped at its
+rungs, and the result shows whether the best trials would still have run to the end.
+
+Example: python benchmarks/halving_simulation.py -b my-bucket --reduction 3 --brackets 1
+'''
+
+import argparse
+import os
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils.scheduler import rung_epochs, keep_going
+from clouDL_utils.progress import Progress
+from clouDL_utils import strings
+
+
+def load_curves(bucket_name):
+    '''
+    :return: List of (result file name, best score after each epoch) with higher scores being better
+    '''
+
+    blobs = []
+    for folder in [strings.results, os.path.join(strings.archive, strings.results)]:
+        blobs.extend(gcp.backend.list_blobs(bucket_name, folder + '/'))
+    results = {}
+    gcp.transfer_all([(lambda blob=blob: results.__setitem__(blob.name, gcp.stream_download_json(
+        bucket_name, blob.name)), blob.size or 0) for blob in blobs if blob.name.endswith('.json')])
+
+    curves = []
+    # Result file names start with the time the trial finished
+    for name in sorted(results, key=os.path.basename):
+        progress = Progress(progress=results[name]["progress"])
+        compare, goal = progress.get_compare_goal()
+        try:
+            values = progress.get_compare_vals()
+        except KeyError:
+            continue
+        sign = 1 if goal == "max" else -1
+        best = []
+        for value in values:
+            best.append(max(best[-1], sign * value) if best else sign * value)
+        if best:
+            curves.append((name, best))
+    return curves
+
+
+def simulate(curves, min_epochs, max_epochs, reduction, brackets):
+    '''
+    :return: List of epochs each trial would have run
+    '''
+
+    recorded = {}
+    used = []
+    for index, (_, curve) in enumerate(curves):
+        bracket = index % brackets
+        epochs = min(len(curve), max_epochs)
+        for rung in rung_epochs(min_epochs, max_epochs, reduction, bracket):
+            if rung > len(curve):
+                break
+            scores = recorded.setdefault((bracket, rung), [])
+            scores.append(curve[rung - 1])
+            if not keep_going(curve[rung - 1], scores, reduction):
+                epochs = rung
+                break
+        used.append(epochs)
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulating successive halving on recorded results")
+    parser.add_argument("-b", "--bucket", required=True, help="Bucket holding the results")
+    parser.add_argument("--min_epochs", type=int, default=1, help="Epochs before the first comparison")
+    parser.add_argument("--max_epochs", type=int, help="Epochs of a full trial, defaults to the longest curve")
+    parser.add_argument("-r", "--reduction", type=int, default=3, help="Only 1 / reduction of the trials continue")
+    parser.add_argument("--brackets", type=int, default=1, help="Number of Hyperband brackets")
+    parser.add_argument("--storage", choices=["gcs", "local"], default="gcs")
+    parser.add_argument("--localpth", default="./buckets")
+    args = parser.parse_args()
+
+    gcp.set_storage(args.storage, args.localpth)
+    curves = load_curves(args.bucket)
+    if not curves:
+        print('No results in %s' % args.bucket)
+        return
+
+    max_epochs = args.max_epochs or max(len(curve) for _, curve in curves)
+    used = simulate(curves, args.min_epochs, max_epochs, args.reduction, args.brackets)
+    full = [min(len(curve), max_epochs) for _, curve in curves]
+
+    finals = [curve[epochs - 1] for (_, curve), epochs in zip(curves, full)]
+    best_index = finals.index(max(finals))
+    completed = [final for final, epochs, total in zip(finals, used, full) if epochs == total]
+
+    print('%d trials, %d epochs per full trial' % (len(curves), max_epochs))
+    print('Epochs without halving: %d' % sum(full))
+    print('Epochs with halving:    %d (%.1f%% saved)' % (sum(used), 100 * (1 - sum(used) / sum(full))))
+    print('Extra full trials the saved epochs buy: %d' % ((sum(full) - sum(used)) // max_epochs))
+    print('Best trial %s ran to the end: %s' % (curves[best_index][0], used[best_index] == full[best_index]))
+    print('Best completed score: %s, best overall: %s (scores negated when minimizing)' %
+          (max(completed) if completed else None, finals[best_index]))
+
+
+if __name__ == '__main__':
+    main()
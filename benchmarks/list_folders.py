@@ -0,0 +1,63 @@
+'''
+Compares listing every blob against delimiter listing in gcp.get_folder_names.
+
+Example: python benchmarks/list_folders.py --localpth /tmp/clouDL-bench --objects 100000 --folders 50
+'''
+
+import argparse
+import time
+import os
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils import strings
+
+
+def fill_bucket(bucket_name, objects, folders):
+    per_folder = objects // folders
+    jobs = []
+    for folder in range(folders):
+        for i in range(per_folder):
+            dest = os.path.join(strings.best_model, str(folder), 'blob-%d.json' % i)
+            jobs.append((lambda dest=dest: gcp.stream_upload_str(bucket_name, '{}', dest), 2))
+    print(gcp.transfer_all(jobs))
+
+
+def time_listing(bucket_name, delimiter, repeats):
+    start = time.time()
+    for _ in range(repeats):
+        folder_names = gcp.get_folder_names(bucket_name, strings.best_model, delimiter=delimiter)
+    return (time.time() - start) / repeats, folder_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarking folder listing")
+    parser.add_argument("-b", "--bucket", default="clouDL-bench", help="The bucket to fill and list")
+    parser.add_argument("-o", "--objects", type=int, default=100000, help="Total number of blobs")
+    parser.add_argument("-f", "--folders", type=int, default=50, help="Number of first level folders")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Number of timed listings per mode")
+    parser.add_argument("--storage", choices=["gcs", "local"], default="local")
+    parser.add_argument("--localpth", default="./bench-buckets")
+    parser.add_argument("--skipfill", action="store_true", help="Reuse blobs from an earlier run")
+    args = parser.parse_args()
+
+    gcp.set_storage(args.storage, args.localpth)
+
+    if not args.skipfill:
+        try:
+            gcp.make_bucket(args.bucket, "us-central1")
+        except Exception:
+            print('Using existing bucket %s' % args.bucket)
+        fill_bucket(args.bucket, args.objects, args.folders)
+
+    full_secs, full_names = time_listing(args.bucket, False, args.repeats)
+    delim_secs, delim_names = time_listing(args.bucket, True, args.repeats)
+    assert full_names == delim_names
+
+    print('%d folders, %d objects' % (len(delim_names), args.objects))
+    print('Listing every blob: %.4fs' % full_secs)
+    print('Delimiter listing:  %.4fs' % delim_secs)
+    print('Speedup: %.1fx' % (full_secs / delim_secs if delim_secs > 0 else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+'''
+Compares the time to finish a search when each worker runs a fixed share of the trials against workers taking
+trials from the trial queue. Both read the same trials from the bucket, on threads over the local storage backend
+that sleep instead of training, with some workers slower than others, and optionally one worker that is preempted
+in the middle of a trial. Both are timed, along with the trials they leave undone.
+
+Example: python benchmarks/queue_throughput.py --workers 4 --trials 24 --preempt
+'''
+
+import argparse
+import tempfile
+import threading
+import random
+import json
+import time
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils.trial_queue import TrialQueue, trial_ids, trial_path, done_path
+from clouDL_utils import strings
+
+
+def fill_queue(bucket_name, durations):
+    '''
+    Replaces the trials of the queue with one trial per duration, so every run starts from the same queue
+
+    :return: Ids of the trials in order
+    '''
+    names = [blob.name for blob in gcp.backend.list_blobs(bucket_name, strings.queue + '/')]
+    if names:
+        gcp.backend.delete_many(bucket_name, names)
+    trials = {'%08d' % index: {"duration": duration} for index, duration in enumerate(durations)}
+    TrialQueue.fill(bucket_name, trials)
+    return sorted(trials)
+
+
+def run_workers(bucket_name, work, speeds):
+    '''
+    Runs work(worker, speed) on a thread per worker
+
+    :return: Seconds until every worker stopped and the number of trials left undone
+    '''
+    start = time.time()
+    threads = [threading.Thread(target=work, args=(worker, speed)) for worker, speed in enumerate(speeds)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return elapsed, len(trial_ids(bucket_name, 'trials')) - len(trial_ids(bucket_name, 'done'))
+
+
+def static_time(bucket_name, durations, speeds):
+    '''
+    Every worker runs the trials of its own share (every workers-th trial) and nothing else
+    '''
+    shares = fill_queue(bucket_name, durations)
+    workers = len(speeds)
+
+    def work(worker, speed):
+        for trial_id in shares[worker::workers]:
+            hyparams = gcp.stream_download_json(bucket_name, trial_path(trial_id))
+            if speed is None:
+                # Preempted halfway through its first trial, the rest of its share is never run
+                time.sleep(hyparams["duration"] / 2)
+                return
+            time.sleep(hyparams["duration"] * speed)
+            gcp.stream_upload_str(bucket_name, json.dumps({"worker": worker}), done_path(trial_id))
+
+    return run_workers(bucket_name, work, speeds)
+
+
+def queue_time(bucket_name, durations, speeds, lease_seconds):
+    '''
+    Every worker takes the next trial from the trial queue until every trial is done
+    '''
+    fill_queue(bucket_name, durations)
+
+    def work(worker, speed):
+        queue = TrialQueue(bucket_name, lease_seconds)
+        while True:
+            lease = queue.next(poll_seconds=lease_seconds / 4)
+            if lease is None:
+                return
+            lease.start()
+            if speed is None:
+                # Preempted halfway through its first trial, the lease is never renewed or released
+                time.sleep(lease.hyparams["duration"] / 2)
+                lease.stopped.set()
+                return
+            time.sleep(lease.hyparams["duration"] * speed)
+            lease.complete()
+
+    return run_workers(bucket_name, work, speeds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarking static trial shares against the trial queue")
+    parser.add_argument("--workers", type=int, default=4, help="Number of workers")
+    parser.add_argument("--trials", type=int, default=24, help="Number of trials")
+    parser.add_argument("--duration", type=float, default=0.2, help="Average seconds per trial on a fast worker")
+    parser.add_argument("--slowdown", type=float, default=2, help="How many times slower the slow workers are")
+    parser.add_argument("--lease", type=float, default=1, help="Seconds a lease lasts without being renewed")
+    parser.add_argument("--preempt", action="store_true", help="Preempt the first worker during its first trial")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    durations = [rand.uniform(0.5, 1.5) * args.duration for _ in range(args.trials)]
+    # Every other worker is slow, None is a preempted worker
+    speeds = [args.slowdown if worker % 2 else 1 for worker in range(args.workers)]
+    if args.preempt:
+        speeds[0] = None
+
+    with tempfile.TemporaryDirectory() as root:
+        gcp.set_storage('local', root)
+        gcp.make_bucket('benchmark', None)
+
+        static = static_time('benchmark', durations, speeds)
+        queued = queue_time('benchmark', durations, speeds, args.lease)
+
+    print('static shares: %.2fs, %d trials left undone' % static)
+    print('trial queue:   %.2fs, %d trials left undone' % queued)
+
+
+if __name__ == '__main__':
+    main()
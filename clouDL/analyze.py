@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import argparse
 import json
 import os
@@ -17,7 +16,14 @@ def hr():
     print("---" * 20)
 
 
+def get_plt():
+    # Imported when a plot is drawn since matplotlib is slow to import
+    import matplotlib.pyplot as plt
+    return plt
+
+
 def plot_vals(x, y, title, ylabel, xlabel="Number of Epochs"):
+    plt = get_plt()
     plt.plot(x, y, marker='o')
     plt.ylabel(ylabel)
     plt.xlabel(xlabel)
@@ -95,7 +101,6 @@ class Best_Model:
     @staticmethod
     def best_progress_list(bucket_name):
         folder_names = gcp.get_folder_names(bucket_name, strings.best_model)
-        folder_names = list(folder_names)
 
         if not folder_names:
             return None
@@ -157,7 +162,7 @@ class Best_Model:
         print("Hyperparameters used:")
         print(best_hyparams.interesting_vals())
         complete_title = title + (": %s vs. %s" % (compare, x_label))
-        plot_vals(best_progress.progress[x_label], compare_vals, complete_title, compare, x_label)
+        plot_vals(best_progress.get_values(x_label), compare_vals, complete_title, compare, x_label)
 
     def view(self, x_label):
         hr()
@@ -230,11 +235,12 @@ class Results:
         # ceiling division
         rows = (num + cols - 1 ) // cols
 
+        plt = get_plt()
         fig, axs = plt.subplots(nrows=rows, ncols=cols, sharex=True, sharey=True)
         fig.suptitle(main_title)
 
         for index, (progress, subplot_title) in enumerate(progress_list):
-            x = progress.progress[x_label]
+            x = progress.get_values(x_label)
             y = progress.get_compare_vals()
 
             row = index // cols
@@ -278,7 +284,7 @@ class Results:
         for folder_name, progress_list in progress_dictionary.items():
             main_title = 'For VM %s' % folder_name
             Results.subplot(main_title, x_label, yrange, progress_list)
-        plt.show()
+        get_plt().show()
 
 
 class Best_Archived_Models:
@@ -343,7 +349,7 @@ class Best_Archived_Models:
             # Plotting subplots
             main_title = "Best Models From Archive"
             Results.subplot(main_title, x_label, yrange, progress_list)
-            plt.show()
+            get_plt().show()
         else:
             print('No archived best model, cannot create subplots and will not plot metadata')
 
@@ -360,9 +366,17 @@ def main():
     parser.add_argument("-a", '--archive', nargs=2, help='View the best archived models. Provide the x value to plot by and top n to archive')
     parser.add_argument("-r", '--results', help='View the results. Provide the x value to plot by')
     parser.add_argument("-y", '--yrange', nargs=2, type=int, default=[0, 100], help='Provide y range for plotting')
+    parser.add_argument("-w", '--workers', type=int, default=gcp.transfer_workers,
+                        help='Max number of concurrent downloads')
+    parser.add_argument("--storage", choices=["gcs", "local"], default="gcs",
+                        help="Where the bucket lives. Use local to keep buckets in a local folder (ex: for benchmarking)")
+    parser.add_argument("--localpth",
+                        help="The folder holding the buckets when using local storage")
 
 
     args = parser.parse_args()
+    gcp.set_storage(args.storage, args.localpth)
+    gcp.set_transfer_workers(args.workers)
     downloader = Downloader(args.bucket_name, args.tmppth)
 
     if args.errs:
@@ -1,14 +1,24 @@
+import threading
 import argparse
 import copy
 import time
 import json
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 from clouDL_utils import gcp_interactions as gcp
 from clouDL_utils.archive import Archive
+from clouDL_utils.trial_queue import TrialQueue
+from clouDL_utils.supervisor import Supervisor
+from clouDL_utils import checkpoint
 from clouDL_utils import strings
 
-from pkg_resources import resource_string
+
+def resource_string(package, resource):
+    # pkg_resources is slow to import, so only pay for it when a packaged file is read
+    from pkg_resources import resource_string as read_resource
+    return read_resource(package, resource)
 
 
 def user_accepts(msg):
@@ -84,8 +94,8 @@ def move_access_token(bucket_name, access_token_pth):
     gcp.upload_file(bucket_name, access_token_pth, strings.secrets)
 
 
-def rmvms(bucket_name, folder_name):
-    folder_name = 'VM-progress'
+def rmvms(bucket_name, folder_name, dry_run=False):
+    folder_name = strings.vm_progress
 
     print(
         '''
@@ -94,7 +104,19 @@ def rmvms(bucket_name, folder_name):
         -folder_name: {1}
         '''.format(bucket_name, folder_name))
 
-    gcp.delete_all_prefixes(bucket_name, folder_name)
+    print(gcp.delete_all_prefixes(bucket_name, folder_name, dry_run))
+
+
+def collect_tensors(bucket_name, grace_minutes, dry_run=False):
+    print(
+        '''
+        Deleting the tensors of delta checkpoints that no checkpoint uses anymore.
+        -bucket name: {0}
+        -grace_minutes: {1}
+        '''.format(bucket_name, grace_minutes))
+
+    stats = checkpoint.collect_tensor_garbage(bucket_name, grace_minutes * 60, dry_run)
+    print('Unused tensors: %s' % stats)
 
 
 def fill(big, small):
@@ -105,20 +127,24 @@ def fill(big, small):
     return big_copy
 
 
-def hyperparamters(bucket_name, hyparams_path, archive, quick_send):
+def hyperparamters(bucket_name, hyparams_path, archive, quick_send, queue=False):
     print(
         '''
         Archiving data (if there are any) to prepare for new hyperparameters. 
         -bucket name: {0}
         -hyparams_pth: {1}
-        '''.format(bucket_name, hyparams_path))
+        -queue: {2}
+        '''.format(bucket_name, hyparams_path, queue))
 
     archive.archive()
+    if archive.dry_run:
+        return
 
     hyparam_configs = json.load(open(hyparams_path))
     iters = hyparam_configs["iterations"]
     all_hyperparameters = hyparam_configs["hyperparameters"]
     first = all_hyperparameters[0]
+    trials = {}
     for index, hyperparameters in enumerate(all_hyperparameters):
         if index == 0:
             filled = hyperparameters
@@ -128,12 +154,136 @@ def hyperparamters(bucket_name, hyparams_path, archive, quick_send):
         wrapper["hyperparameters"] = filled
         wrapper["current_iter"] = 0
         wrapper["max_iter"] = iters
+        # Lets joint sampling methods give every VM its own points
+        wrapper["rank"] = index
+        wrapper["workers"] = len(all_hyperparameters)
+        if "scheduler" in hyparam_configs:
+            wrapper["scheduler"] = hyparam_configs["scheduler"]
         quick_send.send(strings.vm_hyparams_report, json.dumps(wrapper), strings.vm_progress + '/' + str(index))
 
+        if queue:
+            for iteration in range(iters):
+                trial = copy.deepcopy(wrapper)
+                trial["current_iter"] = iteration
+                # Trial ids sort like the sample indexes, so the first trials of every section are taken first
+                trials['%08d' % (iteration * len(all_hyperparameters) + index)] = trial
+
+    if queue:
+        print(TrialQueue.fill(bucket_name, trials))
+
+
+def make_startup_script(startup_script_pth):
+    startup_template = resource_string('clouDL_utils', 'startup.sh').decode()
+    user_startup_script = open(startup_script_pth, 'r').read()
+    return startup_template.replace('# USER_CODE_GOES_HERE', user_startup_script)
+
 
-def build_cluster(project_id, bucket_name, workers, machine_configs_pth, startup_script_pth, quick_send):
+def build_worker(project_id, bucket_name, machine_configs, startup_script, rank, valid_zones, lock):
+    '''
+    Builds the VM of one rank. If it fails to build, the zone is removed (for every rank) and a different zone
+    is tried, until the VM is built or there are no more zones. Errors that are not caused by the zone
+    (ex: credentials or malformed configs) are raised instead, since every zone would fail the same way.
+
+    :param valid_zones: Zones that have not failed yet, shared by every rank
+    :param lock: Lock for valid_zones
+    :return: True if the VM was built
+    '''
+
+    tried = set()
+    while True:
+        with lock:
+            zones = [zone for zone in valid_zones if zone not in tried]
+            if not zones:
+                return False
+            zone = zones[rank % len(zones)]
+        tried.add(zone)
+
+        try:
+            operation = gcp.create_instance(project_id, machine_configs, startup_script, zone, rank, bucket_name)
+            if gcp.wait_for_operation(project_id, operation['name'], zone):
+                return True
+            print("Failed to build a worker in zone %s, trying a different zone" % zone)
+        except Exception as err:
+            if not gcp.is_zonal_error(err):
+                print("Failed to build worker %d: %s" % (rank, err))
+                raise
+            print("Failed to build a worker in zone %s, trying a different zone: %s" % (zone, err))
+
+        with lock:
+            if zone in valid_zones:
+                valid_zones.remove(zone)
+
+
+def bulk_build(project_id, bucket_name, workers, machine_configs, startup_script):
+    '''
+    Builds the VMs from one instance template with a bulk insert per zone, so the number of API calls
+    depends on the number of zones instead of workers. The ranks are split between the zones, and the ranks
+    of a zone that fails to build (without their instances existing) are split between the remaining zones.
+    Errors that are not caused by the zone are raised, see gcp.is_zonal_error.
+
+    :return: Number of VMs built
+    '''
+
+    prefix = machine_configs["name_prefix"]
+    template_name = "%s-template-%s" % (prefix, time.strftime("%Y%m%d-%H%M%S"))
+    operation = gcp.create_instance_template(project_id, machine_configs, startup_script, bucket_name, template_name)
+    if not gcp.wait_for_operation(project_id, operation['name']):
+        print("Failed to create the instance template %s" % template_name)
+        return 0
+
+    def insert(zone, ranks):
+        try:
+            names = [prefix + ("-%d" % rank) for rank in ranks]
+            operation = gcp.bulk_insert_instances(project_id, zone, template_name, names)
+            return gcp.wait_for_operation(project_id, operation['name'], zone)
+        except Exception as err:
+            if not gcp.is_zonal_error(err):
+                raise
+            print("Bulk insert in zone %s failed: %s" % (zone, err))
+            return False
+
+    valid_zones = list(machine_configs['zones'])
+    remaining_ranks = list(range(workers))
+    built = 0
+    try:
+        while remaining_ranks and valid_zones:
+            groups = {}
+            for idx, rank in enumerate(remaining_ranks):
+                groups.setdefault(valid_zones[idx % len(valid_zones)], []).append(rank)
+
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                futures = {zone: executor.submit(insert, zone, ranks) for zone, ranks in groups.items()}
+
+            remaining_ranks = []
+            for zone, future in futures.items():
+                if future.result():
+                    built += len(groups[zone])
+                    continue
+
+                # The insert may have failed after its instances were created (ex: a timeout while waiting),
+                # those are kept instead of being created again in another zone under the same names
+                existing = {instance['name'] for instance in gcp.list_instances(project_id, zone) or []}
+                ranks = [rank for rank in groups[zone] if prefix + ("-%d" % rank) not in existing]
+                built += len(groups[zone]) - len(ranks)
+                valid_zones.remove(zone)
+                if ranks:
+                    print("Failed to build %d workers in zone %s, trying a different zone" % (len(ranks), zone))
+                    remaining_ranks.extend(ranks)
+    finally:
+        # The VMs keep their properties without the template
+        try:
+            gcp.wait_for_operation(project_id, gcp.delete_instance_template(project_id, template_name)['name'])
+        except Exception:
+            print("Could not delete the instance template %s" % template_name)
+
+    return built
+
+
+def build_cluster(project_id, bucket_name, workers, machine_configs_pth, startup_script_pth, quick_send,
+                  max_in_flight=16, bulk=False):
     '''
     Builds a cluster of virtual machines in Google Cloud Platform (GCP).
+    Up to max_in_flight VMs are inserted and waited on at once, each on its own thread and compute client.
 
     :param project_id: The project ID for GCP.
     :param bucket_name: The bucket name for the VMs to store checkpoints and statistics.
@@ -141,6 +291,8 @@ def build_cluster(project_id, bucket_name, workers, machine_configs_pth, startup
     :param machine_configs_pth: The path for the JSON file specifying the hardware of the VMs.
     :param startup_script_pth: The startup script each VM should run.
     :param quick_send: A custom class used to easily send messages to Google Cloud Storage.
+    :param max_in_flight: The max number of VMs being built at once.
+    :param bulk: Build the VMs from an instance template with a bulk insert per zone, see bulk_build.
     '''
 
     print(
@@ -153,64 +305,63 @@ def build_cluster(project_id, bucket_name, workers, machine_configs_pth, startup
         -bucket_name: {4}
         '''.format(project_id, workers, machine_configs_pth, startup_script_pth, bucket_name))
 
-    max_workers = workers
+    start = time.time()
     machine_configs = json.load(open(machine_configs_pth))
-
-    # Generating startup script
-    startup_template = resource_string('clouDL_utils', 'startup.sh').decode()
-    user_startup_script = open(startup_script_pth, 'r').read()
-    startup_script = startup_template.replace('# USER_CODE_GOES_HERE', user_startup_script)
-
-    valid_zones = machine_configs['zones']
-    remaining_ranks = list(range(0, workers))
-
-    '''
-    Builds VM according to configs with given startup script.
-    If VM fails to build, then the zone is removed and we try a different zone. 
-    Cycle continues until there are no more zones or all workers have been built
-    '''
-    while workers > 0 and len(valid_zones) > 0:
-        unused_ranks = []
-        operations = []
-        for idx, rank in enumerate(remaining_ranks):
-            zone = valid_zones[idx % len(valid_zones)]
+    startup_script = make_startup_script(startup_script_pth)
+
+    if bulk:
+        built = bulk_build(project_id, bucket_name, workers, machine_configs, startup_script)
+    else:
+        valid_zones = list(machine_configs['zones'])
+        lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            futures = [executor.submit(build_worker, project_id, bucket_name, machine_configs, startup_script, rank,
+                                       valid_zones, lock) for rank in range(workers)]
             try:
-                operation = gcp.create_instance(project_id, machine_configs, startup_script,
-                                                zone, rank, bucket_name)
-                operation['vm-rank'] = rank
-                operation['testing-zone'] = zone
-                operations.append(operation)
+                built = sum(future.result() for future in futures)
             except Exception:
-                print("Failed to build a worker in zone %s, trying a different zone" % zone)
-                unused_ranks.append(rank)
-                valid_zones.remove(zone)
-            # Empirically improves workers startup time
-            time.sleep(3)
-
-        for op in operations:
-            zone = op['testing-zone']
-            rank = op['vm-rank']
-            passed = gcp.wait_for_operation(project_id, op['name'], zone)
-            if passed:
-                workers -= 1
-            else:
-                print("Failed to build a worker in zone %s, trying a different zone" % zone)
-                unused_ranks.append(rank)
-                valid_zones.remove(zone)
-        remaining_ranks = unused_ranks
+                # The other ranks would fail the same way
+                for future in futures:
+                    future.cancel()
+                raise
 
     # Writing errors to bucket
-    if workers != 0:
+    if built != workers:
         print("Writing error to shared errors in the cloud")
-        error_msg = "%d/%d workers built. All desired hyperparemters could not be explored" % \
-              (max_workers - len(remaining_ranks), max_workers)
+        error_msg = "%d/%d workers built. All desired hyperparemters could not be explored" % (built, workers)
         msg = {
             "error": error_msg,
             "time": time.strftime("%m/%d/%Y-%H:%M:%S")
         }
         quick_send.send(strings.cluster_error, json.dumps(msg), strings.shared_errors)
 
-    print("%d/%d workers built" % (max_workers - len(remaining_ranks), max_workers))
+    print("%d/%d workers built in %.1fs" % (built, workers, time.time() - start))
+    return built
+
+
+def supervise(project_id, bucket_name, workers, machine_configs_pth, startup_script_pth, stale_minutes,
+              poll_seconds):
+    '''
+    Re-creates the VMs whose heartbeats stopped until every rank is done, then reports the time to recover.
+
+    :param workers: The number of VMs in the cluster.
+    :param stale_minutes: Minutes without a heartbeat before a VM is re-created.
+    :param poll_seconds: Seconds between checks of the heartbeats.
+    '''
+
+    print(
+        '''
+        Supervising cluster
+        -project_id: {0}
+        -workers: {1}
+        -stale_minutes: {2}
+        -bucket_name: {3}
+        '''.format(project_id, workers, stale_minutes, bucket_name))
+
+    machine_configs = json.load(open(machine_configs_pth))
+    supervisor = Supervisor(project_id, bucket_name, workers, machine_configs, make_startup_script(startup_script_pth),
+                            stale_minutes * 60, poll_seconds)
+    supervisor.run()
 
 
 def gen_bucket_name(project_id, bucket_name):
@@ -230,6 +381,17 @@ def main():
                         help='The name of the bucket')
     parser.add_argument("-c", '--cluster', nargs=3,
                         help='Build VM cluster for training. Requires number of workers, machine configs path, and startup script path')
+    parser.add_argument("--inflight", type=int, default=16,
+                        help="The max number of VMs --cluster builds at once")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Build the VMs of --cluster from an instance template with one bulk insert per zone")
+    parser.add_argument("-s", '--supervise', nargs=3,
+                        help='Re-create the VMs that stopped sending heartbeats until every VM is done. '
+                             'Requires the same number of workers, machine configs path, and startup script path as --cluster')
+    parser.add_argument("--stale", type=float, default=30,
+                        help="Minutes without a heartbeat before --supervise re-creates a VM")
+    parser.add_argument("--poll", type=float, default=60,
+                        help="Seconds between the heartbeat checks of --supervise")
     parser.add_argument("-t", '--tokenpth',
                         help='The access_token path is used to download private repo from GitHub')
     parser.add_argument("-b", "--mkbucket", action="store_true",
@@ -238,17 +400,34 @@ def main():
                         help="The path of the data to move into the bucket")
     parser.add_argument("-p", "--hyparams",
                         help="The path for the hyperparameter json")
+    parser.add_argument("-q", "--queue", action="store_true",
+                        help="Put every trial of the hyperparameter json in a queue the workers take trials from, "
+                             "instead of giving each worker the iterations of its section")
     parser.add_argument("-a", "--archive", type=int, default=3,
                         help="The number of best models to archive")
+    parser.add_argument("-r", "--rmvms", action="store_true",
+                        help="Remove the folder containing VM progress")
+    parser.add_argument("--gc_tensors", action="store_true",
+                        help="Delete the tensors of delta checkpoints that no checkpoint uses anymore")
+    parser.add_argument("--grace", type=float, default=60,
+                        help="Minutes a tensor is kept after its upload by --gc_tensors")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Only report the files and bytes --rmvms, --gc_tensors, and the archive of --hyparams "
+                             "would delete")
     parser.add_argument("-l", "--location", default="us-central1",
                         help="The location for your bucket")
+    parser.add_argument("--storage", choices=["gcs", "local"], default="gcs",
+                        help="Where the bucket lives. Use local to keep buckets in a local folder (ex: for benchmarking)")
+    parser.add_argument("--localpth",
+                        help="The folder holding the buckets when using local storage")
 
     args = parser.parse_args()
+    gcp.set_storage(args.storage, args.localpth)
 
     pid = args.project_id
     bname = gen_bucket_name(pid, args.bucket_name)
     quick_send = gcp.QuickSend(bname)
-    archive = Archive(bname, args.archive)
+    archive = Archive(bname, args.archive, args.dry_run)
 
     if args.mkbucket:
         make_bucket(bname, args.location)
@@ -262,8 +441,16 @@ def main():
         move_data(bname, args.datapth)
         hr()
 
+    if args.rmvms:
+        rmvms(bname, strings.vm_progress, args.dry_run)
+        hr()
+
+    if args.gc_tensors:
+        collect_tensors(bname, args.grace, args.dry_run)
+        hr()
+
     if args.hyparams:
-        hyperparamters(bname, args.hyparams, archive, quick_send)
+        hyperparamters(bname, args.hyparams, archive, quick_send, args.queue)
         hr()
 
     if args.cluster:
@@ -271,8 +458,13 @@ def main():
             num_worker = int(args.cluster[0])
             machine_configs_pth = args.cluster[1]
             startup_script_pth = args.cluster[2]
-            build_cluster(pid, bname, num_worker, machine_configs_pth, startup_script_pth, quick_send)
+            build_cluster(pid, bname, num_worker, machine_configs_pth, startup_script_pth, quick_send,
+                          args.inflight, args.bulk)
             hr()
         else:
             print("Please push your desired code before continuing")
             hr()
+
+    if args.supervise:
+        supervise(pid, bname, int(args.supervise[0]), args.supervise[1], args.supervise[2], args.stale, args.poll)
+        hr()
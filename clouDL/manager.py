@@ -1,13 +1,22 @@
+import multiprocessing
+import threading
 import traceback
-import requests
+import atexit
+import shutil
 import copy
 import time
 import json
 import os
 
+from clouDL_utils.checkpointer import BackgroundCheckpointer
+from clouDL_utils.checkpoint import CheckpointOptions
 from clouDL_utils.hyperparameters import Hyperparameters
+from clouDL_utils.trial_history import TrialHistory
 from clouDL_utils import gcp_interactions as gcp
-from clouDL_utils.progress import Progress
+from clouDL_utils.progress import Progress, ProgressLog
+from clouDL_utils.scheduler import SuccessiveHalving
+from clouDL_utils.trial_queue import TrialQueue, LeaseLost
+from clouDL_utils import preemption
 from clouDL_utils import strings
 
 
@@ -16,41 +25,139 @@ class Manager:
     Triggers saving the current state of the model, hyperparameters, and performance
     '''
 
-    def __init__(self, temp_path, bucket_name, rank, torch):
+    def __init__(self, temp_path, bucket_name, rank, torch, checkpoint_options=None, slot=None, trial=None,
+                 heartbeat_seconds=60):
+        '''
+        :param checkpoint_options: CheckpointOptions of how checkpoints are saved and loaded, the defaults when None
+        :param slot: Slot of a trial run in parallel with others on this VM (see hyparam_search), its progress,
+            hyperparameters, and checkpoints are kept in vm-progress/<rank>/<slot>
+        :param trial: Id of a trial taken from the trial queue (see queue_search), its progress, hyperparameters,
+            and checkpoints are kept in vm-progress/trial-<id> so any worker can resume it, and its best model and
+            results in best-models/trial-<id> and results/trial-<id>
+        :param heartbeat_seconds: Write a heartbeat for clouDL --supervise at most this often, None to never write one
+        '''
+        options = checkpoint_options or CheckpointOptions()
+
         self.rank = rank
+        self.slot = slot
+        self.trial = trial
         self.bucket_name = bucket_name
         self.temp_path = temp_path
         self.torch = torch
+        # Passed on to the Managers of the slots and queued trials
+        self.checkpoint_options = options
+        self.best_precision = options.best_precision
+        self.preempt_save = options.preempt_save
+        self.metadata_url = options.metadata_url
+
+        # Name of the folders in best-models and results, a slot has its own
+        self.name = str(rank) if slot is None else '%d-%d' % (rank, slot)
+        self.folder_path = os.path.join(strings.vm_progress, str(rank))
+        if slot is not None:
+            self.folder_path = os.path.join(self.folder_path, str(slot))
+        if trial is not None:
+            # Workers run trials of the same section at once, so a queued trial only writes to folders of its own
+            self.folder_path = Manager.trial_folder(trial)
+            self.name = os.path.basename(self.folder_path)
+        # Lease of the queued trial, checked before writing to the trial's folder
+        self.lease = None
+
+        self.heartbeat_seconds = heartbeat_seconds
+        # Queued trials write the heartbeat of the worker that runs them
+        self.heartbeat_name = self.name
+        self.last_heartbeat = 0
+        self.epoch = None
+        self.checkpoint_io = options.create_io(bucket_name, temp_path, torch)
+        # Codec of the loaded params, read from the commit marker
+        self.loaded_codec = None
+
+        self.checkpointer = None
+        if options.async_save:
+            self.checkpointer = BackgroundCheckpointer()
+            # Pending checkpoints still reach the cloud when the training script exits
+            atexit.register(self.flush)
 
         if not os.path.isdir(temp_path):
             os.mkdir(temp_path)
 
         self.quick_send = gcp.QuickSend(bucket_name)
 
-        progress_path = os.path.join(strings.vm_progress, str(rank), strings.vm_progress_report)
-        hyparams_path = os.path.join(strings.vm_progress, str(rank), strings.vm_hyparams_report)
+        progress_path = os.path.join(self.folder_path, strings.vm_progress_report)
+        hyparams_path = os.path.join(self.folder_path, strings.vm_hyparams_report)
 
         self.progress = Progress(progress_path=progress_path, bucket_name=bucket_name)
-        self.hyparams = Hyperparameters(hyparams_path=hyparams_path, bucket_name=bucket_name)
+        self.progress_log = None
+        if options.progress_log:
+            self.progress_log = ProgressLog(bucket_name, os.path.dirname(progress_path), options.compress_log)
+        # Finished trials for the tpe methods, cached in temp_path so they are not downloaded every trial
+        history = TrialHistory(bucket_name, os.path.join(temp_path, strings.trials_cache))
+        self.hyparams = Hyperparameters(hyparams_path=hyparams_path, bucket_name=bucket_name, history=history)
+        # Successive halving shared by the cluster, set by the "scheduler" section of the hyperparameters
+        self.scheduler = SuccessiveHalving.from_hyparams(bucket_name, self.hyparams.get_raw_hyparams())
 
         self.load_params = self.hyparams.force_cur_values()
         self.load_best_params = False
         self.count = 0
+        if trial is not None:
+            # Every queued trial has its own Manager, so results are numbered by iteration to keep their names apart
+            self.count = self.hyparams.get_raw_hyparams()[self.hyparams.cur_iter]
+
+        # Local files of the loaded params that can be used with torch.load, None when there are none
+        self.params_pth = None
+        self.best_params_pth = None
 
         # For tracking the model
         self.model = None
         self.best_params = None
+        # Host memory the best params are copied into in place, allocated on the first improvement
+        self.best_buffer = None
+        self.best_pinned = False
+        self.defer_best = options.defer_best
+        self.best_pending = False
+        # Forward pre-hook that copies deferred best params before the next step can change them
+        self.best_hook = None
+        # Counts the improvements so async saves only snapshot the best params when they changed
+        self.best_version = 0
+        self.best_snapshot = None
+        self.best_snapshot_version = None
+        # Progress of the best model of this rank (or slot) in best-models and the generation of its progress.json
+        self.best_model_cache = None
+        # Best params version and generation of the best params in the last checkpoint, committed again by
+        # emergency saves when they did not change
+        self.committed_best = None
+
+        # Keeps an emergency save from running at the same time as another save
+        self.save_lock = threading.Lock()
+        # True once progress was added to the current trial
+        self.has_progress = False
+        # Set after an emergency save, since the VM is about to stop
+        self.stopping = False
 
         if self.load_params:
-            params_path = os.path.join(strings.vm_progress, str(rank), strings.params_file)
-            gcp.download_file(self.bucket_name, params_path, self.temp_path)
-
-            try:
-                params_path = os.path.join(strings.vm_progress, str(rank), strings.best_params_file)
-                gcp.download_file(self.bucket_name, params_path, self.temp_path)
-                self.load_best_params = True
-            except Exception as err:
-                print('No best params in cloud')
+            folder_path = self.folder_path
+            # Only a checkpoint whose commit marker matches every artifact is trusted
+            marker = gcp.read_checkpoint(self.bucket_name, folder_path)
+
+            if marker is None:
+                print('No committed checkpoint in cloud, restarting the current hyperparameters')
+                self.load_params = False
+                self.progress.reset()
+                if self.progress_log is not None:
+                    self.progress_log.clear()
+            else:
+                if self.progress_log is not None:
+                    # Records after the committed offset belong to a checkpoint that was never finished
+                    self.progress = self.progress_log.resume(marker.get("metadata", {}).get("progress_offset"))
+                self.loaded_codec = marker.get("metadata", {}).get("codec")
+                self.params_pth = self.checkpoint_io.download(folder_path, strings.params_file, self.loaded_codec)
+
+                if strings.best_params_file in marker["artifacts"]:
+                    self.best_params_pth = self.checkpoint_io.download(folder_path, strings.best_params_file,
+                                                                      self.loaded_codec)
+                    self.load_best_params = True
+                    self.committed_best = (self.best_version, marker["artifacts"][strings.best_params_file])
+                else:
+                    print('No best params in cloud')
 
     def track_model(self, model):
         '''
@@ -60,13 +167,25 @@ class Manager:
         '''
 
         self.model = model
+        if self.best_hook is not None:
+            self.best_hook.remove()
+            self.best_hook = None
+        if self.defer_best:
+            if hasattr(model, 'register_forward_pre_hook'):
+                # An optimizer step only follows a forward pass, so the params of the best epoch are still there
+                self.best_hook = model.register_forward_pre_hook(lambda module, args: self.copy_pending_best())
+            else:
+                print('Model has no forward hooks, copying the best params on every improvement')
+                self.defer_best = False
+        if self.preempt_save:
+            # The newest Manager of the process (ex: of the current trial) is the one saved
+            preemption.watch(self.emergency_save, self.metadata_url)
 
+        folder_path = self.folder_path
         if self.load_params:
-            path = os.path.join(self.temp_path, strings.params_file)
-            self.model.load_state_dict(self.torch.load(path))
+            self.model.load_state_dict(self.checkpoint_io.load(folder_path, strings.params_file, self.loaded_codec))
         if self.load_best_params:
-            path = os.path.join(self.temp_path, strings.best_params_file)
-            self.best_params = self.torch.load(path)
+            self.best_params = self.checkpoint_io.load(folder_path, strings.best_params_file, self.loaded_codec)
 
     def start_epoch(self):
         return self.progress.start_epoch()
@@ -82,33 +201,149 @@ class Manager:
 
     def add_progress(self, key, value):
         improved = self.progress.add(key, value)
+        self.has_progress = True
+        if key == "epochs":
+            self.epoch = value
+        self.heartbeat()
+        if self.progress_log is not None:
+            self.progress_log.add(key, value)
         if improved and self.model is not None:
-            self.best_params = copy.deepcopy(self.model.state_dict())
+            if self.defer_best:
+                self.best_pending = True
+            else:
+                self.copy_best(self.model.state_dict())
+
+    def copy_best(self, param_dict):
+        '''
+        Copies the params into the best params buffer in place, so no memory is allocated after the first call.
+        The buffer is pinned when the params are on the GPU so the copy does not block training.
+
+        :param param_dict: Generated by model.state_dict()
+        '''
+        buffer = self.best_buffer
+        if buffer is None or list(buffer.keys()) != list(param_dict.keys()):
+            buffer = copy.copy(param_dict)
+            self.best_pinned = False
+            for key, value in param_dict.items():
+                if self.torch.is_tensor(value):
+                    buffer[key] = self.torch.empty_like(value, device='cpu')
+                    if value.is_cuda:
+                        buffer[key] = buffer[key].pin_memory()
+                        self.best_pinned = True
+            self.best_buffer = buffer
+
+        for key, value in param_dict.items():
+            if self.torch.is_tensor(value):
+                buffer[key].copy_(value.detach(), non_blocking=self.best_pinned)
+            else:
+                buffer[key] = copy.deepcopy(value)
+
+        self.best_params = buffer
+        self.best_version += 1
+
+    def copy_pending_best(self):
+        '''
+        Copies the best params deferred by add_progress, called before the next forward pass of the model
+        '''
+        if self.best_pending and self.model is not None:
+            self.copy_best(self.model.state_dict())
+        self.best_pending = False
+
+    def sync_best(self):
+        '''
+        Copies deferred best params and waits for pending copies to the best params buffer
+        '''
+        self.copy_pending_best()
+        if self.best_pinned:
+            self.torch.cuda.synchronize()
+
+    def should_stop(self, epochs):
+        '''
+        Compares the trial against the rest of the cluster when it reaches a rung of the scheduler.
+        Call this after the progress of an epoch is added, and call finished when it returns True.
+        The epochs the trial does not use are saved up to run extra trials.
+
+        :param epochs: Number of epochs the trial has completed
+        :return: True if the trial should stop
+        '''
+        if self.scheduler is None:
+            return False
+
+        trial_id = '%s-%d' % (self.name, self.get_cur_max_iter()[0])
+        stop = self.scheduler.should_stop(trial_id, self.hyparams.sample_index(), epochs, self.progress)
+        # Queued trials have no iterations of their own, the worker takes the next trial right away instead
+        saved = self.scheduler.max_epochs - epochs
+        if stop and self.trial is None and self.hyparams.add_saved_epochs(saved, self.scheduler.max_epochs):
+            print('Saved enough epochs for an extra trial')
+        return stop
 
     def finished(self, param_dict=None):
         '''
         :param param_dict: This can be the current params or the best params for the model.
         '''
-        if param_dict is None:
-            if self.best_params is not None:
-                param_dict = self.best_params
-            elif self.model is not None:
-                param_dict = self.model.state_dict()
-            else:
-                raise ValueError
+        self.check_lease()
+        with self.save_lock:
+            self.sync_best()
+            if param_dict is None:
+                if self.best_params is not None:
+                    param_dict = self.best_params
+                elif self.model is not None:
+                    param_dict = self.model.state_dict()
+                else:
+                    raise ValueError
+
+            # A checkpoint still uploading must not land after the cloud progress is reset
+            self.flush()
+            self.save_results()
+            self.save_best(param_dict)
+            self.reset()
+            self.reset_cloud_progress()
+            if self.best_hook is not None:
+                # The model may be tracked again by the Manager of the next trial
+                self.best_hook.remove()
+                self.best_hook = None
+
+    def heartbeat(self, force=False, done=False):
+        '''
+        Writes heartbeats/<name>.json with the current iteration and epoch, so the supervisor (clouDL --supervise)
+        can tell this VM is still alive. Only writes once every heartbeat_seconds unless forced.
+
+        :param done: True once every trial of this VM is done, so the supervisor stops watching it
+        '''
+        now = time.time()
+        if self.heartbeat_seconds is None or (not force and now - self.last_heartbeat < self.heartbeat_seconds):
+            return
+        self.last_heartbeat = now
+
+        msg = {
+            "iteration": self.get_cur_max_iter()[0],
+            "epoch": self.epoch,
+            "trial": self.trial,
+            "done": done,
+            "time": now
+        }
+        try:
+            self.quick_send.send(self.heartbeat_name + '.json', json.dumps(msg), strings.heartbeats)
+        except Exception as err:
+            # Missing a heartbeat is fine as long as the next one gets through
+            print('Could not write the heartbeat: %s' % err)
 
-        self.save_results()
-        self.save_best(param_dict)
-        self.reset()
-        self.reset_cloud_progress()
+    def check_lease(self):
+        '''
+        Stops a queued trial whose lease was taken over by another worker by raising LeaseLost
+        '''
+        if self.lease is not None:
+            self.lease.check()
 
     def reset_cloud_progress(self):
         '''
         Resets the cloud folder keeping track of progress by deleting the params and removing current hyperparameter
         values
         '''
-        cloud_folder_path = os.path.join(strings.vm_progress, str(self.rank))
-        gcp.delete_all_prefixes(self.bucket_name, cloud_folder_path)
+        cloud_folder_path = self.folder_path
+        # The trailing slash keeps vm-progress/1 from matching vm-progress/10
+        gcp.delete_all_prefixes(self.bucket_name, cloud_folder_path + '/')
+        self.committed_best = None
 
         hyparams_copy = copy.deepcopy(self.hyparams.raw_hyparams)
         hyparams_copy.pop("current_values", None)
@@ -116,10 +351,38 @@ class Manager:
         self.quick_send.send(strings.vm_hyparams_report, json.dumps(hyparams_copy), cloud_folder_path)
 
     def reset(self):
+        # Only the first trial resumes from the loaded checkpoint, reset_cloud_progress deletes it afterwards
+        self.load_params = False
+        self.load_best_params = False
+        self.params_pth = None
+        self.best_params_pth = None
+        self.has_progress = False
         self.progress.reset()
         self.hyparams.reset()
+        if self.progress_log is not None:
+            self.progress_log.reset()
 
     def save_progress(self, param_dict=None, best_param_dict=None):
+        '''
+        Saves a checkpoint of the progress, hyperparameters, params, and best params.
+        With async_save, the state is copied to host memory here and uploaded on a background thread.
+        '''
+        self.check_lease()
+        self.heartbeat()
+        with self.save_lock:
+            if self.stopping:
+                print('Not saving since the VM is stopping')
+                return
+            self.checkpoint(param_dict, best_param_dict)
+
+    def checkpoint(self, param_dict=None, best_param_dict=None, reuse_best=False):
+        '''
+        Body of save_progress, called with save_lock held.
+
+        :param reuse_best: Commit the best params of the last checkpoint again instead of uploading them
+            when they did not change since
+        '''
+        self.sync_best()
         if param_dict is None and self.model is not None:
             param_dict = self.model.state_dict()
         if best_param_dict is None and self.best_params is not None:
@@ -128,12 +391,129 @@ class Manager:
         if param_dict is None:
             raise ValueError
 
-        folder_path = strings.vm_progress + ("/%d" % self.rank)
-        self.progress.save_progress(self.quick_send, folder_path)
-        self.hyparams.save_hyparams(self.quick_send, folder_path)
-        self.save_params(param_dict, folder_path)
-        if best_param_dict:
-            self.save_params(best_param_dict, folder_path, strings.best_params_file)
+        folder_path = self.folder_path
+
+        # Only the tracked best params have a version to tell whether they changed
+        best_version = self.best_version if best_param_dict and best_param_dict is self.best_params else None
+        best_generation = None
+        if reuse_best and best_version is not None and self.committed_best is not None \
+                and self.committed_best[0] == best_version:
+            best_generation = self.committed_best[1]
+
+        if self.checkpointer is not None:
+            param_dict = self.snapshot(param_dict)
+            if best_generation is not None:
+                # Committed again without being uploaded, so there is nothing to copy
+                best_param_dict = None
+            elif best_param_dict and best_param_dict is self.best_buffer:
+                # The buffer is updated in place, so it is only copied again when the best params changed
+                if self.best_snapshot_version != self.best_version:
+                    self.best_snapshot = self.snapshot(best_param_dict)
+                    self.best_snapshot_version = self.best_version
+                best_param_dict = self.best_snapshot
+            elif best_param_dict and best_param_dict is not self.best_params:
+                # Loaded best params are never updated in place, so only params passed in are copied
+                best_param_dict = self.snapshot(best_param_dict)
+
+        save = self.checkpoint_saver(folder_path, param_dict, best_param_dict, log_progress=True,
+                                     best_version=best_version, best_generation=best_generation)
+        if self.checkpointer is None:
+            save()
+        else:
+            self.checkpointer.submit(save)
+
+    def emergency_save(self):
+        '''
+        Saves a checkpoint of the tracked model and progress as fast as possible because the VM is about to stop.
+        Called by the preemption watcher with preempt_save. The best params are only uploaded when they changed
+        since the last checkpoint, and no checkpoint is saved after this one.
+        '''
+        with self.save_lock:
+            try:
+                if self.model is None or not self.has_progress:
+                    print('No tracked model or progress to save')
+                else:
+                    self.check_lease()
+                    self.checkpoint(reuse_best=True)
+                    self.flush()
+            finally:
+                self.stopping = True
+
+    def checkpoint_saver(self, folder_path, param_dict, best_param_dict=None, precision=None, log_progress=False,
+                         best_version=None, best_generation=None):
+        '''
+        Creates a function that uploads one checkpoint. The artifacts are uploaded concurrently and
+        the commit marker is written last, along with the codec and precision of the params.
+        Progress and hyperparameters are serialized here so later changes do not leak into the checkpoint.
+
+        :param folder_path: Cloud folder of the checkpoint
+        :param param_dict: Params to save
+        :param best_param_dict: Best params to save, skipped when None
+        :param precision: Precision to store the params in, keeps their precision when None
+        :param log_progress: Append the new progress to the progress log instead of uploading all of it,
+            when the Manager keeps a progress log
+        :param best_version: Version of the best params, remembered with their generation once committed
+        :param best_generation: Generation of the best params already in folder_path to commit again instead of
+            uploading best_param_dict
+        :return: Function without arguments
+        '''
+        hyparams_msg = json.dumps(self.hyparams.get_raw_hyparams())
+
+        uploads = {
+            strings.vm_hyparams_report: lambda: self.quick_send.send(strings.vm_hyparams_report, hyparams_msg,
+                                                                     folder_path),
+            strings.params_file: lambda: self.save_params(param_dict, folder_path, precision=precision)
+        }
+        if best_generation is not None:
+            uploads[strings.best_params_file] = lambda: best_generation
+        elif best_param_dict:
+            uploads[strings.best_params_file] = lambda: self.save_params(best_param_dict, folder_path,
+                                                                         strings.best_params_file, precision)
+        metadata = {
+            "codec": self.checkpoint_io.codec,
+            "precision": precision
+        }
+
+        commit = None
+        if log_progress and self.progress_log is not None:
+            log_uploads, metadata["progress_offset"], commit = self.progress_log.prepare(self.progress)
+            uploads.update(log_uploads)
+        else:
+            progress_msg = json.dumps(self.progress.get_progress())
+            uploads[strings.vm_progress_report] = lambda: self.quick_send.send(strings.vm_progress_report,
+                                                                               progress_msg, folder_path)
+
+        def save():
+            marker = gcp.upload_checkpoint(self.bucket_name, folder_path, uploads, metadata=metadata)
+            if commit is not None:
+                commit()
+            if best_version is not None and strings.best_params_file in uploads:
+                self.committed_best = (best_version, marker["artifacts"][strings.best_params_file])
+            return marker
+
+        return save
+
+    def snapshot(self, param_dict):
+        '''
+        Copies a state dict into host memory so training can keep updating the original.
+
+        :param param_dict: Generated by model.state_dict()
+        :return: Copy of param_dict with every tensor on the cpu
+        '''
+        snapshot = copy.copy(param_dict)
+        for key, value in snapshot.items():
+            if self.torch.is_tensor(value):
+                snapshot[key] = value.detach().to('cpu', copy=True)
+            else:
+                snapshot[key] = copy.deepcopy(value)
+        return snapshot
+
+    def flush(self):
+        '''
+        Blocks until every background checkpoint is uploaded. Does nothing without async_save.
+        '''
+        if self.checkpointer is not None:
+            self.checkpointer.flush()
 
     def save_results(self):
         progress_report = self.progress.get_progress()
@@ -150,59 +530,111 @@ class Manager:
         }
         msg = json.dumps(result)
 
-        self.quick_send.send(filename, msg, strings.results + ("/%d" % self.rank))
+        self.quick_send.send(filename, msg, strings.results + "/" + self.name)
         self.count += 1
 
     def save_best(self, param_dict):
         if self.isBest(self.progress):
-            folder_path = strings.best_model + ("/%d" % self.rank)
-            self.progress.save_progress(self.quick_send, folder_path)
-            self.hyparams.save_hyparams(self.quick_send, folder_path)
-            self.save_params(param_dict, folder_path)
+            folder_path = strings.best_model + "/" + self.name
+            marker = self.checkpoint_saver(folder_path, param_dict, precision=self.best_precision)()
+            # The copy outlives the reset of self.progress in finished
+            best_progress = Progress(progress=self.progress.get_progress())
+            self.best_model_cache = (best_progress, marker["artifacts"][strings.vm_progress_report])
             return True
         return False
 
     def isBest(self, cur_report):
-        progress_path = os.path.join(strings.best_model, str(self.rank), strings.vm_progress_report)
+        '''
+        Compares against the best model of this rank (or slot), which is cached from when it was last read or written.
+        Beating the cached best needs no round trip. Otherwise the cached best is only trusted when
+        the generation of its progress.json did not change (ex: it was archived), and is downloaded again if it did.
+        '''
+        progress_path = os.path.join(strings.best_model, self.name, strings.vm_progress_report)
+        cur_best = cur_report.get_best()
+
+        if self.best_model_cache is not None and self.best_model_cache[0].worse(cur_best):
+            return True
 
         try:
-            best_progress_json = gcp.stream_download_json(self.bucket_name, progress_path)
-            best_progress = Progress(progress=best_progress_json)
+            blob = gcp.stat_blob(self.bucket_name, progress_path)
+            if blob is None:
+                # No best model of this rank (or slot) yet
+                self.best_model_cache = None
+                return True
+            if self.best_model_cache is None or self.best_model_cache[1] != blob.generation:
+                best_progress_json = gcp.stream_download_json(self.bucket_name, progress_path)
+                self.best_model_cache = (Progress(progress=best_progress_json), blob.generation)
         except Exception as err:
+            self.best_model_cache = None
             return True
 
-        return best_progress.worse(cur_report.get_best())
+        return self.best_model_cache[0].worse(cur_best)
 
-    def save_params(self, param_dict, cloud_folder, filename=strings.params_file):
+    def save_params(self, param_dict, cloud_folder, filename=strings.params_file, precision=None):
         '''
         Saving the parameters for a model to a folder determined by whether or not the training is done.
 
         :param param_dict: Generated by model.state_dict()
+        :param precision: Store floating point tensors as fp16 or bf16, keeps their precision when None
+        :return: Generation of the uploaded params
         '''
-        local_path = os.path.join(self.temp_path, filename)
-        self.torch.save(param_dict, local_path)
-        gcp.upload_file(self.bucket_name, local_path, cloud_folder)
+        return self.checkpoint_io.save(param_dict, cloud_folder, filename, precision)
 
     def get_cur_max_iter(self):
         cur_iter = self.hyparams.get_raw_hyparams()[self.hyparams.cur_iter]
-        max_iter = self.hyparams.get_raw_hyparams()["max_iter"]
+        max_iter = self.hyparams.get_max_iter()
         return cur_iter, max_iter
 
+    @staticmethod
+    def trial_folder(trial_id):
+        return os.path.join(strings.vm_progress, 'trial-' + trial_id)
+
     @staticmethod
     def get_meta_data():
+        import requests
+
         root_url = 'http://metadata/computeMetadata/v1/instance/attributes/'
         rank_url = os.path.join(root_url, 'rank')
         bucket_url = os.path.join(root_url, 'bucket')
+        name_url = 'http://metadata/computeMetadata/v1/instance/name'
 
         rank_request = requests.get(rank_url, headers={'Metadata-Flavor': 'Google'})
         bucket_request = requests.get(bucket_url, headers={'Metadata-Flavor': 'Google'})
-        rank = int(rank_request.text)
+        if rank_request.status_code == 200:
+            rank = int(rank_request.text)
+        else:
+            # VMs from an instance template share their metadata, their rank ends their name (ex: vm-12)
+            name_request = requests.get(name_url, headers={'Metadata-Flavor': 'Google'})
+            rank = int(name_request.text.rsplit('-', 1)[1])
         bucket_name = bucket_request.text
 
         return rank, bucket_name
 
     @staticmethod
-    def create_manager(torch, tmppath='./tmp', rank=None, bucket_name=None):
+    def create_manager(torch, tmppath='./tmp', rank=None, bucket_name=None, storage=None, localpth=None,
+                       async_save=False, stream=False, delta=False, shard_size=None, codec='none',
+                       best_precision=None, defer_best=False, progress_log=False, compress_log=False,
+                       preempt_save=False, metadata_url=None, heartbeat_seconds=60):
+        '''
+        Creates a Manager, reading the rank and bucket name from the VM meta data when they are not given.
+
+        :param storage: Storage backend to use, either "gcs" or "local". Leaves the current backend when None
+        :param localpth: The folder holding the buckets when using local storage
+        :param async_save: Upload checkpoints from save_progress on a background thread
+        :param stream: Stream params straight to and from the cloud without files in tmppath
+        :param delta: Only upload the tensors that changed since an earlier save
+        :param shard_size: Split params into shards of about shard_size bytes
+        :param codec: Compress params with this codec (none, zlib, lzma, or zstd)
+        :param best_precision: Store the best params as fp16 or bf16 in best-models
+        :param defer_best: Copy the best params right before the next forward pass instead of in add_progress
+        :param progress_log: Only upload the progress added since the last save
+        :param compress_log: Gzip the progress log
+        :param preempt_save: Save an emergency checkpoint when the VM is preempted or the process gets SIGTERM
+        :param metadata_url: Url polled for the preemption (ex: of a fake metadata server when testing)
+        :param heartbeat_seconds: Write a heartbeat for clouDL --supervise at most this often, None to never write one
+        '''
+        if storage is not None:
+            gcp.set_storage(storage, localpth)
         if rank is None or bucket_name is None:
             try:
                 meta_rank, meta_bucket_name = Manager.get_meta_data()
@@ -211,39 +643,207 @@ class Manager:
             except Exception as err:
                 print('Could not get meta data')
                 raise ValueError
-        return Manager(tmppath, bucket_name, rank, torch)
+        checkpoint_options = CheckpointOptions(async_save, stream, delta, shard_size, codec, best_precision, defer_best,
+                                               progress_log, compress_log, preempt_save, metadata_url)
+        return Manager(tmppath, bucket_name, rank, torch, checkpoint_options, heartbeat_seconds=heartbeat_seconds)
 
-    def hyparam_search(self, run):
-        start, end = self.get_cur_max_iter()
-        quick_send = self.quick_send
-        rank = self.rank
-        temp_path = self.temp_path
+    def hyparam_search(self, run, parallel=None, queue=None):
+        '''
+        Runs trials until every hyperparameter iteration of this rank is done, or every trial in the queue is done.
+
+        :param run: Called as run(manager, param_pth, best_param_pth) for every trial
+        :param parallel: Number of trials to run at once in separate processes, see parallel_search
+        :param queue: Take trials from the trial queue of the bucket (filled by clouDL --queue) instead of running
+            the iterations of this rank, see queue_search. Uses the queue whenever the bucket has one when None
+        '''
+        if queue is None:
+            queue = TrialQueue.exists(self.bucket_name)
+        self.heartbeat(force=True)
+
+        if parallel is not None and parallel > 1:
+            self.parallel_search(run, parallel, queue)
+        elif queue:
+            self.queue_search(run)
+        else:
+            start, _ = self.get_cur_max_iter()
+            step = self.hyparams.get_iter_step()
+
+            # The end moves when the scheduler saves enough epochs for an extra trial
+            while start < self.get_cur_max_iter()[1]:
+                self.run_trial(run)
+                start += step
+
+        self.heartbeat(force=True, done=True)
+
+    def run_trial(self, run):
+        '''
+        Runs the current hyperparameters once. Errors are written to the shared errors folder and the cloud
+        progress is reset so the next hyperparameters start fresh.
+
+        :param run: Same as in hyparam_search
+        :return: False if the lease of a queued trial was lost to another worker, True otherwise
+        '''
+        start, _ = self.get_cur_max_iter()
+        try:
+            # There are no local files when streaming or sharding, use track_model to load params instead
+            param_pth = self.params_pth if self.load_params else None
+            best_param_pth = self.best_params_pth if self.load_best_params else None
+            run(self, param_pth, best_param_pth)
+            print("Trying new hyperparameters")
+        except LeaseLost:
+            # The checkpoint now belongs to the worker that took over
+            print("Another worker took over trial %s" % self.trial)
+            return False
+        except Exception as err:
+            timestr = time.strftime("%m%d%Y-%H%M%S")
+            readable_timestr = time.strftime("%m/%d/%Y-%H:%M:%S")
+            filename = timestr + ("-vm%d" % self.rank) + "-iter" + str(start) + ".json"
+            msg = {
+                "traceback": traceback.format_exc(),
+                "error": str(err),
+                "hyperparameters": self.get_hyparams(),
+                "progress": self.get_progress(),
+                "time": readable_timestr
+            }
+            msg = json.dumps(msg)
+            print("Writing the following msg to shared errors folder in Google cloud")
+            print(msg)
+            self.quick_send.send(filename, msg, strings.shared_errors)
 
-        while start < end:
             try:
-                param_pth = os.path.join(temp_path, strings.params_file) if self.load_params else None
-                best_param_pth = os.path.join(temp_path, strings.best_params_file) if self.load_best_params else None
-                run(self, param_pth, best_param_pth)
-                print("Trying new hyperparameters")
-            except Exception as err:
-                timestr = time.strftime("%m%d%Y-%H%M%S")
-                readable_timestr = time.strftime("%m/%d/%Y-%H:%M:%S")
-                filename = timestr + ("-vm%d" % rank) + "-iter" + str(start) + ".json"
-                msg = {
-                    "traceback": traceback.format_exc(),
-                    "error": str(err),
-                    "hyperparameters": self.get_hyparams(),
-                    "progress": self.get_progress(),
-                    "time": readable_timestr
-                }
-                msg = json.dumps(msg)
-                print("Writing the following msg to shared errors folder in Google cloud")
-                print(msg)
-                quick_send.send(filename, msg, strings.shared_errors)
-
-                self.reset()
-                self.reset_cloud_progress()
-            start += 1
+                self.flush()
+            except Exception:
+                print('Dropping the failed background checkpoint')
+            self.reset()
+            self.reset_cloud_progress()
+        return True
+
+    def queue_search(self, run, temp_path=None):
+        '''
+        Takes trials from the trial queue of the bucket until every trial is done, so a fast worker is never idle
+        while a slow one still has iterations left. Each trial runs with its own Manager that keeps its checkpoints
+        in vm-progress/trial-<id>, and its lease is renewed in the background while it trains. When a worker stops
+        renewing (ex: it was preempted), the lease expires and the next free worker resumes the trial.
+        Best models and results are kept per trial in best-models/trial-<id> and results/trial-<id>, so workers
+        running trials of the same hyperparameter section (rank) never write to the same folders.
+
+        :param run: Same as in hyparam_search
+        :param temp_path: Local folder of the trials, defaults to the temp_path of this Manager
+        '''
+        temp_path = temp_path or self.temp_path
+        os.makedirs(temp_path, exist_ok=True)
+        queue = TrialQueue(self.bucket_name)
+
+        while True:
+            lease = queue.next()
+            if lease is None:
+                print("Every trial in the queue is done")
+                return
+
+            folder_path = Manager.trial_folder(lease.trial_id)
+            hyparams_path = os.path.join(folder_path, strings.vm_hyparams_report)
+            if gcp.stat_blob(self.bucket_name, hyparams_path) is None:
+                gcp.stream_upload_str(self.bucket_name, json.dumps(lease.hyparams), hyparams_path)
+
+            print("Starting trial %s" % lease.trial_id)
+            trial_path = os.path.join(temp_path, 'trial-' + lease.trial_id)
+            lease.start()
+            try:
+                trial_manager = Manager(trial_path, self.bucket_name, lease.hyparams.get("rank", self.rank),
+                                        self.torch, self.checkpoint_options, trial=lease.trial_id,
+                                        heartbeat_seconds=self.heartbeat_seconds)
+                trial_manager.lease = lease
+                trial_manager.heartbeat_name = self.heartbeat_name
+                trial_manager.last_heartbeat = self.last_heartbeat
+                done = trial_manager.run_trial(run)
+            finally:
+                lease.stop()
+
+            if done:
+                lease.complete()
+                gcp.delete_all_prefixes(self.bucket_name, folder_path + '/')
+            shutil.rmtree(trial_path, ignore_errors=True)
+
+    def parallel_search(self, run, parallel, queue=False):
+        '''
+        Runs parallel trials at once, each in its own forked process with its own Manager, pinned to its share of
+        the CPUs. Slot k keeps its progress, hyperparameters, and checkpoints in vm-progress/<rank>/<k> and tries
+        iterations k, k + parallel, ... of this rank, so a restarted VM resumes every slot where it stopped.
+        Its best model and results go to best-models/<rank>-<k> and results/<rank>-<k>.
+
+        :param run: Called as run(manager, param_pth, best_param_pth) in the slot processes
+        :param parallel: Number of slots, which has to stay the same when resuming
+        :param queue: Every slot takes trials from the trial queue instead, so the slots have no iterations to split
+        '''
+        if not queue:
+            self.split_slots(parallel)
+
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        # Fork so run does not need to be picklable and the training script is not imported again.
+        # This Manager tracks no model, so its checkpoint and preemption threads have not started yet,
+        # and each slot builds its own Manager (with its own threads) after the fork
+        self.flush()
+        context = multiprocessing.get_context('fork')
+        processes = []
+        for slot in range(parallel):
+            slot_cpus = cpus[slot::parallel] if len(cpus) >= parallel else cpus
+            process = context.Process(target=run_slot, args=(self, slot, slot_cpus, run, queue))
+            process.start()
+            processes.append(process)
+
+        for slot, process in enumerate(processes):
+            process.join()
+            if process.exitcode != 0:
+                print('Slot %d exited with code %s' % (slot, process.exitcode))
+
+    def split_slots(self, parallel):
+        '''
+        Writes the hyperparameters of every slot that does not have them yet, or checks the ones of a resumed slot
+        '''
+        start, end = self.get_cur_max_iter()
+        for slot in range(parallel):
+            hyparams_path = os.path.join(self.folder_path, str(slot), strings.vm_hyparams_report)
+            if gcp.stat_blob(self.bucket_name, hyparams_path) is None:
+                slot_hyparams = copy.deepcopy(self.hyparams.get_raw_hyparams())
+                slot_hyparams.pop(self.hyparams.cur_val, None)
+                slot_hyparams[self.hyparams.cur_iter] = start + slot
+                slot_hyparams[self.hyparams.iter_step] = parallel
+                gcp.stream_upload_str(self.bucket_name, json.dumps(slot_hyparams), hyparams_path)
+                continue
+
+            # Resuming, the slot keeps its own iterations
+            slot_hyparams = gcp.stream_download_json(self.bucket_name, hyparams_path)
+            if slot_hyparams.get(self.hyparams.iter_step) != parallel:
+                raise ValueError("Slots in %s were started with a different parallel" % self.folder_path)
+
+
+def run_slot(manager, slot, cpus, run, queue=False):
+    '''
+    Entry point of a slot process started by Manager.parallel_search
+
+    :param manager: Manager of the rank
+    :param slot: Slot number
+    :param cpus: CPUs the slot is pinned to
+    :param run: Same as in Manager.hyparam_search
+    :param queue: Take trials from the trial queue
+    '''
+    gcp.after_fork()
+    preemption.after_fork()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    # Without this every slot would start one thread per core and fight over the CPUs
+    manager.torch.set_num_threads(len(cpus))
+
+    temp_path = os.path.join(manager.temp_path, str(slot))
+    if queue:
+        manager.heartbeat_name = '%s-%d' % (manager.name, slot)
+        manager.queue_search(run, temp_path)
+        return
+    slot_manager = Manager(temp_path, manager.bucket_name, manager.rank, manager.torch, manager.checkpoint_options,
+                           slot=slot, heartbeat_seconds=manager.heartbeat_seconds)
+    slot_manager.hyparam_search(run, queue=False)
+    # Forked processes exit without running atexit
+    slot_manager.flush()
 
 
 class TestManager:
@@ -271,13 +871,19 @@ class TestManager:
     def add_progress(self, key, value):
         print('Adding progress')
 
+    def should_stop(self, epochs):
+        return False
+
     def finished(self, param_dict=None):
         print('Finishing')
 
     def save_progress(self, param_dict=None, best_param_dict=None):
         print('Saving progress')
 
-    def hyparam_search(self, run):
+    def flush(self):
+        print('Flushing checkpoints')
+
+    def hyparam_search(self, run, parallel=None, queue=None):
         run(self)
 
     @staticmethod
@@ -8,15 +8,24 @@ from clouDL_utils import strings
 
 
 class Archive:
-    def __init__(self, bucket_name, top_n):
+    def __init__(self, bucket_name, top_n, dry_run=False):
+        '''
+        :param dry_run: Only report what clearing for new hyperparameters would delete, without archiving
+        '''
         self.bucket_name = bucket_name
         self.top_n = top_n
+        self.dry_run = dry_run
 
     def clear_for_new_hyparams(self):
-        gcp.delete_all_prefixes(self.bucket_name, strings.vm_progress)
-        gcp.delete_all_prefixes(self.bucket_name, strings.best_model)
-        gcp.delete_all_prefixes(self.bucket_name, strings.results)
-        gcp.delete_all_prefixes(self.bucket_name, strings.shared_errors)
+        prefixes = [strings.vm_progress, strings.best_model, strings.results, strings.shared_errors,
+                    # Rung scores only compare trials of the same search
+                    strings.rungs + '/', strings.queue + '/',
+                    # Done heartbeats of the last search would keep the supervisor from watching the next one
+                    strings.heartbeats + '/']
+        for prefix in prefixes:
+            stats = gcp.delete_all_prefixes(self.bucket_name, prefix, self.dry_run)
+            if self.dry_run:
+                print('%s: %s' % (prefix, stats))
 
     def archive_results(self):
         folder_names = gcp.get_folder_names(self.bucket_name, strings.results)
@@ -112,6 +121,12 @@ class Archive:
         gcp.stream_upload_str(self.bucket_name, json.dumps(meta_progress.get_progress()), meta_path)
 
     def archive(self):
+        if self.dry_run:
+            self.clear_for_new_hyparams()
+            return
+
+        # Finishing any move an earlier archive left halfway
+        gcp.resume_moves(self.bucket_name)
         self.archive_results()
         result = self.archive_best_model(self.top_n)
         if result is not None:
@@ -0,0 +1,436 @@
+from datetime import datetime, timezone
+import threading
+import tempfile
+import shutil
+import time
+import os
+
+
+class PreconditionFailed(Exception):
+    '''
+    Raised when a conditional write or delete finds a different generation than the one it expected
+    '''
+
+
+def not_found_error():
+    # Imported on use since the cloud libraries are slow to import
+    from google.api_core.exceptions import NotFound
+    return NotFound
+
+
+def precondition_failed_error():
+    from google.api_core.exceptions import PreconditionFailed as GooglePreconditionFailed
+    return GooglePreconditionFailed
+
+
+class GCSBackend:
+    '''
+    Storage backend that talks to Google Cloud Storage.
+    Blob names are full paths inside the bucket (ex: vm-progress/0/progress.json).
+    The client needs credentials, so it is only created (and cached) on first use.
+    Raises FileNotFoundError when a blob does not exist, just like LocalBackend.
+    '''
+
+    def __init__(self, pool_size=None):
+        self._client = None
+        self.pool_size = pool_size
+        # Threads of a transfer pool all ask for the client on first use, only one of them builds it
+        self.client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.client_lock:
+                if self._client is None:
+                    # Cloud storage client library
+                    from google.cloud import storage
+
+                    client = storage.Client()
+                    if self.pool_size:
+                        self._mount_pool(client, self.pool_size)
+                    # Only shared once it is ready
+                    self._client = client
+        return self._client
+
+    def reset_client(self):
+        self._client = None
+        # The lock may have been held by a thread that does not exist after a fork
+        self.client_lock = threading.Lock()
+
+    def set_pool_size(self, pool_size):
+        '''
+        Sizes the HTTP connection pool shared by every thread using this backend.
+        requests defaults to 10 connections per host, so larger thread pools would otherwise keep reconnecting.
+        '''
+        self.pool_size = pool_size
+        if self._client is not None:
+            self._mount_pool(self._client, pool_size)
+
+    @staticmethod
+    def _mount_pool(client, pool_size):
+        import requests
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        client._http.mount('https://', adapter)
+
+    def bucket(self, bucket_name):
+        return self.client.bucket(bucket_name)
+
+    def list_blobs(self, bucket_name, prefix):
+        '''
+        Lists every blob that starts with prefix in lexicographical order.
+        Each returned object has a name, size, generation, and updated (datetime) attribute.
+        '''
+        return self.bucket(bucket_name).list_blobs(prefix=prefix)
+
+    def list_prefixes(self, bucket_name, prefix, page_size=1000):
+        '''
+        Lists only the immediate sub-prefixes of prefix (ex: best-models/0/ for prefix best-models/).
+        The server groups the blobs by the delimiter, so the cost depends on the number of folders, not blobs.
+        '''
+        iterator = self.client.list_blobs(bucket_name, prefix=prefix, delimiter='/', page_size=page_size)
+        prefixes = set()
+        for page in iterator.pages:
+            prefixes.update(page.prefixes)
+        return prefixes
+
+    def stat(self, bucket_name, name):
+        '''
+        Gets the metadata (name, size, generation) of a blob.
+        Raises FileNotFoundError when the blob does not exist.
+        '''
+        blob = self.bucket(bucket_name).get_blob(name)
+        if blob is None:
+            raise FileNotFoundError(name)
+        return blob
+
+    def upload_file(self, bucket_name, src, dest):
+        '''
+        Uploads a local file and returns the generation of the new blob.
+        '''
+        blob = self.bucket(bucket_name).blob(dest)
+        blob.upload_from_filename(src)
+        return blob.generation
+
+    def download_file(self, bucket_name, src, dest):
+        try:
+            self.bucket(bucket_name).blob(src).download_to_filename(dest)
+        except not_found_error() as err:
+            raise FileNotFoundError(src) from err
+
+    def upload_stream(self, bucket_name, dest, write, chunk_size):
+        '''
+        Uploads whatever write(f) writes into f through a resumable upload.
+        Only chunk_size bytes (a multiple of 256 KB) are buffered in memory at a time.
+
+        :return: Generation of the new blob
+        '''
+        blob = self.bucket(bucket_name).blob(dest)
+        with blob.open('wb', chunk_size=chunk_size) as f:
+            write(f)
+        # The writer does not report the metadata of the finished upload
+        blob.reload()
+        return blob.generation
+
+    def open_read(self, bucket_name, src, chunk_size):
+        '''
+        Opens a blob as a seekable file that downloads chunk_size bytes at a time.
+        '''
+        blob = self.bucket(bucket_name).blob(src)
+        try:
+            # The reader only downloads on the first read, so a missing blob is found here instead.
+            # The size it gets also saves the reader a request when seeking from the end
+            blob.reload()
+        except not_found_error() as err:
+            raise FileNotFoundError(src) from err
+        return blob.open('rb', chunk_size=chunk_size)
+
+    def upload_str(self, bucket_name, src, dest, if_generation_match=None):
+        '''
+        Uploads a string or bytes and returns the generation of the new blob.
+        With if_generation_match, the upload only happens if the blob still has that generation (0 when the blob
+        must not exist yet), otherwise PreconditionFailed is raised.
+        '''
+        blob = self.bucket(bucket_name).blob(dest)
+        if if_generation_match is None:
+            blob.upload_from_string(src)
+            return blob.generation
+        try:
+            blob.upload_from_string(src, if_generation_match=if_generation_match)
+        except precondition_failed_error() as err:
+            raise PreconditionFailed(dest) from err
+        return blob.generation
+
+    def download_str(self, bucket_name, src):
+        try:
+            return self.bucket(bucket_name).blob(src).download_as_string()
+        except not_found_error() as err:
+            raise FileNotFoundError(src) from err
+
+    def rename(self, bucket_name, src, dest):
+        bucket = self.bucket(bucket_name)
+        try:
+            bucket.rename_blob(bucket.blob(src), dest)
+        except not_found_error() as err:
+            raise FileNotFoundError(src) from err
+
+    def copy(self, bucket_name, src, dest):
+        '''
+        Copies a blob server side. Large objects (ex: params.pt) are rewritten over several calls,
+        each call returning a token to continue from, so no single request has to copy the whole object.
+        '''
+        bucket = self.bucket(bucket_name)
+        src_blob = bucket.blob(src)
+        dest_blob = bucket.blob(dest)
+        try:
+            token, _, _ = dest_blob.rewrite(src_blob)
+            while token is not None:
+                token, _, _ = dest_blob.rewrite(src_blob, token=token)
+        except not_found_error() as err:
+            raise FileNotFoundError(src) from err
+
+    def delete(self, bucket_name, name, if_generation_match=None):
+        blob = self.bucket(bucket_name).blob(name)
+        try:
+            if if_generation_match is None:
+                blob.delete()
+            else:
+                blob.delete(if_generation_match=if_generation_match)
+        except precondition_failed_error() as err:
+            raise PreconditionFailed(name) from err
+        except not_found_error() as err:
+            raise FileNotFoundError(name) from err
+
+    def delete_many(self, bucket_name, names):
+        '''
+        Deletes all the blobs in a single batch request. GCS allows at most 100 calls per batch.
+        Batches are tracked per thread, so several threads can each send their own batch.
+        Blobs that are already gone count as deleted, so a batch can be sent again after a partial failure.
+        '''
+        bucket = self.bucket(bucket_name)
+        NotFound = not_found_error()
+        try:
+            with self.client.batch():
+                for name in names:
+                    bucket.delete_blob(name)
+        except Exception:
+            # The batch only reports its first failed delete, and the others may have gone through
+            # (ex: a retry of a batch that partly failed, or resuming a move), so the rest are deleted one by one
+            for name in names:
+                try:
+                    bucket.delete_blob(name)
+                except NotFound:
+                    pass
+
+    def make_bucket(self, bucket_name, location):
+        # Will throw error if bucket already exists
+        self.client.create_bucket(bucket_name, location=location)
+
+
+class LocalBlob:
+    def __init__(self, name, path):
+        stat = os.stat(path)
+        self.name = name
+        self.size = stat.st_size
+        self.generation = stat.st_mtime_ns
+        self.updated = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+
+
+class LocalBackend:
+    '''
+    Storage backend that keeps every bucket as a folder inside root.
+    Mirrors the semantics of GCSBackend so the rest of the package can run against local disk
+    (ex: benchmarking checkpoint throughput or staging on a local SSD).
+    Raises FileNotFoundError when a blob does not exist.
+    '''
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def reset_client(self):
+        pass
+
+    def set_pool_size(self, pool_size):
+        # There are no connections to pool on local disk
+        pass
+
+    def path(self, bucket_name, name):
+        return os.path.join(self.root, bucket_name, *name.split('/'))
+
+    def _bucket_path(self, bucket_name):
+        bucket_path = os.path.join(self.root, bucket_name)
+        if not os.path.isdir(bucket_path):
+            raise FileNotFoundError("Bucket %s does not exist in %s" % (bucket_name, self.root))
+        return bucket_path
+
+    def _write(self, path, write):
+        '''
+        Writes to a temporary file then moves it into place so readers never see a partial blob.
+        Like in the cloud, every write gets a new generation (the modification time in nanoseconds).
+
+        :return: Generation of the new blob
+        '''
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            generation = time.time_ns()
+            os.utime(tmp_path, ns=(generation, generation))
+            os.replace(tmp_path, path)
+            return generation
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _check_generation(self, bucket_name, name, if_generation_match):
+        '''
+        Holds a lock on the bucket while checking the generation of a blob, so conditional writes from several
+        processes happen one at a time. The lock is released when the returned file is closed.
+        '''
+        # Only available on unix, like the VMs
+        import fcntl
+
+        lock = open(os.path.join(self.root, '.lock-' + bucket_name), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                generation = os.stat(self.path(bucket_name, name)).st_mtime_ns
+            except FileNotFoundError:
+                generation = 0
+            if generation != if_generation_match:
+                raise PreconditionFailed(name)
+        except BaseException:
+            lock.close()
+            raise
+        return lock
+
+    def _prune(self, bucket_name, folder):
+        '''
+        Removes empty parent folders since cloud storage has no real folders.
+        '''
+        bucket_path = self._bucket_path(bucket_name)
+        while folder != bucket_path and folder.startswith(bucket_path):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                return
+            folder = os.path.dirname(folder)
+
+    def list_blobs(self, bucket_name, prefix):
+        bucket_path = self._bucket_path(bucket_name)
+
+        # Only walk the deepest folder that can contain the prefix
+        folder_prefix = prefix[:prefix.rfind('/') + 1]
+        start = os.path.join(bucket_path, *folder_prefix.split('/'))
+        if not os.path.isdir(start):
+            return []
+
+        blobs = []
+        for folder, _, filenames in os.walk(start):
+            rel_folder = os.path.relpath(folder, bucket_path).replace(os.sep, '/')
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+                name = filename if rel_folder == '.' else rel_folder + '/' + filename
+                if name.startswith(prefix):
+                    blobs.append(LocalBlob(name, os.path.join(folder, filename)))
+        blobs.sort(key=lambda blob: blob.name)
+        return blobs
+
+    def list_prefixes(self, bucket_name, prefix, page_size=None):
+        bucket_path = self._bucket_path(bucket_name)
+        folder_prefix = prefix[:prefix.rfind('/') + 1]
+        folder = os.path.join(bucket_path, *folder_prefix.split('/'))
+        if not os.path.isdir(folder):
+            return set()
+
+        prefixes = set()
+        for entry in os.scandir(folder):
+            name = folder_prefix + entry.name + '/'
+            if entry.is_dir() and name.startswith(prefix):
+                prefixes.add(name)
+        return prefixes
+
+    def stat(self, bucket_name, name):
+        return LocalBlob(name, self.path(bucket_name, name))
+
+    def upload_file(self, bucket_name, src, dest):
+        self._bucket_path(bucket_name)
+        with open(src, 'rb') as src_file:
+            return self._write(self.path(bucket_name, dest), lambda f: shutil.copyfileobj(src_file, f))
+
+    def download_file(self, bucket_name, src, dest):
+        shutil.copyfile(self.path(bucket_name, src), dest)
+
+    def upload_stream(self, bucket_name, dest, write, chunk_size):
+        self._bucket_path(bucket_name)
+        return self._write(self.path(bucket_name, dest), write)
+
+    def open_read(self, bucket_name, src, chunk_size):
+        return open(self.path(bucket_name, src), 'rb', buffering=chunk_size)
+
+    def upload_str(self, bucket_name, src, dest, if_generation_match=None):
+        self._bucket_path(bucket_name)
+        data = src.encode() if isinstance(src, str) else src
+        if if_generation_match is None:
+            return self._write(self.path(bucket_name, dest), lambda f: f.write(data))
+        with self._check_generation(bucket_name, dest, if_generation_match):
+            return self._write(self.path(bucket_name, dest), lambda f: f.write(data))
+
+    def download_str(self, bucket_name, src):
+        with open(self.path(bucket_name, src), 'rb') as f:
+            return f.read()
+
+    def rename(self, bucket_name, src, dest):
+        src_path = self.path(bucket_name, src)
+        dest_path = self.path(bucket_name, dest)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(src_path, dest_path)
+        self._prune(bucket_name, os.path.dirname(src_path))
+
+    def copy(self, bucket_name, src, dest):
+        with open(self.path(bucket_name, src), 'rb') as src_file:
+            self._write(self.path(bucket_name, dest), lambda f: shutil.copyfileobj(src_file, f))
+
+    def delete(self, bucket_name, name, if_generation_match=None):
+        path = self.path(bucket_name, name)
+        if if_generation_match is None:
+            os.remove(path)
+        else:
+            with self._check_generation(bucket_name, name, if_generation_match):
+                os.remove(path)
+        self._prune(bucket_name, os.path.dirname(path))
+
+    def delete_many(self, bucket_name, names):
+        for name in names:
+            try:
+                self.delete(bucket_name, name)
+            except FileNotFoundError:
+                # Already deleted by someone else
+                pass
+
+    def make_bucket(self, bucket_name, location):
+        # Will throw error if bucket already exists, just like in the cloud
+        os.makedirs(self.root, exist_ok=True)
+        os.mkdir(os.path.join(self.root, bucket_name))
+
+
+def create_backend(name, root=None):
+    '''
+    Creates a storage backend by name.
+
+    :param name: Either "gcs" or "local"
+    :param root: Folder holding the buckets when using the local backend
+    :return: Storage backend
+    '''
+
+    if name == 'gcs':
+        return GCSBackend()
+    if name == 'local':
+        if not root:
+            raise ValueError("The local storage backend needs a root folder")
+        return LocalBackend(root)
+    raise ValueError("Unknown storage backend %s" % name)
@@ -0,0 +1,531 @@
+import collections
+import hashlib
+import copy
+import uuid
+import time
+import json
+import io
+import os
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils import compression
+from clouDL_utils import strings
+
+# Reduced precisions that floating point tensors can be stored in
+PRECISIONS = ['fp16', 'bf16']
+
+# Bytes read from a state dict file to tell a delta manifest apart from a full torch file
+manifest_chunk_size = 256 * 1024
+
+
+class CheckpointOptions:
+    '''
+    How a Manager saves, uploads, and loads its checkpoints
+    '''
+
+    def __init__(self, async_save=False, stream=False, delta=False, shard_size=None, codec='none',
+                 best_precision=None, defer_best=False, progress_log=False, compress_log=False, preempt_save=False,
+                 metadata_url=None):
+        '''
+        :param async_save: Upload checkpoints from save_progress on a background thread instead of blocking training
+        :param stream: Stream params straight to and from the cloud instead of going through files in temp_path
+        :param delta: Save params as a manifest of content hashed tensors so unchanged tensors are not uploaded again
+        :param shard_size: Split params into shards of about shard_size bytes that are saved and loaded in parallel
+        :param codec: Compress params with this codec (none, zlib, lzma, or zstd)
+        :param best_precision: Store the params in best-models (and so in the archive) as fp16 or bf16
+        :param defer_best: Copy the best params right before the next forward pass of the tracked model (or on the
+            next save_progress or finished) instead of in add_progress, so evaluation is not slowed by the copy
+        :param progress_log: Only upload the progress added since the last save, as segments of an append only log
+        :param compress_log: Gzip the progress log segments
+        :param preempt_save: Save an emergency checkpoint of the tracked model and progress when the VM is preempted
+            or the process gets SIGTERM, see Manager.emergency_save. Starts watching once a model is tracked
+        :param metadata_url: Url polled for the preemption, defaults to the one of the metadata server
+        '''
+        if best_precision is not None and best_precision not in PRECISIONS:
+            raise ValueError("Unknown precision %s, use one of %s" % (best_precision, ', '.join(PRECISIONS)))
+
+        self.async_save = async_save
+        self.stream = stream
+        self.delta = delta
+        self.shard_size = shard_size
+        self.codec = codec
+        self.best_precision = best_precision
+        self.defer_best = defer_best
+        self.progress_log = progress_log
+        self.compress_log = compress_log
+        self.preempt_save = preempt_save
+        self.metadata_url = metadata_url
+
+    def create_io(self, bucket_name, temp_path, torch):
+        return CheckpointIO(bucket_name, temp_path, torch, self.stream, self.delta, self.shard_size, self.codec)
+
+
+class CheckpointIO:
+    '''
+    Saves state dicts (ex: params.pt) to the cloud and loads them back.
+
+    By default a state dict goes through a file in temp_path, just like a manual torch.save and upload.
+    With stream, torch.save writes straight into a resumable upload and torch.load reads straight from the blob,
+    so no disk space is needed and only one chunk is held in memory at a time.
+
+    With delta, every tensor is stored once in the shared tensors folder, named by the hash of its content,
+    and the state dict file only holds a small json manifest pointing at them. Tensors that did not change since
+    any earlier save (ex: frozen layers, or the same params in vm-progress and best-models) are not uploaded again.
+
+    With shard_size, the tensors are split into shards of about shard_size bytes saved next to the state dict file
+    (ex: params.pt.<save id>.0), and the state dict file only holds a json index of the shards.
+    Shards are uploaded and downloaded in parallel and memory mapped when loaded from temp_path.
+
+    With a codec other than none, every file holding tensors is compressed with it (see compression.CODECS).
+    Files in temp_path are kept decompressed.
+    Manifests and shard indexes record their codec. A plain torch file does not, so its codec has to be passed
+    back to download and load (Manager keeps it in the commit marker).
+    '''
+
+    def __init__(self, bucket_name, temp_path, torch, stream=False, delta=False, shard_size=None, codec='none'):
+        if delta and shard_size:
+            raise ValueError("Delta checkpoints cannot be sharded")
+        compression.check_codec(codec)
+
+        self.bucket_name = bucket_name
+        self.temp_path = temp_path
+        self.torch = torch
+        self.stream = stream
+        self.delta = delta
+        self.shard_size = shard_size
+        self.codec = codec
+
+    def save(self, state, cloud_folder, filename, precision=None):
+        '''
+        :param state: Generated by model.state_dict()
+        :param cloud_folder: Cloud folder to save in
+        :param filename: Name of the file in the cloud folder
+        :param precision: Store floating point tensors as fp16 or bf16, keeps their precision when None
+        :return: Generation of the uploaded file
+        '''
+
+        if precision is not None:
+            state = self.cast(state, precision)
+
+        if self.delta:
+            manifest = self.save_tensors(state)
+            return gcp.stream_upload_str(self.bucket_name, json.dumps(manifest), os.path.join(cloud_folder, filename))
+
+        if self.shard_size:
+            return self.save_shards(state, cloud_folder, filename)
+
+        if self.stream:
+            dest = os.path.join(cloud_folder, filename)
+            return gcp.stream_upload(self.bucket_name, dest, lambda f: self.write(state, f, self.codec))
+
+        # The local copy is never compressed, just like a downloaded one, so load and torch.load can read it
+        local_path = os.path.join(self.temp_path, filename)
+        with open(local_path, 'wb') as f:
+            self.write(state, f, 'none')
+        if self.codec == 'none':
+            return gcp.upload_file(self.bucket_name, local_path, cloud_folder)
+
+        def write(f):
+            with open(local_path, 'rb') as src:
+                compression.compress_file(self.codec, src, f)
+        return gcp.stream_upload(self.bucket_name, os.path.join(cloud_folder, filename), write)
+
+    def cast(self, state, precision):
+        '''
+        :return: Copy of state with every floating point tensor converted to precision (fp16 or bf16)
+        '''
+
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision %s, use one of %s" % (precision, ', '.join(PRECISIONS)))
+        dtype = self.torch.float16 if precision == 'fp16' else self.torch.bfloat16
+
+        cast_state = copy.copy(state)
+        for key, value in cast_state.items():
+            if self.torch.is_tensor(value) and self.torch.is_floating_point(value):
+                cast_state[key] = value.detach().to(dtype)
+        return cast_state
+
+    def write(self, obj, f, codec):
+        '''
+        torch.save obj into the file object f, compressed with codec
+        '''
+
+        if codec == 'none':
+            self.torch.save(obj, f)
+            return
+        writer = compression.CompressedWriter(codec, f)
+        self.torch.save(obj, writer)
+        writer.close()
+
+    def read(self, f, codec):
+        '''
+        torch.load from the file object f, written with codec
+        '''
+
+        if codec != 'none':
+            # torch.load needs to seek, so the decompressed file is held in memory
+            f = io.BytesIO(compression.decompress(codec, f.read()))
+        return self.torch.load(f, map_location='cpu')
+
+    def decompress_file(self, local_path, codec):
+        '''
+        Decompresses a downloaded file in place
+        '''
+
+        if codec == 'none':
+            return
+        tmp_path = local_path + '.tmp'
+        with open(local_path, 'rb') as src, open(tmp_path, 'wb') as dest:
+            compression.decompress_file(codec, src, dest)
+        os.replace(tmp_path, local_path)
+
+    def download(self, cloud_folder, filename, codec=None):
+        '''
+        Downloads a saved state dict into temp_path and decompresses it. Nothing is downloaded when streaming.
+        A delta manifest is rebuilt into a regular torch file. The shards of a sharded state dict are downloaded
+        in parallel next to its index.
+
+        :param codec: Codec the state dict was saved with when it is a plain torch file, defaults to none
+        :return: Local path of the state dict if it can be used with torch.load, None otherwise
+        '''
+
+        if self.stream:
+            return None
+
+        local_path = os.path.join(self.temp_path, filename)
+        gcp.download_file(self.bucket_name, os.path.join(cloud_folder, filename), self.temp_path)
+
+        with open(local_path, 'rb') as f:
+            manifest = read_manifest(f)
+        if manifest is None:
+            self.decompress_file(local_path, codec or 'none')
+            return local_path
+        if manifest["format"] == "sharded":
+            self.download_shards(manifest, cloud_folder)
+            return None
+        self.torch.save(self.load_tensors(manifest), local_path)
+        return local_path
+
+    def load(self, cloud_folder, filename, codec=None):
+        '''
+        Loads a saved state dict, from temp_path if it was downloaded already or else from the cloud.
+
+        :param codec: Codec the state dict was saved with when it is a plain torch file, defaults to none
+        :return: The state dict
+        '''
+
+        if self.stream:
+            with gcp.stream_open(self.bucket_name, os.path.join(cloud_folder, filename)) as f:
+                manifest = read_manifest(f)
+                if manifest is not None:
+                    return self.load_manifest(manifest, cloud_folder)
+                return self.read(f, codec or 'none')
+
+        local_path = os.path.join(self.temp_path, filename)
+        if not os.path.isfile(local_path):
+            self.download(cloud_folder, filename, codec)
+
+        with open(local_path, 'rb') as f:
+            manifest = read_manifest(f)
+        if manifest is not None:
+            return self.load_manifest(manifest, cloud_folder)
+        return self.torch.load(local_path)
+
+    def load_manifest(self, manifest, cloud_folder):
+        if manifest["format"] == "sharded":
+            return self.load_shards(manifest, cloud_folder)
+        return self.load_tensors(manifest)
+
+    def save_shards(self, state, cloud_folder, filename):
+        '''
+        Splits a state dict into shards of about shard_size bytes, uploads them in parallel, then uploads the index.
+        Every save uses new shard names, so the previous index stays valid until it is replaced.
+        Shards of earlier saves are deleted afterwards.
+
+        :return: Generation of the uploaded index
+        '''
+
+        save_id = uuid.uuid4().hex[:12]
+        shards = []
+        shard = collections.OrderedDict()
+        shard_bytes = 0
+        for key, value in state.items():
+            shard[key] = value
+            if self.torch.is_tensor(value):
+                shard_bytes += value.numel() * value.element_size()
+            if shard_bytes >= self.shard_size:
+                shards.append((shard, shard_bytes))
+                shard = collections.OrderedDict()
+                shard_bytes = 0
+        if shard or not shards:
+            shards.append((shard, shard_bytes))
+
+        index = {
+            "format": "sharded",
+            "keys": list(state.keys()),
+            "metadata": getattr(state, '_metadata', None),
+            "codec": self.codec,
+            "shards": []
+        }
+        jobs = []
+        for i, (shard, shard_bytes) in enumerate(shards):
+            shard_name = '%s.%s.%d' % (filename, save_id, i)
+            index["shards"].append(shard_name)
+            dest = os.path.join(cloud_folder, shard_name)
+            jobs.append((lambda dest=dest, shard=shard: gcp.stream_upload(
+                self.bucket_name, dest, lambda f: self.write(shard, f, self.codec)), shard_bytes))
+        gcp.transfer_all(jobs)
+
+        generation = gcp.stream_upload_str(self.bucket_name, json.dumps(index, default=str),
+                                           os.path.join(cloud_folder, filename))
+
+        current = set(index["shards"])
+        prefix = os.path.join(cloud_folder, filename + '.')
+        old = [blob.name for blob in gcp.backend.list_blobs(self.bucket_name, prefix)
+               if blob.name[len(cloud_folder) + 1:] not in current]
+        gcp.backend.delete_many(self.bucket_name, old)
+        return generation
+
+    def download_shards(self, index, cloud_folder):
+        codec = index.get("codec", 'none')
+
+        def download(src, local_path):
+            gcp.backend.download_file(self.bucket_name, src, local_path)
+            self.decompress_file(local_path, codec)
+
+        jobs = []
+        for shard_name in index["shards"]:
+            local_path = os.path.join(self.temp_path, shard_name)
+            if not os.path.isfile(local_path):
+                src = os.path.join(cloud_folder, shard_name)
+                jobs.append((lambda src=src, local_path=local_path: download(src, local_path), 0))
+        gcp.transfer_all(jobs)
+
+    def load_shard_file(self, path):
+        try:
+            # Memory mapped so tensors are only read from disk when they are used
+            return self.torch.load(path, map_location='cpu', mmap=True)
+        except TypeError:
+            # torch older than 2.1 cannot memory map
+            return self.torch.load(path, map_location='cpu')
+
+    def load_shards(self, index, cloud_folder):
+        '''
+        Loads every shard of a sharded state dict in parallel and merges them.
+
+        :param index: Index of the sharded state dict
+        :param cloud_folder: Cloud folder of the state dict
+        :return: The state dict
+        '''
+
+        shards = {}
+        if self.stream:
+            def load(shard_name):
+                with gcp.stream_open(self.bucket_name, os.path.join(cloud_folder, shard_name)) as f:
+                    shards[shard_name] = self.read(f, index.get("codec", 'none'))
+        else:
+            self.download_shards(index, cloud_folder)
+
+            def load(shard_name):
+                shards[shard_name] = self.load_shard_file(os.path.join(self.temp_path, shard_name))
+
+        gcp.transfer_all([(lambda shard_name=shard_name: load(shard_name), 0) for shard_name in index["shards"]])
+
+        merged = {}
+        for shard_name in index["shards"]:
+            merged.update(shards[shard_name])
+        state = collections.OrderedDict((key, merged[key]) for key in index["keys"])
+        if index["metadata"] is not None:
+            state._metadata = index["metadata"]
+        return state
+
+    def tensor_hash(self, tensor):
+        '''
+        Hashes the dtype, shape, and raw bytes of a tensor
+        '''
+
+        tensor = tensor.detach().cpu().contiguous()
+        digest = hashlib.sha256(('%s%s' % (tensor.dtype, tuple(tensor.shape))).encode())
+        digest.update(tensor.reshape(-1).view(self.torch.uint8).numpy())
+        return digest.hexdigest()
+
+    def to_bytes(self, obj):
+        buffer = io.BytesIO()
+        self.write(obj, buffer, self.codec)
+        return buffer.getvalue()
+
+    def save_tensors(self, state):
+        '''
+        Uploads the tensors of a state dict that are not in the cloud yet.
+        The tensors folder is listed on every save, since collect_tensor_garbage may have deleted tensors since.
+
+        :param state: Generated by model.state_dict()
+        :return: Manifest of the state dict
+        '''
+
+        stored = stored_tensor_names(self.bucket_name)
+
+        manifest = {
+            "format": "delta",
+            "keys": list(state.keys()),
+            "tensors": {},
+            "extras": None,
+            "codec": self.codec
+        }
+        # Non tensor values and the state dict metadata are small, so they are saved together
+        extras = {
+            "values": {},
+            "metadata": getattr(state, '_metadata', None)
+        }
+
+        uploads = {}
+        for key, value in state.items():
+            if not self.torch.is_tensor(value):
+                extras["values"][key] = value
+                continue
+
+            digest = self.tensor_hash(value)
+            manifest["tensors"][key] = digest
+            if tensor_name(digest, self.codec) not in stored and digest not in uploads:
+                uploads[digest] = value.detach().cpu()
+
+        extras_data = self.to_bytes(extras)
+        extras_digest = hashlib.sha256(extras_data).hexdigest()
+        manifest["extras"] = extras_digest
+
+        jobs = [(lambda digest=digest, tensor=tensor: gcp.stream_upload_str(
+            self.bucket_name, self.to_bytes(tensor), tensor_path(digest, self.codec)),
+            tensor.numel() * tensor.element_size()) for digest, tensor in uploads.items()]
+        if tensor_name(extras_digest, self.codec) not in stored:
+            jobs.append((lambda: gcp.stream_upload_str(self.bucket_name, extras_data,
+                                                       tensor_path(extras_digest, self.codec)), len(extras_data)))
+        gcp.transfer_all(jobs)
+        return manifest
+
+    def load_tensors(self, manifest):
+        '''
+        Downloads the tensors of a delta manifest concurrently and rebuilds the state dict.
+
+        :param manifest: Manifest of the state dict
+        :return: The state dict
+        '''
+
+        codec = manifest.get("codec", 'none')
+        digests = set(manifest["tensors"].values())
+        digests.add(manifest["extras"])
+        data = {}
+        jobs = [(lambda digest=digest: data.__setitem__(
+            digest, gcp.stream_download_str(self.bucket_name, tensor_path(digest, codec))), 0) for digest in digests]
+        gcp.transfer_all(jobs)
+
+        extras = self.read(io.BytesIO(data[manifest["extras"]]), codec)
+        state = collections.OrderedDict()
+        for key in manifest["keys"]:
+            if key in manifest["tensors"]:
+                state[key] = self.read(io.BytesIO(data[manifest["tensors"][key]]), codec)
+            else:
+                state[key] = extras["values"][key]
+        if extras["metadata"] is not None:
+            state._metadata = extras["metadata"]
+        return state
+
+
+def tensor_name(digest, codec='none'):
+    # The codec is part of the name since the same tensor can be saved with several codecs
+    if codec == 'none':
+        return digest + '.pt'
+    return '%s.pt.%s' % (digest, codec)
+
+
+def tensor_path(digest, codec='none'):
+    return os.path.join(strings.tensors, tensor_name(digest, codec))
+
+
+def stored_tensor_names(bucket_name):
+    prefix = strings.tensors + '/'
+    return {blob.name[len(prefix):] for blob in gcp.backend.list_blobs(bucket_name, prefix)}
+
+
+def read_manifest(f):
+    '''
+    Reads a delta manifest from a file object, leaving the file at its start if it is a regular torch file.
+
+    :param f: Seekable file object opened in binary mode
+    :return: The manifest, None if the file is not a manifest
+    '''
+
+    first = f.read(1)
+    f.seek(0)
+    # torch files start with a zip or pickle header, never with a json object
+    if first != b'{':
+        return None
+    return json.loads(f.read())
+
+
+def recent_checkpoint(bucket_name, since):
+    '''
+    :return: True (and prints where) if a checkpoint in vm-progress or best-models was committed after since
+    '''
+
+    for folder in [strings.vm_progress, strings.best_model]:
+        for blob in gcp.backend.list_blobs(bucket_name, folder + '/'):
+            if blob.name.endswith('/' + strings.checkpoint_marker) and blob.updated.timestamp() > since:
+                print('Not collecting tensors since %s was saved %.0fs ago' % (blob.name,
+                                                                             time.time() - blob.updated.timestamp()))
+                return True
+    return False
+
+
+def collect_tensor_garbage(bucket_name, grace_seconds=3600, dry_run=False):
+    '''
+    Deletes the tensors that no manifest in vm-progress, best-models, or the archive points at anymore.
+    Tensors newer than grace_seconds are kept, since a VM uploads its tensors before the manifest pointing at them.
+    Nothing is deleted while VMs are saving checkpoints (one was committed in the last grace_seconds), since a VM
+    skips uploading the tensors it lists in the cloud and could point its next manifest at an old one.
+
+    :param bucket_name: Bucket name
+    :param grace_seconds: Only delete tensors uploaded at least this long ago
+    :param dry_run: Only count the tensors and bytes that would be deleted
+    :return: TransferStats for the deleted tensors
+    '''
+
+    start = time.time()
+    action = 'Would delete' if dry_run else 'Deleted'
+    prefix = strings.tensors + '/'
+    tensors = {blob.name[len(prefix):]: blob for blob in gcp.backend.list_blobs(bucket_name, prefix)}
+    if not tensors:
+        # No delta checkpoint was ever saved, so there are no manifests to read
+        return gcp.TransferStats(0, 0, time.time() - start, action)
+    if recent_checkpoint(bucket_name, start - grace_seconds):
+        return gcp.TransferStats(0, 0, time.time() - start, action)
+
+    referenced = set()
+    folders = [strings.vm_progress, strings.best_model, os.path.join(strings.archive, strings.best_model)]
+    for folder in folders:
+        for blob in gcp.backend.list_blobs(bucket_name, folder + '/'):
+            if not blob.name.endswith('.pt'):
+                continue
+            # Only the start of a full torch file is downloaded to find out it is not a manifest
+            with gcp.stream_open(bucket_name, blob.name, manifest_chunk_size) as f:
+                manifest = read_manifest(f)
+            if manifest is not None and manifest["format"] == "delta":
+                codec = manifest.get("codec", 'none')
+                referenced.update(tensor_name(digest, codec) for digest in manifest["tensors"].values())
+                referenced.add(tensor_name(manifest["extras"], codec))
+
+    unused = [blob for name, blob in tensors.items()
+              if name not in referenced and start - blob.updated.timestamp() >= grace_seconds]
+    num_bytes = sum(blob.size or 0 for blob in unused)
+    if dry_run:
+        return gcp.TransferStats(len(unused), num_bytes, time.time() - start, 'Would delete')
+
+    # A VM that started saving while the manifests were read
+    if recent_checkpoint(bucket_name, start - grace_seconds):
+        return gcp.TransferStats(0, 0, time.time() - start, action)
+
+    names = [blob.name for blob in unused]
+    batch_size = gcp.delete_batch_size
+    jobs = [(lambda batch=names[i:i + batch_size]: gcp.backend.delete_many(bucket_name, batch), 0)
+            for i in range(0, len(names), batch_size)]
+    gcp.transfer_all(jobs)
+    return gcp.TransferStats(len(names), num_bytes, time.time() - start, 'Deleted')
@@ -0,0 +1,71 @@
+import threading
+import traceback
+
+
+class BackgroundCheckpointer:
+    '''
+    Runs checkpoint saves on a background thread so training does not wait on uploads.
+    At most one save is pending at a time. A newer save replaces a pending save that has not started yet,
+    since only the latest checkpoint matters. The thread only starts with the first save, so a process can
+    still be forked safely before that (see Manager.parallel_search).
+    '''
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = None
+        self.running = False
+        self.error = None
+        self.coalesced = 0
+        self.thread = None
+
+    def submit(self, save):
+        '''
+        Queues a save to run on the background thread.
+
+        :param save: Function without arguments that performs the whole save
+        '''
+
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work, daemon=True)
+                self.thread.start()
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = save
+            self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                save = self.pending
+                self.pending = None
+                self.running = True
+
+            try:
+                save()
+            except Exception as err:
+                print('Background checkpoint failed')
+                traceback.print_exc()
+                with self.cond:
+                    self.error = err
+            finally:
+                with self.cond:
+                    self.running = False
+                    self.cond.notify_all()
+
+    def flush(self):
+        '''
+        Blocks until every queued save is done.
+        Raises the error of a failed save so it is not silently lost.
+        '''
+
+        with self.cond:
+            while self.pending is not None or self.running:
+                self.cond.wait()
+            error = self.error
+            self.error = None
+
+        if error is not None:
+            raise error
@@ -0,0 +1,118 @@
+import lzma
+import zlib
+
+# Lossless codecs for checkpoints. zlib (fastest level) and lzma ship with python, zstd needs the zstandard package
+CODECS = ['none', 'zlib', 'lzma', 'zstd']
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("The zstd codec needs the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def check_codec(codec):
+    '''
+    Raises ValueError if the codec is unknown or cannot be used in this environment
+    '''
+
+    if codec not in CODECS:
+        raise ValueError("Unknown codec %s, use one of %s" % (codec, ', '.join(CODECS)))
+    if codec == 'zstd':
+        _zstandard()
+
+
+def compressor(codec):
+    '''
+    :return: Object with compress(data) and flush() that compresses a stream of bytes
+    '''
+
+    if codec == 'zlib':
+        return zlib.compressobj(1)
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=1)
+    if codec == 'zstd':
+        return _zstandard().ZstdCompressor(level=3).compressobj()
+    raise ValueError("Unknown codec %s" % codec)
+
+
+def decompressor(codec):
+    '''
+    :return: Object with decompress(data) that decompresses a stream of bytes
+    '''
+
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    if codec == 'zstd':
+        return _zstandard().ZstdDecompressor().decompressobj()
+    raise ValueError("Unknown codec %s" % codec)
+
+
+def compress(codec, data):
+    if codec == 'none':
+        return data
+    c = compressor(codec)
+    return c.compress(data) + c.flush()
+
+
+def decompress(codec, data):
+    if codec == 'none':
+        return data
+    return decompressor(codec).decompress(data)
+
+
+def compress_file(codec, src, dest, chunk_size=16 * 1024 * 1024):
+    '''
+    Compresses the src file object into the dest file object one chunk at a time
+    '''
+
+    c = compressor(codec)
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dest.write(c.compress(chunk))
+    dest.write(c.flush())
+
+
+def decompress_file(codec, src, dest, chunk_size=16 * 1024 * 1024):
+    '''
+    Decompresses the src file object into the dest file object one chunk at a time
+    '''
+
+    d = decompressor(codec)
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dest.write(d.decompress(chunk))
+
+
+class CompressedWriter:
+    '''
+    File object that compresses everything written to it before passing it on to f.
+    close() writes the end of the compressed stream but leaves f open.
+    '''
+
+    def __init__(self, codec, f):
+        self.f = f
+        self.compressor = compressor(codec)
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        self.f.write(self.compressor.compress(bytes(data)))
+        return len(data)
+
+    def tell(self):
+        return self.written
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.f.write(self.compressor.flush())
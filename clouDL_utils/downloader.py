@@ -5,15 +5,18 @@ from clouDL_utils import gcp_interactions as gcp
 
 
 class Downloader:
-    def __init__(self, bucket_name, temp_path):
+    def __init__(self, bucket_name, temp_path, workers=None):
         self.bucket_name = bucket_name
         self.temp_path = temp_path
+        # Max number of concurrent downloads, defaults to gcp.transfer_workers
+        self.workers = workers
 
     def download(self, folder_name, ignore_filename=None):
         dest = self.cplt_tmppth(folder_name)
         if not os.path.isdir(dest):
             pathlib.Path(dest).mkdir(parents=True, exist_ok=True)
-            gcp.download_folder(self.bucket_name, folder_name, dest, ignore_filename)
+            stats = gcp.download_folder(self.bucket_name, folder_name, dest, ignore_filename, self.workers)
+            print('%s: %s' % (folder_name, stats))
             return None
         else:
             return 'The folder %s already exists and will be used (DATA MAY BE OUTDATED!)' % dest
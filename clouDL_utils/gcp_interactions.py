@@ -1,26 +1,180 @@
+import threading
 import pathlib
+import random
+import uuid
 import glob
 import json
 import time
 import os
 
-# Compute Engine client library
-import googleapiclient.discovery
-# Cloud storage client library
-from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-storage_client = storage.Client()
-# using compute engine service, version 1
-compute = googleapiclient.discovery.build('compute', 'v1')
+from clouDL_utils import backends
+from clouDL_utils import strings
 
+# Max number of concurrent blob transfers when moving folders
+transfer_workers = 16
+# Max number of deletes sent in one HTTP request (GCS batch limit)
+delete_batch_size = 100
+# Bytes buffered in memory by streaming uploads and downloads, must be a multiple of 256 KB
+stream_chunk_size = 16 * 1024 * 1024
+# Every storage call goes through this backend, swap it with set_storage
+backend = backends.GCSBackend(pool_size=transfer_workers)
+# Compute engine services of every thread, built by get_compute on first use
+compute = threading.local()
+# Builds a compute engine service, swap it with set_compute (ex: for a fake one when benchmarking)
+compute_factory = None
+# Longest sleep between polls of an operation, or between retries of a rate limited compute call
+max_backoff = 16
 
-def upload_folder_helper(bucket, src, dest):
+
+def build_compute():
+    # Compute Engine client library
+    import googleapiclient.discovery
+
+    return googleapiclient.discovery.build('compute', 'v1')
+
+
+def get_compute():
+    '''
+    Builds the compute engine client (version 1) of this thread on first use and caches it.
+    The client is not thread safe, so every thread gets its own.
+    Building it needs credentials and a network call, so importing this module stays cheap.
     '''
-    Recursively uploads folder.
 
-    :param bucket: Bucket name
+    client = getattr(compute, 'client', None)
+    if client is None:
+        client = (compute_factory or build_compute)()
+        compute.client = client
+    return client
+
+
+def set_compute(factory):
+    '''
+    Selects how compute engine clients are built, clients already built by any thread are dropped.
+
+    :param factory: Function without arguments returning a compute engine service, None for the real one
+    '''
+
+    global compute, compute_factory
+    compute_factory = factory
+    compute = threading.local()
+
+
+def set_storage(name, root=None):
+    '''
+    Selects the storage backend used by every storage call in this module.
+
+    :param name: Either "gcs" for Google Cloud Storage or "local" for a local folder
+    :param root: Folder holding the buckets when using the local backend
+    '''
+
+    global backend
+    backend = backends.create_backend(name, root)
+    backend.set_pool_size(transfer_workers)
+
+
+def after_fork():
+    '''
+    Drops the clients inherited from a parent process, their connections cannot be shared between processes.
+    New clients are created on first use.
+    '''
+
+    global compute
+    backend.reset_client()
+    compute = threading.local()
+
+
+def set_transfer_workers(workers):
+    '''
+    Sets the default number of concurrent blob transfers and sizes the shared HTTP connection pool to match.
+
+    :param workers: Max number of concurrent transfers
+    '''
+
+    global transfer_workers
+    transfer_workers = workers
+    backend.set_pool_size(workers)
+
+
+class TransferStats:
+    '''
+    Aggregate report for a batch of blob transfers
+    '''
+
+    def __init__(self, files=0, num_bytes=0, seconds=0.0, action='Transferred'):
+        self.files = files
+        self.bytes = num_bytes
+        self.seconds = seconds
+        self.action = action
+
+    def bytes_per_sec(self):
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return '%s %d files (%.2f MB) in %.2fs (%.2f MB/s)' % \
+               (self.action, self.files, self.bytes / 1e6, self.seconds, self.bytes_per_sec() / 1e6)
+
+
+def retry(func, retries=3, delay=0.5):
+    '''
+    Calls func until it succeeds or retries run out, backing off exponentially in between.
+    Missing files are never retried.
+
+    :param func: Function without arguments
+    :param retries: Number of retries after the first attempt
+    :param delay: Seconds to wait before the first retry
+    :return: The result of func
+    '''
+
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except FileNotFoundError:
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(delay * (2 ** attempt))
+
+
+def transfer_all(jobs, workers=None, retries=3):
+    '''
+    Runs blob transfers concurrently on a bounded thread pool.
+
+    :param jobs: List of (function, num_bytes) tuples. Each function performs one transfer
+    :param workers: Max number of concurrent transfers, defaults to transfer_workers
+    :param retries: Number of retries per transfer
+    :return: TransferStats for all the jobs
+    '''
+
+    workers = workers or transfer_workers
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(retry, func, retries) for func, _ in jobs]
+        for future in futures:
+            # Raises the first error after its retries run out
+            future.result()
+    return TransferStats(len(jobs), sum(num_bytes for _, num_bytes in jobs), time.time() - start)
+
+
+def is_ignored(name, ignore_filename):
+    '''
+    True if the blob is the ignored file or one of its shards (ex: params.pt.<save id>.0)
+    '''
+
+    basename = os.path.basename(name)
+    return basename == ignore_filename or basename.startswith(ignore_filename + '.')
+
+
+def upload_folder_helper(bucket_name, src, dest, jobs):
+    '''
+    Recursively collects the uploads needed for a folder.
+
+    :param bucket_name: Bucket name
     :param src: To upload
     :param dest: Location to upload
+    :param jobs: List to append (function, num_bytes) upload jobs to
     '''
 
     assert os.path.isdir(src)
@@ -28,14 +182,15 @@ def upload_folder_helper(bucket, src, dest):
         basename = os.path.basename(local_obj)
         if os.path.isdir(local_obj):
             # local_obj is a folder
-            upload_folder_helper(bucket, local_obj, os.path.join(dest, basename))
+            upload_folder_helper(bucket_name, local_obj, os.path.join(dest, basename), jobs)
         else:
             remote_path = os.path.join(dest, basename)
-            blob = bucket.blob(remote_path)
-            blob.upload_from_filename(local_obj)
+            upload = lambda local_obj=local_obj, remote_path=remote_path: \
+                backend.upload_file(bucket_name, local_obj, remote_path)
+            jobs.append((upload, os.path.getsize(local_obj)))
 
 
-def upload_folder(bucket_name, src, dest):
+def upload_folder(bucket_name, src, dest, workers=None):
     '''
     Moves the contents of the src folder inside dest folder.
     This function should not be used to push training data.
@@ -46,24 +201,26 @@ def upload_folder(bucket_name, src, dest):
     :param bucket_name: name of bucket
     :param src: source folder
     :param dest: destination folder
+    :param workers: Max number of concurrent uploads, defaults to transfer_workers
+    :return: TransferStats for the upload
     '''
     if not os.path.isdir(src) or len(os.listdir(src)) == 0:
         raise ValueError("src folder must exist and not be empty")
 
-    bucket = storage_client.bucket(bucket_name)
-
     if dest[-1] != '/':
         dest = dest + '/'
 
     # Ensuring empty dest folder
-    blobs = bucket.list_blobs(prefix=dest)
+    blobs = backend.list_blobs(bucket_name, dest)
     for blob in blobs:
         # Ignoring the folder itself
         if not blob.name[len(dest):]:
             continue
         raise ValueError("Dest folder must be empty")
 
-    upload_folder_helper(bucket, src, dest)
+    jobs = []
+    upload_folder_helper(bucket_name, src, dest, jobs)
+    return transfer_all(jobs, workers)
 
 
 def upload_file(bucket_name, src, dest):
@@ -74,15 +231,14 @@ def upload_file(bucket_name, src, dest):
     :param bucket_name: Bucket name
     :param src: Path of the file to upload
     :param dest: Path of the folder of where to upload file
+    :return: Generation of the uploaded blob
     '''
 
-    bucket = storage_client.bucket(bucket_name)
     remote_path = os.path.join(dest, os.path.basename(src))
-    blob = bucket.blob(remote_path)
-    blob.upload_from_filename(src)
+    return backend.upload_file(bucket_name, src, remote_path)
 
 
-def download_folder(bucket_name, src, dest, ignore_filename=None):
+def download_folder(bucket_name, src, dest, ignore_filename=None, workers=None):
     '''
     Moves content of src folder in GCP into local dest folder.
     For safety, dest must be empty.
@@ -91,6 +247,8 @@ def download_folder(bucket_name, src, dest, ignore_filename=None):
     :param src: Source folder in GCP storage
     :param dest: local destination folder
     :param ignore_filename: files to not move in the src folder
+    :param workers: Max number of concurrent downloads, defaults to transfer_workers
+    :return: TransferStats for the download
     '''
 
     # if not os.path.isdir(dest) or len(os.listdir(dest)) != 0:
@@ -99,13 +257,13 @@ def download_folder(bucket_name, src, dest, ignore_filename=None):
     if src[-1] != '/':
         src = src + '/'
 
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=src)  # Get list of files
+    jobs = []
+    blobs = backend.list_blobs(bucket_name, src)  # Get list of files
     for blob in blobs:
         # name will be in the format of src/folder1/.../folderN/file.ext
         name = blob.name
 
-        if ignore_filename and os.path.basename(name) == ignore_filename:
+        if ignore_filename and is_ignored(name, ignore_filename):
             continue
 
         # Ignoring the path to the src folder
@@ -121,10 +279,13 @@ def download_folder(bucket_name, src, dest, ignore_filename=None):
                 pathlib.Path(only_dir).mkdir(parents=True, exist_ok=True)
 
         # The blob is a folder in the cloud
-        if os.path.isdir(local_path):
+        if os.path.isdir(local_path) or name.endswith('/'):
             continue
 
-        blob.download_to_filename(local_path)
+        download = lambda name=name, local_path=local_path: backend.download_file(bucket_name, name, local_path)
+        jobs.append((download, blob.size or 0))
+
+    return transfer_all(jobs, workers)
 
 
 def download_file(bucket_name, src, dest):
@@ -137,32 +298,34 @@ def download_file(bucket_name, src, dest):
     :param dest: Path of the folder to keep the file.
     '''
     filename = os.path.basename(src)
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(src)
-    blob.download_to_filename(os.path.join(dest, filename))
+    backend.download_file(bucket_name, src, os.path.join(dest, filename))
 
 
-def move_cloud_folder(bucket_name, src, dest, ignore_filename=None):
+def move_cloud_folder(bucket_name, src, dest, ignore_filename=None, workers=None):
     '''
-    Moves the contents of the src cloud folder to the dest Cloud folder by
-    renaming each blob in the src folder.
+    Moves the contents of the src cloud folder to the dest Cloud folder.
+    Blobs are copied server side concurrently, then the sources are deleted in batches.
+    The planned move is saved in the moves folder first so an interrupted move can be finished with resume_moves.
 
     :param bucket_name: Bucket name
     :param src: Source folder
     :param dest: Destination folder
     :param ignore_filename: files to not move in the src folder
+    :param workers: Max number of concurrent copies, defaults to transfer_workers
+    :return: TransferStats for the move
     '''
 
     if src[-1] != '/':
         src = src + '/'
 
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=src)  # Get list of files
+    pairs = []
+    num_bytes = 0
+    blobs = backend.list_blobs(bucket_name, src)  # Get list of files
     for blob in blobs:
         # name will be in the format of src/folder1/.../folderN/file.ext
         name = blob.name
 
-        if ignore_filename and os.path.basename(name) == ignore_filename:
+        if ignore_filename and is_ignored(name, ignore_filename):
             continue
 
         # Ignoring the path to the src folder
@@ -170,23 +333,106 @@ def move_cloud_folder(bucket_name, src, dest, ignore_filename=None):
         if not no_src:
             continue
 
-        new_name = os.path.join(dest, no_src)
-        bucket.rename_blob(blob, new_name)
+        pairs.append([name, os.path.join(dest, no_src)])
+        num_bytes += blob.size or 0
+
+    if not pairs:
+        return TransferStats(action='Moved')
+
+    manifest = {
+        "src": src,
+        "dest": dest,
+        "pairs": pairs
+    }
+    # Nanosecond prefix keeps manifests listed in the order the moves started
+    manifest_path = os.path.join(strings.moves, '%d-%s.json' % (time.time_ns(), uuid.uuid4().hex))
+    stream_upload_str(bucket_name, json.dumps(manifest), manifest_path)
+
+    stats = finish_move(bucket_name, manifest_path, pairs, workers)
+    stats.bytes = num_bytes
+    return stats
 
 
-def get_folder_names(bucket_name, src):
+def finish_move(bucket_name, manifest_path, pairs, workers=None):
     '''
-    Gets all the folder names in the first level of the src folder
+    Copies every (src, dest) pair, deletes the sources in batches, then deletes the manifest.
+    Safe to run again on a move that was interrupted since sources are only deleted after all copies finish.
+
+    :param bucket_name: Bucket name
+    :param manifest_path: Path of the saved move in the cloud
+    :param pairs: List of [src, dest] blob names
+    :param workers: Max number of concurrent copies, defaults to transfer_workers
+    :return: TransferStats for the move
+    '''
+
+    def copy(src, dest):
+        try:
+            backend.copy(bucket_name, src, dest)
+        except FileNotFoundError:
+            # Source was deleted by an interrupted move, it must have been copied already
+            pass
+
+    jobs = [(lambda src=src, dest=dest: copy(src, dest), 0) for src, dest in pairs]
+    stats = transfer_all(jobs, workers)
+
+    batch_size = delete_batch_size
+    names = [src for src, _ in pairs]
+    delete_jobs = [(lambda batch=names[i:i + batch_size]: backend.delete_many(bucket_name, batch), 0)
+                   for i in range(0, len(names), batch_size)]
+    transfer_all(delete_jobs, workers)
+
+    backend.delete_many(bucket_name, [manifest_path])
+    return TransferStats(len(pairs), 0, stats.seconds, 'Moved')
+
+
+def resume_moves(bucket_name, workers=None):
+    '''
+    Finishes every move that was interrupted, oldest first.
+
+    :param bucket_name: Bucket name
+    :param workers: Max number of concurrent copies, defaults to transfer_workers
+    :return: Number of moves finished
+    '''
+
+    manifests = [blob.name for blob in backend.list_blobs(bucket_name, strings.moves + '/')]
+    for manifest_path in manifests:
+        manifest = stream_download_json(bucket_name, manifest_path)
+        print('Resuming move from %s to %s' % (manifest["src"], manifest["dest"]))
+        finish_move(bucket_name, manifest_path, manifest["pairs"], workers)
+    return len(manifests)
+
+
+def sort_folder_names(folder_names):
+    '''
+    Sorts folder names with numeric names (ex: ranks) in numeric order first, then the rest alphabetically.
+
+    :param folder_names: Iterable of folder names
+    :return: Sorted list of folder names
+    '''
+
+    return sorted(folder_names, key=lambda name: (0, int(name), '') if name.isdigit() else (1, 0, name))
+
+
+def get_folder_names(bucket_name, src, delimiter=True):
+    '''
+    Gets all the folder names in the first level of the src folder, sorted by sort_folder_names
     :param bucket_name: Bucket name
     :param src: Source folder
+    :param delimiter: Only ask the server for the first level folders instead of listing every blob
     '''
 
     if src[-1] != '/':
         src = src + '/'
 
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=src)  # Get list of files
     folder_names = set({})
+    if delimiter:
+        for prefix in backend.list_prefixes(bucket_name, src):
+            folder_name = prefix[len(src):].rstrip('/')
+            if folder_name:
+                folder_names.add(folder_name)
+        return sort_folder_names(folder_names)
+
+    blobs = backend.list_blobs(bucket_name, src)  # Get list of files
     for blob in blobs:
         name = blob.name
         no_src = name[len(src):]
@@ -196,7 +442,7 @@ def get_folder_names(bucket_name, src):
         folder_name = no_src[:folder_delimiter_index]
         if folder_name:
             folder_names.add(folder_name)
-    return folder_names
+    return sort_folder_names(folder_names)
 
 
 def stream_download_str(bucket_name, src):
@@ -207,9 +453,33 @@ def stream_download_str(bucket_name, src):
     :param src: Source to download from
     '''
 
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(src)
-    return blob.download_as_string()
+    return backend.download_str(bucket_name, src)
+
+
+def stream_upload(bucket_name, dest, write, chunk_size=None):
+    '''
+    Streams data straight into a blob without writing a local file first
+
+    :param bucket_name: Bucket name
+    :param dest: Destination to save file (ex: vm-progress/0/params.pt)
+    :param write: Function that writes the data into the file object it receives
+    :param chunk_size: Bytes buffered in memory, defaults to stream_chunk_size
+    :return: Generation of the uploaded blob
+    '''
+
+    return backend.upload_stream(bucket_name, dest, write, chunk_size or stream_chunk_size)
+
+
+def stream_open(bucket_name, src, chunk_size=None):
+    '''
+    Opens a blob as a seekable, read only file object that downloads in chunks
+
+    :param bucket_name: Bucket name
+    :param src: Source to download from
+    :param chunk_size: Bytes buffered in memory, defaults to stream_chunk_size
+    '''
+
+    return backend.open_read(bucket_name, src, chunk_size or stream_chunk_size)
 
 
 def stream_download_json(bucket_name, src):
@@ -231,25 +501,115 @@ def stream_upload_str(bucket_name, src, dest):
     :param bucket_name: Bucket name
     :param src: Source string
     :param dest: Destination to save file (ex: vm-progress/filename.json)
+    :return: Generation of the uploaded blob
     '''
 
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(dest)
-    blob.upload_from_string(src)
+    return backend.upload_str(bucket_name, src, dest)
 
 
-def delete_all_prefixes(bucket_name, prefix):
+def stat_blob(bucket_name, name):
     '''
-    Delete folder and all of its content in Google Cloud Storage
+    Gets the metadata of a blob without downloading it.
 
     :param bucket_name: Bucket name
-    :param folder: Folder name in Cloud
+    :param name: Name of the blob
+    :return: The blob (with its name, size, and generation), None if it does not exist
     '''
 
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=prefix)
-    for blob in blobs:
-        blob.delete()
+    try:
+        return backend.stat(bucket_name, name)
+    except FileNotFoundError:
+        return None
+
+
+def upload_checkpoint(bucket_name, folder, uploads, workers=None, metadata=None):
+    '''
+    Uploads the artifacts of one checkpoint concurrently, then writes the commit marker last.
+    The marker records the generation of every artifact, so a checkpoint that was only partly
+    written (or partly overwritten) is never trusted by read_checkpoint.
+
+    :param bucket_name: Bucket name
+    :param folder: Cloud folder of the checkpoint (ex: vm-progress/0)
+    :param uploads: Dict of filename to a function that uploads that file and returns its generation
+    :param workers: Max number of concurrent uploads, defaults to transfer_workers
+    :param metadata: Dict saved in the marker that readers need to decode the artifacts (ex: their codec)
+    :return: The commit marker
+    '''
+
+    with ThreadPoolExecutor(max_workers=workers or transfer_workers) as executor:
+        futures = {filename: executor.submit(retry, upload) for filename, upload in uploads.items()}
+        generations = {filename: future.result() for filename, future in futures.items()}
+
+    marker = {
+        "artifacts": generations,
+        "metadata": metadata or {},
+        "time": time.strftime("%m/%d/%Y-%H:%M:%S")
+    }
+    stream_upload_str(bucket_name, json.dumps(marker), os.path.join(folder, strings.checkpoint_marker))
+    return marker
+
+
+def read_checkpoint(bucket_name, folder):
+    '''
+    Reads the commit marker of a checkpoint and checks it against the artifacts in the folder.
+
+    :param bucket_name: Bucket name
+    :param folder: Cloud folder of the checkpoint (ex: vm-progress/0)
+    :return: The commit marker if every artifact matches it, None otherwise
+    '''
+
+    if folder[-1] != '/':
+        folder = folder + '/'
+
+    # One listing gives the current generation of every artifact
+    generations = {blob.name[len(folder):]: blob.generation for blob in backend.list_blobs(bucket_name, folder)}
+    if strings.checkpoint_marker not in generations:
+        return None
+
+    marker = stream_download_json(bucket_name, folder + strings.checkpoint_marker)
+    for filename, generation in marker["artifacts"].items():
+        if generations.get(filename) != generation:
+            return None
+    return marker
+
+
+def delete_all_prefixes(bucket_name, prefix, dry_run=False, progress=None, workers=None,
+                        batch_size=None):
+    '''
+    Delete folder and all of its content in Google Cloud Storage.
+    Deletes are grouped into batches (one HTTP round trip each) and the batches are sent concurrently.
+
+    :param bucket_name: Bucket name
+    :param prefix: Folder name in Cloud
+    :param dry_run: Only count the blobs and bytes that would be deleted
+    :param progress: Called as progress(deleted, total) after each batch finishes
+    :param workers: Max number of concurrent batches, defaults to transfer_workers
+    :param batch_size: Max number of deletes per batch, defaults to delete_batch_size
+    :return: TransferStats with the number of blobs and bytes deleted
+    '''
+
+    start = time.time()
+    blobs = list(backend.list_blobs(bucket_name, prefix))
+    num_bytes = sum(blob.size or 0 for blob in blobs)
+
+    if dry_run:
+        return TransferStats(len(blobs), num_bytes, time.time() - start, 'Would delete')
+
+    names = [blob.name for blob in blobs]
+    batch_size = batch_size or delete_batch_size
+    batches = [names[i:i + batch_size] for i in range(0, len(names), batch_size)]
+
+    deleted = 0
+    with ThreadPoolExecutor(max_workers=workers or transfer_workers) as executor:
+        futures = {executor.submit(retry, lambda batch=batch: backend.delete_many(bucket_name, batch)): len(batch)
+                   for batch in batches}
+        for future in as_completed(futures):
+            future.result()
+            deleted += futures[future]
+            if progress:
+                progress(deleted, len(names))
+
+    return TransferStats(len(names), num_bytes, time.time() - start, 'Deleted')
 
 
 def make_bucket(bucket_name, location):
@@ -261,7 +621,7 @@ def make_bucket(bucket_name, location):
     '''
 
     # Will throw error if bucket already exists
-    storage_client.create_bucket(bucket_name, location=location)
+    backend.make_bucket(bucket_name, location)
 
 
 def gen_gcp_pth(root, *args):
@@ -279,18 +639,47 @@ def gen_gcp_pth(root, *args):
 
 
 def list_instances(project_id, zone):
-    result = compute.instances().list(project=project_id, zone=zone).execute()
+    result = execute_compute(lambda: get_compute().instances().list(project=project_id, zone=zone))
     return result['items'] if 'items' in result else None
 
 
-def create_instance(project_id, configs, startup_script, zone, rank, bucket_name):
-    name = configs["name_prefix"] + ("-%d" % rank)
-    machine_type = "zones/%s/machineTypes/n1-standard-%d" % (zone, configs["cpu_count"])
-    accelerator_type = "zones/%s/acceleratorTypes/%s" % (zone, configs['gpu'])
-    subnetwork = "regions/%s/subnetworks/default" % zone[:zone.rfind('-')]
+def instance_properties(configs, startup_script, bucket_name, zone=None, rank=None):
+    '''
+    Builds the body of an instance from the machine configs.
+    Without a zone, the body is for an instance template, which names its machine type, accelerator type,
+    and network instead of giving their zonal (or regional) paths.
+
+    :param rank: Rank saved in the metadata, left out for templates since their instances share it
+    '''
+
+    if zone is None:
+        machine_type = "n1-standard-%d" % configs["cpu_count"]
+        accelerator_type = configs['gpu']
+        network = {"network": "global/networks/default"}
+    else:
+        machine_type = "zones/%s/machineTypes/n1-standard-%d" % (zone, configs["cpu_count"])
+        accelerator_type = "zones/%s/acceleratorTypes/%s" % (zone, configs['gpu'])
+        network = {"subnetwork": "regions/%s/subnetworks/default" % zone[:zone.rfind('-')]}
+
+    metadata = [
+        {
+            # Startup script is automatically executed by the
+            # instance upon startup.
+            'key': 'startup-script',
+            'value': startup_script
+        },
+        {
+            'key': 'bucket',
+            'value': bucket_name
+        }
+    ]
+    if rank is not None:
+        metadata.append({
+            'key': 'rank',
+            'value': rank
+        })
 
     config = {
-        "name": name,
         "machineType": machine_type,
 
         "disks": [
@@ -305,9 +694,8 @@ def create_instance(project_id, configs, startup_script, zone, rank, bucket_name
         ],
 
         "networkInterfaces": [
-            {
+            dict(network, **{
                 "kind": "compute#networkInterface",
-                "subnetwork": subnetwork,
                 "accessConfigs": [
                     {
                         "kind": "compute#accessConfig",
@@ -317,7 +705,7 @@ def create_instance(project_id, configs, startup_script, zone, rank, bucket_name
                     }
                 ],
                 "aliasIpRanges": []
-            }
+            })
         ],
 
         "scheduling": {
@@ -343,22 +731,7 @@ def create_instance(project_id, configs, startup_script, zone, rank, bucket_name
         # Metadata is readable from the instance and allows you to
         # pass configuration from deployment scripts to instances.
         'metadata': {
-            'items': [
-                {
-                    # Startup script is automatically executed by the
-                    # instance upon startup.
-                    'key': 'startup-script',
-                    'value': startup_script
-                },
-                {
-                    'key': 'rank',
-                    'value': rank
-                },
-                {
-                    'key': 'bucket',
-                    'value': bucket_name
-                }
-            ]
+            'items': metadata
         }
     }
 
@@ -368,43 +741,141 @@ def create_instance(project_id, configs, startup_script, zone, rank, bucket_name
                 "acceleratorCount": configs["gpu_count"],
                 "acceleratorType": accelerator_type
             }
-        ],
+        ]
+
+    return config
+
+
+def create_instance(project_id, configs, startup_script, zone, rank, bucket_name):
+    config = instance_properties(configs, startup_script, bucket_name, zone, rank)
+    config["name"] = configs["name_prefix"] + ("-%d" % rank)
 
-    return compute.instances().insert(
+    return execute_compute(lambda: get_compute().instances().insert(
         project=project_id,
         zone=zone,
-        body=config).execute()
+        body=config))
+
+
+def create_instance_template(project_id, configs, startup_script, bucket_name, name):
+    '''
+    Creates an instance template for the VMs of a cluster. Its instances have no rank in their metadata,
+    so they read it from the end of their name (ex: vm-12).
+
+    :param name: Name of the template
+    :return: The global operation
+    '''
+
+    body = {
+        "name": name,
+        "properties": instance_properties(configs, startup_script, bucket_name)
+    }
+    return execute_compute(lambda: get_compute().instanceTemplates().insert(project=project_id, body=body))
+
+
+def delete_instance_template(project_id, name):
+    return execute_compute(lambda: get_compute().instanceTemplates().delete(project=project_id,
+                                                                            instanceTemplate=name))
+
+
+def bulk_insert_instances(project_id, zone, template_name, names):
+    '''
+    Creates several instances from an instance template with a single request.
+    Either every instance is created or none are.
+
+    :param names: Names of the instances
+    :return: The zone operation
+    '''
+
+    body = {
+        "count": len(names),
+        "sourceInstanceTemplate": "global/instanceTemplates/%s" % template_name,
+        "perInstanceProperties": {name: {} for name in names}
+    }
+    return execute_compute(lambda: get_compute().instances().bulkInsert(project=project_id, zone=zone, body=body))
+
+
+def is_rate_limited(err):
+    '''
+    True if a compute engine call failed because of rate limits (or a server error worth retrying)
+    '''
+
+    status = getattr(getattr(err, 'resp', None), 'status', None)
+    if status is None:
+        return False
+    status = int(status)
+    return status == 429 or status >= 500 or (status == 403 and b'rateLimitExceeded' in getattr(err, 'content', b''))
+
+
+def is_zonal_error(err):
+    '''
+    True if creating a VM failed because of its zone (ex: the zone ran out of resources, or a network error),
+    so a different zone may work. Other client errors (ex: credentials, quota, or malformed configs) fail in every zone.
+    '''
+
+    status = getattr(getattr(err, 'resp', None), 'status', None)
+    if status is None:
+        return isinstance(err, OSError)
+    status = int(status)
+    if not 400 <= status < 500 or status == 429:
+        return True
+    content = getattr(err, 'content', b'') or b''
+    return b'ZONE_RESOURCE_POOL_EXHAUSTED' in content or b'resourceExhausted' in content
+
+
+def execute_compute(request, retries=5):
+    '''
+    Executes a compute engine request, backing off exponentially (with jitter) while it is rate limited.
+
+    :param request: Function without arguments that builds the request
+    :return: The response
+    '''
+
+    delay = 1
+    for attempt in range(retries + 1):
+        try:
+            return request().execute()
+        except Exception as err:
+            if attempt == retries or not is_rate_limited(err):
+                raise
+        time.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(delay * 2, max_backoff)
 
 
-def wait_for_operation(project_id, operation, zone):
+def wait_for_operation(project_id, operation, zone=None):
     '''
-    Waits for an operation in GCP to finish then report its status
+    Waits for an operation in GCP to finish then report its status.
+    The server blocks the wait call until the operation is done (or about 2 minutes passed), so there is no polling.
+    Clients without the wait call poll instead, backing off between polls.
 
     :param project_id: Project id the operation took place in
     :param operation: Operation name
-    :param zone: Zone of the operation
+    :param zone: Zone of the operation, None for a global operation (ex: creating an instance template)
     :return: True if successful, false otherwise
     '''
 
+    location = {} if zone is None else {"zone": zone}
+    delay = 0.5
     while True:
-        result = compute.zoneOperations().get(
-            project=project_id,
-            zone=zone,
-            operation=operation).execute()
+        operations = get_compute().globalOperations() if zone is None else get_compute().zoneOperations()
+        blocking = hasattr(operations, 'wait')
+        call = operations.wait if blocking else operations.get
+        result = execute_compute(lambda: call(project=project_id, operation=operation, **location))
 
         if result['status'] == 'DONE':
             if 'error' in result:
                 return False
             return True
 
-        time.sleep(1)
+        if not blocking:
+            time.sleep(delay)
+            delay = min(delay * 2, max_backoff)
 
 
 def delete_instance(project_id, zone, name):
-    return compute.instances().delete(
+    return execute_compute(lambda: get_compute().instances().delete(
         project=project_id,
         zone=zone,
-        instance=name).execute()
+        instance=name))
 
 
 class QuickSend:
@@ -413,4 +884,4 @@ class QuickSend:
 
     def send(self, filename, msg, folder):
         file_path = os.path.join(folder, filename)
-        stream_upload_str(self.bucket_name, msg, file_path)
+        return stream_upload_str(self.bucket_name, msg, file_path)
@@ -3,13 +3,26 @@ import copy
 import json
 
 from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils.trial_history import TrialHistory
+from clouDL_utils import sampling
 from clouDL_utils import strings
 
+# Methods that sample every hyperparameter using them together as one point, with whether they are log scaled
+SOBOL_METHODS = {"sobol": False, "log sobol": True}
+LATIN_HYPERCUBE_METHODS = {"latin hypercube": False, "log latin hypercube": True}
+TPE_METHODS = {"tpe": False, "log tpe": True}
+
 class Hyperparameters:
-    def __init__(self, hyparams_path=None, hyparams=None, bucket_name=None):
+    def __init__(self, hyparams_path=None, hyparams=None, bucket_name=None, history=None):
+        '''
+        :param history: TrialHistory the tpe methods learn from, one without a local cache is created when needed
+        '''
         if not hyparams_path and not hyparams:
             raise ValueError
 
+        self.bucket_name = bucket_name
+        self.history = history
+
         if hyparams_path:
             # Letting errors pass through if file cannot be read since the file is mandatory
             if bucket_name:
@@ -21,6 +34,8 @@ class Hyperparameters:
 
         self.cur_val = "current_values"
         self.cur_iter = "current_iter"
+        # Set when several slots split the iterations, slot k tries iterations k, k + iter_step, ...
+        self.iter_step = "iter_step"
 
     def force_cur_values(self):
         '''
@@ -36,10 +51,29 @@ class Hyperparameters:
             return False
 
     def reset(self):
-        # Generate new current values
-        self.generate()
         # Maintains track of number of sets of hyparameters tried
-        self.raw_hyparams[self.cur_iter] = self.raw_hyparams[self.cur_iter] + 1
+        self.raw_hyparams[self.cur_iter] = self.raw_hyparams[self.cur_iter] + self.get_iter_step()
+        # Generate new current values for the next iteration
+        self.generate()
+
+    def get_iter_step(self):
+        return self.raw_hyparams.get(self.iter_step, 1)
+
+    def get_max_iter(self):
+        # Every bonus iteration adds one more iteration for this VM (or slot)
+        return self.raw_hyparams["max_iter"] + self.raw_hyparams.get("bonus_iter", 0) * self.get_iter_step()
+
+    def add_saved_epochs(self, epochs, trial_epochs):
+        '''
+        Adds the epochs a stopped trial did not use. Every trial_epochs saved epochs buy one bonus iteration.
+
+        :return: True if a bonus iteration was added
+        '''
+        saved = self.raw_hyparams.get("saved_epochs", 0) + epochs
+        bonus = saved // trial_epochs
+        self.raw_hyparams["saved_epochs"] = saved - bonus * trial_epochs
+        self.raw_hyparams["bonus_iter"] = self.raw_hyparams.get("bonus_iter", 0) + bonus
+        return bonus > 0
 
     def generate(self):
         '''
@@ -48,6 +82,11 @@ class Hyperparameters:
 
         hyparam_copy = copy.deepcopy(self.raw_hyparams["hyperparameters"])
         cur_iter = self.raw_hyparams[self.cur_iter]
+        hyparam_copy.update(self.joint_sample(hyparam_copy, SOBOL_METHODS, lambda keys: self.sobol_point(len(keys))))
+        hyparam_copy.update(self.joint_sample(hyparam_copy, LATIN_HYPERCUBE_METHODS,
+                                              lambda keys: self.latin_hypercube_point(len(keys))))
+        hyparam_copy.update(self.joint_sample(hyparam_copy, TPE_METHODS,
+                                              lambda keys: self.tpe_point(hyparam_copy, keys)))
         for key, value in hyparam_copy.items():
             if isinstance(value, list):
                 # Defaults to uniform random
@@ -70,6 +109,77 @@ class Hyperparameters:
 
         self.raw_hyparams[self.cur_val] = hyparam_copy
 
+    def sample_index(self):
+        '''
+        Index of this trial in the points shared by the whole cluster. Trials of one iteration on every rank are
+        next to each other, so the first trials of the cluster use the first (most evenly spread) points.
+        '''
+        rank = self.raw_hyparams.get("rank", 0)
+        workers = self.raw_hyparams.get("workers", 1)
+        return self.raw_hyparams[self.cur_iter] * workers + rank
+
+    def sobol_point(self, dims):
+        # Skips the first point, which is the corner of the space
+        return sampling.sobol_point(self.sample_index() + 1, dims)
+
+    def latin_hypercube_point(self, dims):
+        budget = self.raw_hyparams["max_iter"] * self.raw_hyparams.get("workers", 1)
+        return sampling.latin_hypercube_point(self.sample_index(), dims, budget, self.raw_hyparams.get("seed", 0))
+
+    def tpe_point(self, hyparams, keys):
+        '''
+        Fits a tree-structured Parzen estimator on every finished trial in the bucket that searched the same keys
+        within their bounds, and proposes the next point. Until there are tpe_startup (default 10) such trials,
+        Sobol points are used instead.
+
+        :param hyparams: Hyperparameter section
+        :param keys: Sorted keys using a tpe method
+        :return: Point in the unit cube
+        '''
+        if self.history is None and self.bucket_name:
+            self.history = TrialHistory(self.bucket_name)
+
+        observed = []
+        if self.history is not None:
+            self.history.refresh()
+            for trial in self.history.get_trials():
+                try:
+                    point = [sampling.unscale(trial["values"][key], *hyparams[key]["data"],
+                                              log=TPE_METHODS[hyparams[key]["method"]]) for key in keys]
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if all(0 <= u <= 1 for u in point):
+                    score = trial["score"] if trial["goal"] == "max" else -trial["score"]
+                    observed.append((point, score))
+
+        if len(observed) < self.raw_hyparams.get("tpe_startup", 10):
+            return self.sobol_point(len(keys))
+
+        # Seeded by the trial so a VM and its slots do not all propose the same point
+        rand = random.Random('%s-%d' % (self.raw_hyparams.get("seed", 0), self.sample_index()))
+        return sampling.tpe_point(observed, len(keys), rand)
+
+    @staticmethod
+    def joint_sample(hyparams, methods, point):
+        '''
+        Samples every hyperparameter that uses one of methods as a single point, one dimension per hyperparameter.
+
+        :param hyparams: Hyperparameter section
+        :param methods: Dict of method name to whether it is log scaled
+        :param point: Called with the sorted keys, returns a point in the unit cube
+        :return: Dict of the sampled hyperparameters
+        '''
+        keys = sorted(key for key, value in hyparams.items()
+                      if isinstance(value, dict) and value.get("method") in methods)
+        if not keys:
+            return {}
+
+        sampled = {}
+        for key, u in zip(keys, point(keys)):
+            start, end = hyparams[key]["data"]
+            sampled[key] = sampling.scale(u, start, end, methods[hyparams[key]["method"]])
+        return sampled
+
     def uniform_random(start, end):
         return random.uniform(start, end)
 
@@ -96,7 +206,7 @@ class Hyperparameters:
         return self.raw_hyparams
 
     def save_hyparams(self, quick_send, cloud_folder):
-        quick_send.send(strings.vm_hyparams_report, json.dumps(self.raw_hyparams), cloud_folder)
+        return quick_send.send(strings.vm_hyparams_report, json.dumps(self.raw_hyparams), cloud_folder)
 
     def interesting_sec(self):
         '''
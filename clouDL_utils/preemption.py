@@ -0,0 +1,125 @@
+import threading
+import traceback
+import signal
+import time
+import sys
+import os
+
+# Reads TRUE once the VM is being preempted
+METADATA_URL = 'http://metadata/computeMetadata/v1/instance/preempted'
+
+# The watcher of this process, shared by every Manager (see watch)
+watcher = None
+
+
+class PreemptionWatcher:
+    '''
+    Calls a save function once when the VM is about to stop, either because the metadata server reports that the
+    VM is preempted or because the process gets SIGTERM. GCP gives preempted VMs about 30 seconds before they stop,
+    so the save has to be quick. After SIGTERM, the process exits (with the usual exit code) once the save is done.
+    '''
+
+    def __init__(self, url=None, poll_seconds=5):
+        '''
+        :param url: Metadata url to poll, a local fake metadata server can be used for testing
+        :param poll_seconds: Seconds between polls
+        '''
+        self.url = url or METADATA_URL
+        self.poll_seconds = poll_seconds
+        self.save = None
+        self.lock = threading.Lock()
+        self.fired = False
+        self.saved = threading.Event()
+        self.thread = None
+        self.handles_signal = False
+
+    def start(self):
+        # Threads do not survive a fork, so a forked process starts its own
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.poll, daemon=True)
+            self.thread.start()
+        # Signal handlers can only be set from the main thread
+        if not self.handles_signal and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.on_signal)
+            self.handles_signal = True
+
+    def preempted(self):
+        import requests
+
+        response = requests.get(self.url, headers={'Metadata-Flavor': 'Google'}, timeout=self.poll_seconds)
+        return response.text.strip() == 'TRUE'
+
+    def poll(self):
+        while not self.fired:
+            try:
+                if self.preempted():
+                    self.fire('the VM is preempted')
+                    return
+            except Exception:
+                # Not on a VM or the metadata server is busy, SIGTERM still triggers the save
+                pass
+            time.sleep(self.poll_seconds)
+
+    def on_signal(self, signum, frame):
+        # Saving on another thread lets an interrupted save on this thread finish first
+        threading.Thread(target=self.fire, args=('SIGTERM', 128 + signum)).start()
+
+    def fire(self, reason, exit_code=None):
+        '''
+        Runs the save if it has not run yet, otherwise waits for it to finish.
+
+        :param reason: Printed with the save
+        :param exit_code: Exit the process with this code after the save
+        '''
+        with self.lock:
+            first = not self.fired
+            self.fired = True
+
+        if first:
+            print('Saving an emergency checkpoint since %s' % reason)
+            start = time.time()
+            try:
+                if self.save is not None:
+                    self.save()
+                print('Saved the emergency checkpoint in %.2fs' % (time.time() - start))
+            except Exception:
+                print('Could not save the emergency checkpoint')
+                traceback.print_exc()
+            self.saved.set()
+        else:
+            self.saved.wait()
+
+        if exit_code is not None:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+
+def after_fork():
+    '''
+    Drops the watcher inherited from a parent process, its thread did not survive the fork and its lock may be held.
+    The next call to watch starts a new one.
+    '''
+
+    global watcher
+    if watcher is not None and watcher.handles_signal:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    watcher = None
+
+
+def watch(save, url=None, poll_seconds=5):
+    '''
+    Makes the watcher of this process call save on preemption, replacing the save of an earlier call
+    (ex: the Manager of the previous trial).
+
+    :param save: Function without arguments
+    :param url: Same as in PreemptionWatcher
+    :param poll_seconds: Same as in PreemptionWatcher
+    :return: The watcher
+    '''
+    global watcher
+    if watcher is None:
+        watcher = PreemptionWatcher(url, poll_seconds)
+    watcher.save = save
+    watcher.start()
+    return watcher
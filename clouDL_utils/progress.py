@@ -1,35 +1,121 @@
+from array import array
+import threading
+import gzip
 import json
+import os
 
 from clouDL_utils import gcp_interactions as gcp
 from clouDL_utils import strings
 
 
+def pack(values):
+    '''
+    Stores a list of values as compactly as possible: an array of 64 bit ints ('q') or doubles ('d'),
+    or the list itself when the values are not all numbers.
+    '''
+
+    if all(type(value) is int for value in values):
+        try:
+            return array('q', values)
+        except OverflowError:
+            return list(values)
+    if all(type(value) in (int, float) for value in values):
+        return array('d', values)
+    return list(values)
+
+
+def append(values, value):
+    '''
+    Appends a value, widening the array when it cannot hold the value.
+
+    :return: The values, which are a new object when they had to be widened
+    '''
+
+    if isinstance(values, array):
+        if values.typecode == 'q' and type(value) is int:
+            try:
+                values.append(value)
+                return values
+            except OverflowError:
+                return list(values) + [value]
+        if type(value) in (int, float):
+            if values.typecode == 'q':
+                values = array('d', values)
+            values.append(value)
+            return values
+        values = values.tolist()
+    values.append(value)
+    return values
+
+
 class Progress:
+    '''
+    The values of every key are kept in typed arrays, and the best compare value and its index are updated on
+    every add, so adding and comparing against the best value do not rescan the values.
+    get_progress() returns the same dict of lists that is saved to the cloud.
+    '''
+
     def __init__(self, progress_path=None, progress=None, bucket_name=None):
         if progress_path:
             if bucket_name:
                 try:
-                    self.progress = gcp.stream_download_json(bucket_name, progress_path)
+                    # Rebuilt from the progress log when there is one next to progress_path
+                    folder = os.path.dirname(progress_path)
+                    self.load(read_progress_log(bucket_name, folder)[0].get_progress())
                 except Exception as err:
                     self.reset()
             else:
-                self.progress = json.load(open(progress_path))
+                self.load(json.load(open(progress_path)))
         if progress:
-            self.progress = progress
+            self.load(progress)
         if not progress and not progress_path:
             self.reset()
 
+    def load(self, progress):
+        self.goal = progress["goal"]
+        self.compare = progress["compare"]
+        self.values = {}
+        for key, values in progress.items():
+            if key in ("goal", "compare"):
+                continue
+            self.values[key] = pack(values) if isinstance(values, list) else values
+        self.find_best()
+
+    def find_best(self):
+        '''
+        Scans the compare values for the first occurrence of the best value
+        '''
+
+        self.best = None
+        self.best_index = None
+        for index, value in enumerate(self.values.get(self.compare, [])):
+            if self.best_index is None or self.better(value, self.best):
+                self.best = value
+                self.best_index = index
+
+    def better(self, val, best):
+        return val > best if self.goal == "max" else val < best
+
+    @property
+    def progress(self):
+        return self.get_progress()
+
     def get_compare_goal(self):
-        return self.progress["compare"], self.progress["goal"]
+        return self.compare, self.goal
+
+    def get_values(self, key):
+        return self.values[key]
 
     def get_compare_vals(self):
-        compare, _ = self.get_compare_goal()
-        return self.progress[compare]
+        return self.values[self.compare]
 
     def get_best(self):
-        _, goal = self.get_compare_goal()
-        compare_vals = self.get_compare_vals()
-        return max(compare_vals) if goal == "max" else min(compare_vals)
+        if self.best_index is None:
+            raise ValueError("No values for %s" % self.compare)
+        return self.best
+
+    def get_best_index(self):
+        return self.best_index
 
     def add(self, key, value):
         '''
@@ -40,64 +126,254 @@ class Progress:
         :return: True if the key and value are the new best. False otherwise
         '''
 
-        if key not in self.progress:
-            self.progress[key] = []
-        self.progress[key].append(value)
-
-        compare, _ = self.get_compare_goal()
-        if compare == key:
-            compare_vals = self.get_compare_vals()
-            best = self.get_best()
-            index = compare_vals.index(best)
-            if index == len(compare_vals) - 1:
-                # The new key and value is the current best
+        values = self.values.get(key)
+        if values is None:
+            self.values[key] = pack([value])
+        else:
+            self.values[key] = append(values, value)
+
+        if self.compare == key:
+            # Only a strict improvement is a new best, ties keep the first occurrence
+            if self.best_index is None or self.better(value, self.best):
+                self.best = value
+                self.best_index = len(self.values[key]) - 1
                 return True
 
         return False
 
 
     def save_progress(self, quick_send, folder):
-        quick_send.send(strings.vm_progress_report, json.dumps(self.progress), folder)
+        return quick_send.send(strings.vm_progress_report, json.dumps(self.get_progress()), folder)
 
     def get_progress(self):
-        return self.progress
+        progress = {
+            "goal": self.goal,
+            "compare": self.compare
+        }
+        for key, values in self.values.items():
+            progress[key] = values.tolist() if isinstance(values, array) else values
+        return progress
 
     def reset(self):
-        self.progress = {
-            "goal": "max",
-            "compare": "val_accuracy"
-        }
+        self.goal = "max"
+        self.compare = "val_accuracy"
+        self.values = {}
+        self.best = None
+        self.best_index = None
 
     def set_compare_goal(self, compare, goal):
-        self.progress["compare"] = compare
-        self.progress["goal"] = goal
+        self.compare = compare
+        self.goal = goal
+        self.find_best()
 
     def approximate_start_epoch(self):
-        dict_keys = list(self.progress.keys())
-        dict_keys.remove("compare")
-        dict_keys.remove("goal")
-        if len(dict_keys) == 0:
+        if len(self.values) == 0:
             return 0
-        return len(self.progress[dict_keys[0]])
+        return len(next(iter(self.values.values())))
 
     def start_epoch(self):
         epochs = "epochs"
-        if epochs in self.progress:
+        if epochs in self.values:
             # +1 since we have already completed the last epoch in the list
-            return self.progress[epochs][-1] + 1
+            return self.values[epochs][-1] + 1
         else:
             return self.approximate_start_epoch()
 
     def worse(self, val):
         best = self.get_best()
-        _, goal = self.get_compare_goal()
-        if goal == 'max':
+        if self.goal == 'max':
             if val > best:
                 return True
             else:
                 return False
-        if goal == 'min':
+        if self.goal == 'min':
             if val < best:
                 return True
             else:
                 return False
+
+
+def segment_name(start, end, compress):
+    return '%012d-%012d.json%s' % (start, end, '.gz' if compress else '')
+
+
+def parse_segment_name(name):
+    '''
+    :return: Offsets of the first and one past the last record in a segment
+    '''
+
+    start, end = os.path.basename(name).split('.')[0].split('-')
+    return int(start), int(end)
+
+
+def list_segments(bucket_name, folder):
+    '''
+    :return: List of (start, end, blob name) for every log segment of a folder, sorted by start
+    '''
+
+    prefix = os.path.join(folder, strings.progress_log) + '/'
+    segments = [parse_segment_name(blob.name) + (blob.name,) for blob in gcp.backend.list_blobs(bucket_name, prefix)]
+    segments.sort()
+    return segments
+
+
+def read_progress_log(bucket_name, folder, end=None):
+    '''
+    Rebuilds a Progress from the progress.json snapshot in folder and the log segments after it.
+    Without a log this is the same as reading progress.json.
+
+    :param bucket_name: Bucket name
+    :param folder: Cloud folder of the progress (ex: vm-progress/0)
+    :param end: Ignore records at or after this offset (ex: ones not committed by a checkpoint)
+    :return: The Progress and the offset of its last record plus one
+    '''
+
+    segments = list_segments(bucket_name, folder)
+    try:
+        snapshot = gcp.stream_download_json(bucket_name, os.path.join(folder, strings.vm_progress_report))
+    except Exception as err:
+        if not segments:
+            raise
+        snapshot = None
+
+    if snapshot is None:
+        progress = Progress()
+        offset = 0
+    else:
+        offset = snapshot.pop("log_offset", 0)
+        progress = Progress(progress=snapshot)
+
+    segments = [(start, seg_end, name) for start, seg_end, name in segments
+                if seg_end > offset and (end is None or start < end)]
+    data = {}
+    jobs = [(lambda name=name: data.__setitem__(name, gcp.stream_download_str(bucket_name, name)), 0)
+            for _, _, name in segments]
+    gcp.transfer_all(jobs)
+
+    for start, seg_end, name in segments:
+        if start > offset:
+            # A missing segment, the records after it cannot be placed
+            break
+        raw = data[name]
+        if name.endswith('.gz'):
+            raw = gzip.decompress(raw)
+        segment = json.loads(raw)
+        progress.set_compare_goal(segment["compare"], segment["goal"])
+        # Segments can overlap when a save was retried, records before offset are already applied
+        for key, value in segment["records"][offset - start:]:
+            if end is not None and offset >= end:
+                break
+            progress.add(key, value)
+            offset += 1
+    return progress, offset
+
+
+class ProgressLog:
+    '''
+    Append only cloud copy of a Progress in folder/progress-log.
+    Every save uploads only the records added since the last committed save as a new segment, named by the offsets
+    of its first and last records, so a segment that is uploaded twice or a save that is dropped does not lose or
+    repeat records. After max_segments segments, the whole progress is written to progress.json instead and
+    the older segments are deleted, which bounds the number of segments a reader downloads.
+    '''
+
+    def __init__(self, bucket_name, folder, compress=False, max_segments=32):
+        '''
+        :param compress: Gzip the segments
+        '''
+        self.bucket_name = bucket_name
+        self.folder = folder
+        self.compress = compress
+        self.max_segments = max_segments
+        # Saves run on the background checkpoint thread with async_save
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, offset=0, segments=0):
+        '''
+        :param offset: Number of records already in the cloud
+        :param segments: Number of segments after the snapshot in the cloud
+        '''
+        with self.lock:
+            # Records from offset base on, only the ones not compacted into a snapshot are kept
+            self.base = offset
+            self.records = []
+            self.committed = offset
+            self.segments = segments
+
+    def resume(self, end=None):
+        '''
+        Rebuilds the progress from the cloud and deletes segments with records after end, which were uploaded by
+        a checkpoint that was never committed.
+
+        :param end: Offset after the last committed record, every record is kept when None
+        :return: The rebuilt Progress
+        '''
+        progress, offset = read_progress_log(self.bucket_name, self.folder, end)
+        segments = list_segments(self.bucket_name, self.folder)
+        gcp.backend.delete_many(self.bucket_name, [name for _, seg_end, name in segments if seg_end > offset])
+        self.reset(offset, len([seg_end for _, seg_end, _ in segments if seg_end <= offset]))
+        return progress
+
+    def add(self, key, value):
+        with self.lock:
+            self.records.append([key, value])
+
+    def prepare(self, progress):
+        '''
+        Serializes the records that are not in the cloud yet. Nothing is uploaded until the returned functions run.
+
+        :param progress: The Progress the records were added to
+        :return: Dict of filename to a function that uploads it and returns its generation, the offset after
+            the last record, and a function to run once the checkpoint is committed
+        '''
+        with self.lock:
+            end = self.base + len(self.records)
+            start = self.committed
+            compact = self.segments >= self.max_segments
+
+            if compact:
+                snapshot = progress.get_progress()
+                snapshot["log_offset"] = end
+                msg = json.dumps(snapshot)
+                dest = os.path.join(self.folder, strings.vm_progress_report)
+                uploads = {strings.vm_progress_report: lambda: gcp.stream_upload_str(self.bucket_name, msg, dest)}
+            elif end > start:
+                segment = {
+                    "compare": progress.compare,
+                    "goal": progress.goal,
+                    "records": self.records[start - self.base:end - self.base]
+                }
+                data = json.dumps(segment).encode()
+                if self.compress:
+                    data = gzip.compress(data)
+                filename = os.path.join(strings.progress_log, segment_name(start, end, self.compress))
+                dest = os.path.join(self.folder, filename)
+                uploads = {filename: lambda: gcp.stream_upload_str(self.bucket_name, data, dest)}
+            else:
+                uploads = {}
+
+        def commit():
+            with self.lock:
+                if compact:
+                    if end > self.base:
+                        self.records = self.records[end - self.base:]
+                        self.base = end
+                    self.segments = 0
+                elif end > self.committed:
+                    self.segments += 1
+                self.committed = max(self.committed, end)
+            if compact:
+                old = [name for _, seg_end, name in list_segments(self.bucket_name, self.folder) if seg_end <= end]
+                gcp.backend.delete_many(self.bucket_name, old)
+
+        return uploads, end, commit
+
+    def clear(self):
+        '''
+        Deletes the snapshot and every segment in the cloud and starts a new log
+        '''
+        names = [name for _, _, name in list_segments(self.bucket_name, self.folder)]
+        names.append(os.path.join(self.folder, strings.vm_progress_report))
+        gcp.backend.delete_many(self.bucket_name, names)
+        self.reset()
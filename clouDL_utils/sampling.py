@@ -0,0 +1,187 @@
+import random
+import math
+
+# Joe and Kuo direction numbers (new-joe-kuo-6.21201) for the Sobol dimensions after the first:
+# degree s of the primitive polynomial, its inner coefficients a, and the initial direction numbers m
+SOBOL_DIRECTIONS = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+    (6, 19, [1, 1, 1, 15, 7, 5]),
+    (6, 22, [1, 3, 1, 15, 13, 25]),
+    (6, 25, [1, 1, 5, 5, 19, 61]),
+    (7, 1, [1, 3, 7, 11, 23, 15, 103]),
+    (7, 4, [1, 3, 7, 13, 13, 15, 69])
+]
+SOBOL_BITS = 32
+MAX_SOBOL_DIMS = len(SOBOL_DIRECTIONS) + 1
+
+_directions_cache = {}
+
+
+def sobol_directions(dim):
+    '''
+    :return: The SOBOL_BITS direction numbers of a Sobol dimension, scaled to SOBOL_BITS bits
+    '''
+
+    if dim in _directions_cache:
+        return _directions_cache[dim]
+
+    if dim == 0:
+        m = [1] * SOBOL_BITS
+    else:
+        s, a, m = SOBOL_DIRECTIONS[dim - 1]
+        m = list(m)
+        for k in range(s, SOBOL_BITS):
+            value = m[k - s] ^ (m[k - s] << s)
+            for i in range(1, s):
+                if (a >> (s - 1 - i)) & 1:
+                    value ^= m[k - i] << i
+            m.append(value)
+    _directions_cache[dim] = [m[k] << (SOBOL_BITS - 1 - k) for k in range(SOBOL_BITS)]
+    return _directions_cache[dim]
+
+
+def sobol_point(index, dims):
+    '''
+    Point index of the Sobol sequence in Gray code order, any point can be computed without the ones before it.
+
+    :param index: Index of the point, 0 is the corner at the origin
+    :param dims: Number of dimensions, at most MAX_SOBOL_DIMS
+    :return: List of dims floats in [0, 1)
+    '''
+
+    if dims > MAX_SOBOL_DIMS:
+        raise ValueError("Sobol sampling supports at most %d hyperparameters" % MAX_SOBOL_DIMS)
+
+    gray = index ^ (index >> 1)
+    point = []
+    for dim in range(dims):
+        directions = sobol_directions(dim)
+        x = 0
+        bit = 0
+        while gray >> bit:
+            if (gray >> bit) & 1:
+                x ^= directions[bit]
+            bit += 1
+        point.append(x / 2 ** SOBOL_BITS)
+    return point
+
+
+def latin_hypercube_point(index, dims, budget, seed=0):
+    '''
+    Point index of a Latin hypercube of budget points: every dimension is split into budget equal strata and
+    each stratum is used by exactly one of the points. Points past the budget start a new hypercube.
+    All points come from random generators seeded by seed, so every VM computes the same hypercube.
+
+    :param index: Index of the point
+    :param dims: Number of dimensions
+    :param budget: Number of points in a hypercube
+    :param seed: Seed of the hypercube
+    :return: List of dims floats in [0, 1)
+    '''
+
+    block, index = divmod(index, budget)
+    point = []
+    for dim in range(dims):
+        rand = random.Random('%s-%d-%d' % (seed, block, dim))
+        strata = list(range(budget))
+        rand.shuffle(strata)
+        jitter = [rand.random() for _ in range(budget)]
+        point.append((strata[index] + jitter[index]) / budget)
+    return point
+
+
+def scale(u, low, high, log=False):
+    '''
+    Maps u in [0, 1) onto [low, high), evenly in log space when log is set
+    '''
+
+    if log:
+        return math.exp(math.log(low) + u * (math.log(high) - math.log(low)))
+    return low + u * (high - low)
+
+
+def _parzen(u, centers, bandwidth):
+    '''
+    Density at u of a mixture of gaussians at centers plus one uniform component over [0, 1)
+    '''
+
+    density = 1.0
+    for center in centers:
+        density += math.exp(-0.5 * ((u - center) / bandwidth) ** 2) / (bandwidth * math.sqrt(2 * math.pi))
+    return density / (len(centers) + 1)
+
+
+def _bandwidth(centers, dims):
+    # Scott's rule, kept wide enough that a few close trials do not collapse the search
+    if len(centers) < 2:
+        return 0.25
+    mean = sum(centers) / len(centers)
+    std = math.sqrt(sum((center - mean) ** 2 for center in centers) / len(centers))
+    return min(max(1.06 * std * len(centers) ** (-1 / (dims + 4)), 0.05), 0.5)
+
+
+def tpe_point(observed, dims, rand, gamma=0.25, candidates=24):
+    '''
+    Proposes the next point with a tree-structured Parzen estimator.
+    The observed points are split into the best gamma fraction and the rest, each dimension of both groups is
+    modelled with a Parzen estimator, and the candidate drawn around the good points with the highest
+    good to rest density ratio is returned.
+
+    :param observed: List of (point in the unit cube, score) where a higher score is better
+    :param dims: Number of dimensions
+    :param rand: random.Random used to draw the candidates
+    :param gamma: Fraction of the observed points that count as good
+    :param candidates: Number of candidates drawn
+    :return: List of dims floats in [0, 1)
+    '''
+
+    ranked = sorted(observed, key=lambda item: item[1], reverse=True)
+    n_good = max(1, int(math.ceil(gamma * len(ranked))))
+    good = [point for point, _ in ranked[:n_good]]
+    rest = [point for point, _ in ranked[n_good:]]
+
+    good_bandwidths = [_bandwidth([point[dim] for point in good], dims) for dim in range(dims)]
+    rest_bandwidths = [_bandwidth([point[dim] for point in rest], dims) for dim in range(dims)]
+
+    best_point = None
+    best_ratio = None
+    for _ in range(candidates):
+        center = rand.choice(good)
+        point = []
+        for dim in range(dims):
+            # Reflected at the bounds so the candidate stays in the unit cube
+            u = abs(rand.gauss(center[dim], good_bandwidths[dim])) % 2
+            point.append(min(2 - u if u > 1 else u, 1 - 1e-12))
+
+        ratio = 0
+        for dim in range(dims):
+            ratio += math.log(_parzen(point[dim], [p[dim] for p in good], good_bandwidths[dim]))
+            ratio -= math.log(_parzen(point[dim], [p[dim] for p in rest], rest_bandwidths[dim]))
+        if best_ratio is None or ratio > best_ratio:
+            best_point = point
+            best_ratio = ratio
+    return best_point
+
+
+def unscale(value, low, high, log=False):
+    '''
+    Inverse of scale, maps value in [low, high] back into [0, 1]
+    '''
+
+    if log:
+        return (math.log(value) - math.log(low)) / (math.log(high) - math.log(low))
+    return (value - low) / (high - low)
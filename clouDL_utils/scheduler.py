@@ -0,0 +1,120 @@
+import json
+import os
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils import strings
+
+
+def rung_epochs(min_epochs, max_epochs, reduction, bracket=0):
+    '''
+    :return: Epochs at which a trial of the bracket is compared, min_epochs * reduction^(bracket + k) below max_epochs
+    '''
+
+    rungs = []
+    epochs = min_epochs * reduction ** bracket
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= reduction
+    return rungs
+
+
+def cutoff(scores, reduction):
+    '''
+    :return: Lowest score in the top 1 / reduction of scores (linear interpolation between scores)
+    '''
+
+    scores = sorted(scores)
+    position = (len(scores) - 1) * (1 - 1 / reduction)
+    low = int(position)
+    high = min(low + 1, len(scores) - 1)
+    return scores[low] + (scores[high] - scores[low]) * (position - low)
+
+
+def keep_going(score, recorded, reduction):
+    '''
+    :param score: Score of the trial at a rung, higher is better
+    :param recorded: Scores of every trial that reached the rung, including this one
+    :param reduction: Only the top 1 / reduction of the trials continue
+    :return: True if the trial continues past the rung
+    '''
+
+    return score >= cutoff(recorded, reduction)
+
+
+class SuccessiveHalving:
+    '''
+    Asynchronous successive halving shared by every VM through the bucket, no VM ever waits for another.
+
+    A trial is compared at its rungs (ex: epochs 1, 3, and 9 with min_epochs 1 and reduction 3).
+    At each rung it records its best score so far in rungs/<bracket>/<epochs>/<trial id>.json and continues only
+    if that score is in the top 1 / reduction of every score recorded at the rung so far, across all VMs.
+
+    With brackets > 1 this is Hyperband: trials are spread over the brackets in turn, and every bracket starts
+    comparing reduction times later than the one before, which protects slow starting configurations.
+    '''
+
+    def __init__(self, bucket_name, min_epochs, max_epochs, reduction=3, brackets=1):
+        '''
+        :param min_epochs: Epochs before the first comparison
+        :param max_epochs: Epochs of a trial that is never stopped
+        :param reduction: Only 1 / reduction of the trials continue at each rung
+        :param brackets: Number of Hyperband brackets
+        '''
+        if reduction < 2:
+            raise ValueError("The reduction has to be at least 2")
+
+        self.bucket_name = bucket_name
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.reduction = reduction
+        self.brackets = brackets
+        # Blob name to score of every rung record read so far, records are never changed once written
+        self.scores = {}
+
+    @staticmethod
+    def from_hyparams(bucket_name, raw_hyparams):
+        '''
+        :return: The scheduler set by the "scheduler" section of the hyperparameters, None when there is none
+        '''
+        configs = raw_hyparams.get("scheduler")
+        if not configs:
+            return None
+        return SuccessiveHalving(bucket_name, configs.get("min_epochs", 1), configs["max_epochs"],
+                                 configs.get("reduction", 3), configs.get("brackets", 1))
+
+    def bracket(self, trial_index):
+        return trial_index % self.brackets
+
+    def rungs(self, trial_index):
+        return rung_epochs(self.min_epochs, self.max_epochs, self.reduction, self.bracket(trial_index))
+
+    def recorded_scores(self, folder):
+        prefix = folder + '/'
+        names = [blob.name for blob in gcp.backend.list_blobs(self.bucket_name, prefix)]
+        new = [name for name in names if name not in self.scores]
+        jobs = [(lambda name=name: self.scores.__setitem__(
+            name, gcp.stream_download_json(self.bucket_name, name)["score"]), 0) for name in new]
+        gcp.transfer_all(jobs)
+        return [self.scores[name] for name in names]
+
+    def should_stop(self, trial_id, trial_index, epochs, progress):
+        '''
+        :param trial_id: Unique name of the trial
+        :param trial_index: Index of the trial in the cluster, picks its bracket
+        :param epochs: Number of epochs the trial has completed
+        :param progress: Progress of the trial
+        :return: True if the trial should stop
+        '''
+        if epochs not in self.rungs(trial_index):
+            return False
+
+        score = progress.get_best()
+        if progress.get_compare_goal()[1] == "min":
+            score = -score
+
+        folder = os.path.join(strings.rungs, str(self.bracket(trial_index)), str(epochs))
+        dest = os.path.join(folder, trial_id + '.json')
+        gcp.stream_upload_str(self.bucket_name, json.dumps({"score": score}), dest)
+        self.scores[dest] = score
+
+        return not keep_going(score, self.recorded_scores(folder), self.reduction)
@@ -8,6 +8,12 @@ results = "results"
 shared_errors = "shared-errors"
 secrets = "secrets"
 archive = "archive"
+moves = "moves"
+progress_log = "progress-log"
+tensors = "tensors"
+rungs = "rungs"
+queue = "queue"
+heartbeats = "heartbeats"
 
 # Google cloud storage file names
 vm_hyparams_report = "hyperparameters.json"
@@ -16,6 +22,7 @@ params_file = "params.pt"
 best_params_file = "best-params.pt"
 cluster_error = "cluster-startup-err.json"
 meta = "meta.json"
+checkpoint_marker = "checkpoint.json"
 
 # Local folder names
 user_files = "user_files"
@@ -25,4 +32,5 @@ user_configs = "configs.json"
 user_hyperparameters = "hyperparameters.json"
 user_start_up = "user_startup.sh"
 user_access_token = "access_token"
-user_quick_start = "quick_start.sh"
\ No newline at end of file
+user_quick_start = "quick_start.sh"
+trials_cache = "trials.json"
\ No newline at end of file
@@ -0,0 +1,168 @@
+import time
+import os
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils import strings
+
+
+def heartbeat_rank(name):
+    '''
+    :param name: Heartbeat file name (ex: 3.json, or 3-1.json for slot 1 of rank 3)
+    :return: Rank of the VM that wrote it
+    '''
+    return int(os.path.basename(name).split('.')[0].split('-')[0])
+
+
+class Supervisor:
+    '''
+    Watches the heartbeats every Manager writes to heartbeats/ and re-creates the VM of a rank whose heartbeats
+    stopped (ex: preempted, failed to start, or hung). The new VM resumes from the checkpoints in vm-progress/<rank>.
+    Ranks whose last heartbeat says they are done are left alone, and supervising stops once every rank is done.
+    The time to recover of a rank is from its last heartbeat before it was lost to the first one of its new VM.
+    '''
+
+    def __init__(self, project_id, bucket_name, workers, machine_configs, startup_script, stale_seconds=1800,
+                 poll_seconds=60):
+        '''
+        :param workers: Number of ranks in the cluster
+        :param machine_configs: Dict of the machine configs used to build the cluster
+        :param startup_script: Startup script of the VMs
+        :param stale_seconds: A rank without a heartbeat for this long (or since it was created) is re-created
+        :param poll_seconds: Seconds between checks
+        '''
+        self.project_id = project_id
+        self.bucket_name = bucket_name
+        self.workers = workers
+        self.machine_configs = machine_configs
+        self.startup_script = startup_script
+        self.stale_seconds = stale_seconds
+        self.poll_seconds = poll_seconds
+
+        # Ranks without heartbeats are only stale once they had stale_seconds to start
+        self.started = time.time()
+        # Rank to the time its VM was last re-created
+        self.created = {}
+        # Rank to the time of the last heartbeat before it was lost, until its new VM sends one
+        self.lost = {}
+        self.recoveries = []
+        # Heartbeat name to (generation, heartbeat) so unchanged heartbeats are not downloaded again
+        self.cache = {}
+
+    def read_heartbeats(self):
+        '''
+        :return: Dict of rank to the time of its latest heartbeat and whether it is done. A rank with parallel
+            slots is only done when its own heartbeat (not the one of a slot) says so
+        '''
+        latest = {}
+        for blob in gcp.backend.list_blobs(self.bucket_name, strings.heartbeats + '/'):
+            cached = self.cache.get(blob.name)
+            if cached is None or cached[0] != blob.generation:
+                try:
+                    cached = (blob.generation, gcp.stream_download_json(self.bucket_name, blob.name))
+                except Exception:
+                    # Being rewritten
+                    continue
+                self.cache[blob.name] = cached
+            heartbeat = cached[1]
+            rank = heartbeat_rank(blob.name)
+            rank_heartbeat = latest.setdefault(rank, {"time": 0, "done": False})
+            rank_heartbeat["time"] = max(rank_heartbeat["time"], heartbeat["time"])
+            if os.path.basename(blob.name) == '%d.json' % rank:
+                rank_heartbeat["done"] = heartbeat.get("done", False)
+        return latest
+
+    def stale_ranks(self, heartbeats, now):
+        '''
+        :return: Ranks that are not done and did not send a heartbeat in stale_seconds
+        '''
+        stale = []
+        for rank in range(self.workers):
+            heartbeat = heartbeats.get(rank)
+            if heartbeat is not None and heartbeat.get("done"):
+                continue
+            last = max(heartbeat["time"] if heartbeat else self.started, self.created.get(rank, 0))
+            if now - last > self.stale_seconds:
+                stale.append(rank)
+        return stale
+
+    def find_instance(self, name):
+        '''
+        :return: (zone, instance) of the VM with this name, (None, None) if it does not exist
+        '''
+        for zone in self.machine_configs['zones']:
+            for instance in gcp.list_instances(self.project_id, zone) or []:
+                if instance['name'] == name:
+                    return zone, instance
+        return None, None
+
+    def respawn(self, rank):
+        '''
+        Deletes the VM of the rank if it still exists (ex: stopped after a preemption, or hung),
+        then creates it again, trying the zone it was in first.
+
+        :return: True if the VM was created
+        '''
+        name = self.machine_configs["name_prefix"] + ("-%d" % rank)
+        zone, instance = self.find_instance(name)
+        zones = list(self.machine_configs['zones'])
+        if instance is not None:
+            print('Deleting %s (%s) in zone %s' % (name, instance.get('status'), zone))
+            operation = gcp.delete_instance(self.project_id, zone, name)
+            gcp.wait_for_operation(self.project_id, operation['name'], zone)
+            zones.remove(zone)
+            zones.insert(0, zone)
+
+        for zone in zones:
+            try:
+                operation = gcp.create_instance(self.project_id, self.machine_configs, self.startup_script,
+                                                zone, rank, self.bucket_name)
+                if gcp.wait_for_operation(self.project_id, operation['name'], zone):
+                    print('Re-created %s in zone %s' % (name, zone))
+                    return True
+            except Exception as err:
+                print('Could not create %s in zone %s: %s' % (name, zone, err))
+        return False
+
+    def check(self, now=None):
+        '''
+        Records the ranks that recovered and re-creates the ranks that are stale.
+
+        :return: False once every rank is done, True otherwise
+        '''
+        now = now or time.time()
+        heartbeats = self.read_heartbeats()
+
+        for rank, lost_since in list(self.lost.items()):
+            heartbeat = heartbeats.get(rank)
+            if heartbeat is not None and heartbeat["time"] > self.created[rank]:
+                recover_seconds = heartbeat["time"] - lost_since
+                self.recoveries.append((rank, recover_seconds))
+                del self.lost[rank]
+                print('Rank %d recovered in %.0fs' % (rank, recover_seconds))
+
+        for rank in self.stale_ranks(heartbeats, now):
+            if rank not in self.lost:
+                heartbeat = heartbeats.get(rank)
+                self.lost[rank] = heartbeat["time"] if heartbeat else self.created.get(rank, self.started)
+            print('Rank %d has no heartbeat since %s' % (rank, time.strftime("%m/%d/%Y-%H:%M:%S",
+                                                                             time.localtime(self.lost[rank]))))
+            # Tried again after stale_seconds when the VM could not be created or does not come up
+            self.created[rank] = time.time()
+            self.respawn(rank)
+
+        return any(not heartbeats.get(rank, {}).get("done") for rank in range(self.workers))
+
+    def run(self):
+        while self.check():
+            time.sleep(self.poll_seconds)
+        print('Every rank is done')
+        self.report()
+
+    def report(self):
+        if not self.recoveries:
+            print('No rank had to be recovered')
+            return
+        for rank, recover_seconds in self.recoveries:
+            print('Rank %d: recovered in %.0fs' % (rank, recover_seconds))
+        mean = sum(seconds for _, seconds in self.recoveries) / len(self.recoveries)
+        print('%d recoveries, %.0fs to recover on average' % (len(self.recoveries), mean))
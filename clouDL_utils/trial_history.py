@@ -0,0 +1,110 @@
+import json
+import os
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils.progress import Progress
+from clouDL_utils import strings
+
+
+class TrialHistory:
+    '''
+    Hyperparameters and best score of every finished trial in results and archive/results.
+
+    The trials are kept in a local json cache along with the generation of the result file they came from,
+    so a refresh only lists the bucket and downloads the results that are new since the last refresh.
+    Archiving moves a result without changing its file name, so moved results are not downloaded again.
+    '''
+
+    def __init__(self, bucket_name, cache_path=None):
+        '''
+        :param cache_path: Local file of the cache, the cache is only kept in memory when None
+        '''
+        self.bucket_name = bucket_name
+        self.cache_path = cache_path
+        # File name of a result to its blob name, generation, and trial (None if it has no score)
+        self.trials = {}
+
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                with open(cache_path) as f:
+                    self.trials = json.load(f)
+            except ValueError:
+                print('Ignoring the unreadable trial cache %s' % cache_path)
+
+    def refresh(self):
+        '''
+        Downloads the results that are not in the cache yet
+
+        :return: Number of results downloaded
+        '''
+        blobs = []
+        for folder in [strings.results, os.path.join(strings.archive, strings.results)]:
+            blobs.extend(gcp.backend.list_blobs(self.bucket_name, folder + '/'))
+
+        listed = {}
+        downloads = []
+        changed = False
+        for blob in blobs:
+            filename = os.path.basename(blob.name)
+            if not filename.endswith('.json'):
+                continue
+            listed[filename] = blob.name
+            cached = self.trials.get(filename)
+            if cached is None:
+                downloads.append(blob)
+            elif cached["name"] != blob.name:
+                # Moved by an archive, the content is the same
+                cached["name"] = blob.name
+                cached["generation"] = blob.generation
+                changed = True
+            elif cached["generation"] != blob.generation:
+                downloads.append(blob)
+
+        results = {}
+        jobs = [(lambda blob=blob: results.__setitem__(blob, gcp.stream_download_json(self.bucket_name, blob.name)),
+                 blob.size or 0) for blob in downloads]
+        gcp.transfer_all(jobs)
+
+        for blob, result in results.items():
+            self.trials[os.path.basename(blob.name)] = {
+                "name": blob.name,
+                "generation": blob.generation,
+                "trial": TrialHistory.parse(result)
+            }
+        # Results deleted from the bucket are dropped
+        for filename in list(self.trials):
+            if filename not in listed:
+                del self.trials[filename]
+                changed = True
+
+        if self.cache_path and (downloads or changed):
+            self.save()
+        return len(downloads)
+
+    def save(self):
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.trials, f)
+        os.replace(tmp_path, self.cache_path)
+
+    @staticmethod
+    def parse(result):
+        '''
+        :param result: Result json written by Manager.save_results
+        :return: Dict with the hyperparameter values, best score, and goal of the trial, None if it has no score
+        '''
+        try:
+            progress = Progress(progress=result["progress"])
+            return {
+                "values": result["hyperparameters"]["current_values"],
+                "score": progress.get_best(),
+                "goal": progress.get_compare_goal()[1]
+            }
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def get_trials(self):
+        '''
+        :return: List of dicts with the hyperparameter values, best score, and goal of every finished trial
+        '''
+        return [cached["trial"] for cached in self.trials.values() if cached["trial"] is not None]
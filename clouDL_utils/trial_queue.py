@@ -0,0 +1,208 @@
+import threading
+import socket
+import json
+import time
+import uuid
+import os
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils.backends import PreconditionFailed
+from clouDL_utils import strings
+
+
+class LeaseLost(Exception):
+    '''
+    Raised in the trial of a worker whose lease was taken over by another worker
+    '''
+
+
+def trial_path(trial_id):
+    return '%s/trials/%s.json' % (strings.queue, trial_id)
+
+
+def lease_path(trial_id):
+    return '%s/leases/%s.json' % (strings.queue, trial_id)
+
+
+def done_path(trial_id):
+    return '%s/done/%s.json' % (strings.queue, trial_id)
+
+
+def trial_ids(bucket_name, folder):
+    '''
+    :return: Dict of trial id to blob for the blobs in queue/<folder>
+    '''
+    blobs = gcp.backend.list_blobs(bucket_name, '%s/%s/' % (strings.queue, folder))
+    return {os.path.basename(blob.name)[:-len('.json')]: blob for blob in blobs if blob.name.endswith('.json')}
+
+
+class TrialQueue:
+    '''
+    Queue of trials kept in the bucket, so every worker takes the next trial as soon as it is free.
+    Trials are hyperparameter files in queue/trials. A worker claims a trial by creating its lease in queue/leases
+    with a conditional write, so only one worker gets it, and keeps renewing the lease while training.
+    A lease that is not renewed in time (ex: the VM was preempted) expires and the trial is claimed again,
+    resuming from its checkpoint. Finished trials get a marker in queue/done.
+    '''
+
+    def __init__(self, bucket_name, lease_seconds=300, worker=None):
+        '''
+        :param lease_seconds: Time a lease lasts without being renewed
+        :param worker: Name of this worker in the leases, defaults to the host name and process id
+        '''
+        self.bucket_name = bucket_name
+        self.lease_seconds = lease_seconds
+        self.worker = worker or '%s-%d-%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        # Trials that were not done on the last claim
+        self.pending = None
+
+    @staticmethod
+    def fill(bucket_name, trials):
+        '''
+        Adds trials to the queue. Trials are taken in the order of their ids.
+
+        :param trials: Dict of trial id to its hyperparameters
+        :return: TransferStats of the uploads
+        '''
+        jobs = []
+        for trial_id, hyparams in trials.items():
+            msg = json.dumps(hyparams)
+            jobs.append((lambda msg=msg, trial_id=trial_id: gcp.stream_upload_str(bucket_name, msg,
+                                                                                    trial_path(trial_id)), len(msg)))
+        return gcp.transfer_all(jobs)
+
+    @staticmethod
+    def exists(bucket_name):
+        return len(trial_ids(bucket_name, 'trials')) > 0
+
+    def lease_msg(self):
+        return json.dumps({"worker": self.worker, "expires": time.time() + self.lease_seconds})
+
+    def claim(self):
+        '''
+        Claims the first trial that is neither done nor leased, or whose lease expired.
+
+        :return: Lease of the claimed trial, None if every trial is done or leased
+        '''
+        # Done markers are listed before leases since a finished trial writes its marker before deleting its lease
+        done = trial_ids(self.bucket_name, 'done')
+        leases = trial_ids(self.bucket_name, 'leases')
+        trials = [trial_id for trial_id in sorted(trial_ids(self.bucket_name, 'trials')) if trial_id not in done]
+        self.pending = len(trials)
+
+        for trial_id in trials:
+            generation = 0
+            if trial_id in leases:
+                try:
+                    lease = gcp.stream_download_json(self.bucket_name, lease_path(trial_id))
+                except Exception:
+                    # Released since the listing, most likely because it is done
+                    continue
+                if lease["expires"] > time.time():
+                    continue
+                generation = leases[trial_id].generation
+
+            try:
+                generation = gcp.backend.upload_str(self.bucket_name, self.lease_msg(), lease_path(trial_id),
+                                                    if_generation_match=generation)
+            except PreconditionFailed:
+                # Another worker claimed or renewed it first
+                continue
+
+            if gcp.stat_blob(self.bucket_name, done_path(trial_id)) is not None:
+                # Finished between the listing and the claim
+                self.release(trial_id, generation)
+                continue
+
+            hyparams = gcp.stream_download_json(self.bucket_name, trial_path(trial_id))
+            return Lease(self, trial_id, generation, hyparams, reclaimed=trial_id in leases)
+        return None
+
+    def next(self, poll_seconds=30):
+        '''
+        Claims the next trial, waiting for leases to expire while every trial that is not done is leased.
+
+        :return: Lease of the claimed trial, None once every trial is done
+        '''
+        while True:
+            lease = self.claim()
+            if lease is not None or self.pending == 0:
+                return lease
+            time.sleep(min(poll_seconds, self.lease_seconds))
+
+    def renew(self, trial_id, generation):
+        '''
+        :return: Generation of the renewed lease
+        :raises LeaseLost: When another worker took over the lease
+        '''
+        try:
+            return gcp.backend.upload_str(self.bucket_name, self.lease_msg(), lease_path(trial_id),
+                                          if_generation_match=generation)
+        except PreconditionFailed as err:
+            raise LeaseLost(trial_id) from err
+
+    def release(self, trial_id, generation):
+        try:
+            gcp.backend.delete(self.bucket_name, lease_path(trial_id), if_generation_match=generation)
+        except (PreconditionFailed, FileNotFoundError):
+            # Someone else holds it now
+            pass
+
+    def complete(self, trial_id, generation):
+        msg = json.dumps({"worker": self.worker, "time": time.strftime("%m/%d/%Y-%H:%M:%S")})
+        gcp.stream_upload_str(self.bucket_name, msg, done_path(trial_id))
+        self.release(trial_id, generation)
+
+
+class Lease:
+    '''
+    Lease of a claimed trial, renewed on a background thread between start and stop
+    '''
+
+    def __init__(self, queue, trial_id, generation, hyparams, reclaimed=False):
+        '''
+        :param hyparams: Hyperparameters of the trial
+        :param reclaimed: True if the trial was claimed from an expired lease, so it may have a checkpoint
+        '''
+        self.queue = queue
+        self.trial_id = trial_id
+        self.generation = generation
+        self.hyparams = hyparams
+        self.reclaimed = reclaimed
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.keep, daemon=True)
+        self.thread.start()
+
+    def keep(self):
+        # Renewing three times per lease leaves room for a slow or failed renewal
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            try:
+                self.generation = self.queue.renew(self.trial_id, self.generation)
+            except LeaseLost:
+                print('Lost the lease of trial %s' % self.trial_id)
+                self.lost = True
+                return
+            except Exception as err:
+                print('Could not renew the lease of trial %s: %s' % (self.trial_id, err))
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def check(self):
+        '''
+        :raises LeaseLost: When another worker took over the trial, so this worker must not write to it anymore
+        '''
+        if self.lost:
+            raise LeaseLost(self.trial_id)
+
+    def complete(self):
+        self.stop()
+        self.queue.complete(self.trial_id, self.generation)
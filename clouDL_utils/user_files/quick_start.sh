@@ -40,6 +40,12 @@ elif [ "$MODE" = "manual" ]; then
     --hyparams $BASE/hyperparameters.json \
     --location us-central1
 
+elif [ "$MODE" = "supervise" ]; then
+
+  clouDL $PROJECT_ID \
+    $BUCKET_NAME \
+    --supervise $WORKERS $BASE/configs.json $BASE/user_startup.sh
+
 elif [ "$MODE" = "analyze" ]; then
 
   clouDL_analyze $PROJECT_ID-$BUCKET_NAME \
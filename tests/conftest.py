@@ -0,0 +1,13 @@
+import pytest
+
+from clouDL_utils import gcp_interactions as gcp
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    '''
+    Bucket kept in a local folder
+    '''
+    gcp.set_storage('local', str(tmp_path / 'buckets'))
+    gcp.make_bucket('bucket', None)
+    return 'bucket'
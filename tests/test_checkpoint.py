@@ -0,0 +1,89 @@
+import os
+import time
+
+import pytest
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils.checkpoint import CheckpointIO, collect_tensor_garbage
+
+torch = pytest.importorskip('torch')
+
+
+def test_load_after_save_with_codec(bucket, tmp_path):
+    temp_path = str(tmp_path / 'temp')
+    os.mkdir(temp_path)
+    state = {'weight': torch.ones(4), 'bias': torch.zeros(2)}
+
+    checkpoint_io = CheckpointIO(bucket, temp_path, torch, codec='zlib')
+    checkpoint_io.save(state, 'vm-progress/0', 'params.pt')
+
+    # Read back from the local copy the save left in temp_path
+    loaded = checkpoint_io.load('vm-progress/0', 'params.pt', 'zlib')
+    assert torch.equal(loaded['weight'], state['weight'])
+    assert torch.equal(loaded['bias'], state['bias'])
+
+    # And from the cloud, where it is compressed
+    os.remove(os.path.join(temp_path, 'params.pt'))
+    loaded = checkpoint_io.load('vm-progress/0', 'params.pt', 'zlib')
+    assert torch.equal(loaded['weight'], state['weight'])
+
+
+@pytest.mark.parametrize('options', [
+    {'stream': True},
+    {'stream': True, 'codec': 'zlib'},
+    {'delta': True},
+    {'delta': True, 'stream': True},
+    {'shard_size': 8},
+    {'shard_size': 8, 'stream': True, 'codec': 'zlib'}
+])
+def test_load_after_save(bucket, tmp_path, options):
+    temp_path = str(tmp_path / 'temp')
+    os.mkdir(temp_path)
+    state = {'weight': torch.ones(4), 'bias': torch.zeros(2), 'steps': 3}
+
+    CheckpointIO(bucket, temp_path, torch, **options).save(state, 'vm-progress/0', 'params.pt')
+
+    # A new CheckpointIO, like a restarted VM, with nothing left in temp_path
+    fresh_path = str(tmp_path / 'fresh')
+    os.mkdir(fresh_path)
+    loaded = CheckpointIO(bucket, fresh_path, torch, **options).load('vm-progress/0', 'params.pt',
+                                                                     options.get('codec'))
+    assert list(loaded.keys()) == ['weight', 'bias', 'steps']
+    assert torch.equal(loaded['weight'], state['weight'])
+    assert torch.equal(loaded['bias'], state['bias'])
+    assert loaded['steps'] == 3
+
+
+def test_delta_save_after_tensor_garbage_collection(bucket, tmp_path):
+    temp_path = str(tmp_path / 'temp')
+    os.mkdir(temp_path)
+    state = {'weight': torch.ones(4)}
+    checkpoint_io = CheckpointIO(bucket, temp_path, torch, delta=True)
+
+    checkpoint_io.save(state, 'vm-progress/0', 'params.pt')
+    # The trial is reset, so no manifest points at its tensors anymore
+    gcp.backend.delete(bucket, 'vm-progress/0/params.pt')
+    assert collect_tensor_garbage(bucket, grace_seconds=0).files == 2
+
+    # The same tensor (ex: the init weights of the next trial) has to be uploaded again
+    checkpoint_io.save(state, 'vm-progress/0', 'params.pt')
+    loaded = CheckpointIO(bucket, temp_path, torch, delta=True).load('vm-progress/0', 'params.pt')
+    assert torch.equal(loaded['weight'], state['weight'])
+
+
+def test_tensor_garbage_collection_waits_for_saving_vms(bucket, tmp_path):
+    temp_path = str(tmp_path / 'temp')
+    os.mkdir(temp_path)
+    CheckpointIO(bucket, temp_path, torch, delta=True).save({'weight': torch.ones(4)}, 'vm-progress/0', 'params.pt')
+    gcp.backend.delete(bucket, 'vm-progress/0/params.pt')
+    # Tensors uploaded two hours ago
+    old = time.time() - 7200
+    for blob in gcp.backend.list_blobs(bucket, 'tensors/'):
+        os.utime(gcp.backend.path(bucket, blob.name), (old, old))
+
+    gcp.stream_upload_str(bucket, '{}', 'vm-progress/1/checkpoint.json')
+    assert collect_tensor_garbage(bucket, grace_seconds=3600).files == 0
+    assert len(list(gcp.backend.list_blobs(bucket, 'tensors/'))) == 2
+
+    gcp.backend.delete(bucket, 'vm-progress/1/checkpoint.json')
+    assert collect_tensor_garbage(bucket, grace_seconds=3600).files == 2
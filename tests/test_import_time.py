@@ -0,0 +1,36 @@
+import subprocess
+import json
+import sys
+import os
+
+# Seconds the Manager import may take in a fresh interpreter
+BUDGET = 0.3
+
+# Libraries that must only be imported on first use
+HEAVY_MODULES = ['torch', 'google.cloud', 'google.cloud.storage', 'googleapiclient', 'matplotlib', 'requests',
+                 'pkg_resources']
+
+MEASURE = '''
+import json
+import time
+import sys
+start = time.perf_counter()
+from clouDL.manager import Manager
+secs = time.perf_counter() - start
+print(json.dumps({"secs": secs, "loaded": [m for m in %r if m in sys.modules]}))
+''' % HEAVY_MODULES
+
+
+def measure():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', MEASURE], cwd=root)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def test_manager_import_is_light():
+    # The fastest of a few fresh interpreters, to keep noise out of the budget
+    runs = [measure() for _ in range(3)]
+    fastest = min(runs, key=lambda run: run["secs"])
+
+    assert fastest["loaded"] == []
+    assert fastest["secs"] < BUDGET, 'from clouDL.manager import Manager took %.3fs' % fastest["secs"]
@@ -0,0 +1,171 @@
+import http.server
+import functools
+import threading
+import json
+import os
+
+import pytest
+
+from clouDL_utils import gcp_interactions as gcp
+from clouDL_utils import preemption
+from clouDL_utils.checkpoint import CheckpointOptions
+from clouDL.manager import Manager
+
+torch = pytest.importorskip('torch')
+
+
+class Model:
+    def __init__(self):
+        self.weight = torch.zeros(2)
+
+    def state_dict(self):
+        return {'weight': self.weight}
+
+    def load_state_dict(self, state):
+        self.weight = state['weight']
+
+
+def run(manager, param_pth, best_param_pth):
+    model = Model()
+    manager.track_model(model)
+    manager.set_compare_goal('acc', 'max')
+    for epoch in range(manager.start_epoch(), 2):
+        manager.add_progress('epochs', epoch)
+        manager.add_progress('acc', manager.get_hyparams()['LR'])
+        manager.save_progress()
+    manager.finished()
+
+
+def test_parallel_search_with_async_save(bucket, tmp_path):
+    hyparams = {
+        "hyperparameters": {"LR": {"method": "list", "data": [1, 2, 3, 4]}},
+        "current_iter": 0,
+        "max_iter": 4
+    }
+    gcp.stream_upload_str(bucket, json.dumps(hyparams), 'vm-progress/0/hyperparameters.json')
+
+    manager = Manager(str(tmp_path / 'temp'), bucket, 0, torch, CheckpointOptions(async_save=True))
+    manager.hyparam_search(run, parallel=2)
+
+    results = [blob.name for blob in gcp.backend.list_blobs(bucket, 'results/')]
+    assert sorted(os.path.dirname(name) for name in results) == ['results/0-0'] * 2 + ['results/0-1'] * 2
+    assert list(gcp.backend.list_blobs(bucket, 'shared-errors/')) == []
+
+
+class HookedModel(Model):
+    '''
+    Model with the forward pre-hooks of torch.nn.Module
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.hooks = {}
+
+    def register_forward_pre_hook(self, hook):
+        handle = Handle(self.hooks)
+        self.hooks[handle] = hook
+        return handle
+
+    def __call__(self):
+        for hook in list(self.hooks.values()):
+            hook(self, ())
+        return self.weight
+
+
+class Handle:
+    def __init__(self, hooks):
+        self.hooks = hooks
+
+    def remove(self):
+        self.hooks.pop(self, None)
+
+
+def test_defer_best_copies_before_the_next_step(bucket, tmp_path):
+    hyparams = {
+        "hyperparameters": {"LR": {"method": "list", "data": [1]}},
+        "current_iter": 0,
+        "max_iter": 1
+    }
+    gcp.stream_upload_str(bucket, json.dumps(hyparams), 'vm-progress/0/hyperparameters.json')
+    manager = Manager(str(tmp_path / 'temp'), bucket, 0, torch, CheckpointOptions(defer_best=True))
+    model = HookedModel()
+    manager.track_model(model)
+    manager.set_compare_goal('acc', 'max')
+
+    manager.add_progress('epochs', 0)
+    manager.add_progress('acc', 1)
+    # The next training step runs a forward pass before the optimizer changes the params in place
+    model()
+    model.weight.copy_(torch.ones(2))
+    manager.add_progress('epochs', 1)
+    manager.add_progress('acc', 0)
+    manager.save_progress()
+
+    assert torch.equal(manager.best_params['weight'], torch.zeros(2))
+    manager.finished()
+    assert model.hooks == {}
+
+
+class MetadataHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Fake metadata server that reports the VM as preempted once preempted is set to TRUE
+    '''
+    preempted = 'FALSE'
+
+    def do_GET(self):
+        body = self.preempted.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def metadata_url():
+    MetadataHandler.preempted = 'FALSE'
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MetadataHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%d/preempted' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def test_emergency_save_on_preemption(bucket, tmp_path, metadata_url, monkeypatch):
+    pytest.importorskip('requests')
+    hyparams = {
+        "hyperparameters": {"LR": {"method": "list", "data": [1]}},
+        "current_iter": 0,
+        "max_iter": 1
+    }
+    gcp.stream_upload_str(bucket, json.dumps(hyparams), 'vm-progress/0/hyperparameters.json')
+    monkeypatch.setattr(preemption, 'watcher', None)
+    monkeypatch.setattr(preemption, 'watch', functools.partial(preemption.watch, poll_seconds=0.1))
+
+    try:
+        manager = Manager(str(tmp_path / 'temp'), bucket, 0, torch,
+                          CheckpointOptions(preempt_save=True, metadata_url=metadata_url))
+        model = Model()
+        manager.track_model(model)
+        manager.set_compare_goal('acc', 'max')
+        for epoch in range(3):
+            manager.add_progress('epochs', epoch)
+            manager.add_progress('acc', epoch)
+            manager.save_progress()
+        # Epoch 3 is only saved by the emergency checkpoint
+        model.weight = torch.ones(2)
+        manager.add_progress('epochs', 3)
+        manager.add_progress('acc', 3)
+
+        MetadataHandler.preempted = 'TRUE'
+        assert preemption.watcher.saved.wait(10)
+    finally:
+        preemption.after_fork()
+
+    resumed = Manager(str(tmp_path / 'resumed'), bucket, 0, torch)
+    assert resumed.start_epoch() == 4
+    model = Model()
+    resumed.track_model(model)
+    assert torch.equal(model.weight, torch.ones(2))